@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+ローカル代替サーバー（portal_stub.py）を相手に各スクリプトを動かし、段階ごとの所要時間を計測する
+- 段階: startup（Chrome 起動）/ login / switch_store / export（画面操作・直接取得）/ download_wait / shutdown
+- download_wait はダウンロード完了待ち（download_events.wait_for_downloads 等）に掛かった時間
+- 本番サイトにはアクセスしない。セッションキャッシュは .cache/benchmark に分離（本番の Cookie を上書きしない）
+
+使い方:
+    python benchmark.py                                  # 全シナリオを1回ずつ
+    python benchmark.py --repeat 3 --latency 100 --file-size 2048
+    python benchmark.py --scenario carsensor_http --scenario goonet_bukken --json result.json
+    python benchmark.py --compare-lean                   # 通常モードと軽量モード（LEAN_MODE）を比較
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+import download_events
+import portal_stub
+import session_cache
+
+STAGES = ("startup", "login", "switch_store", "export", "download_wait", "shutdown")
+
+# 代替サーバー（portal_stub）の「他店舗参照」にある店舗名
+STUB_STORE_TEXTS = ("ハイエース専門店",)
+
+# ダウンロード完了待ちとして計測する関数（モジュール名, 関数名）
+WAIT_FUNCTIONS = (
+    ("download_events", "wait_for_downloads"),
+    ("carsensor_download", "wait_for_new_downloads"),
+    ("carsensor_bukken", "wait_for_download"),
+    ("goonet_download", "wait_for_new_downloads"),
+    ("goonet_bukken", "wait_for_download"),
+)
+
+
+def new_record():
+    return {stage: 0.0 for stage in STAGES}
+
+
+@contextlib.contextmanager
+def measure(record: dict, stage: str):
+    """stage の所要時間を record に加算する。export からはその間の download_wait を差し引く"""
+    waited = record["download_wait"]
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if stage == "export":
+            elapsed -= record["download_wait"] - waited
+        record[stage] += elapsed
+
+
+@contextlib.contextmanager
+def timed_waits(record: dict):
+    """ダウンロード完了待ちの関数を包んで、待ち時間を record["download_wait"] に加算する"""
+    originals = []
+    for module_name, func_name in WAIT_FUNCTIONS:
+        module = sys.modules.get(module_name)
+        if module is None or not hasattr(module, func_name):
+            continue
+        original = getattr(module, func_name)
+
+        def wrapper(*args, _original=original, **kwargs):
+            started = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                record["download_wait"] += time.perf_counter() - started
+
+        originals.append((module, func_name, original))
+        setattr(module, func_name, wrapper)
+    try:
+        yield
+    finally:
+        for module, func_name, original in originals:
+            setattr(module, func_name, original)
+
+
+# ===== シナリオ（各スクリプトの関数を直接呼ぶ） =====
+
+def scenario_carsensor_download(record, m, download_dir: Path, headless: bool):
+    with measure(record, "startup"):
+        driver = m.build_driver(download_dir, headless)
+    try:
+        with measure(record, "login"):
+            m.login_carsensor(driver, "benchmark", "benchmark")
+        with measure(record, "export"):
+            m.download_access_counts(driver, download_dir, "メイン")
+        with measure(record, "switch_store"):
+            m.switch_store(driver, STUB_STORE_TEXTS)
+        with measure(record, "export"):
+            files = m.download_access_counts(driver, download_dir, "ハイエース")
+            m.rename_with_suffix(files, "_hiace")
+    finally:
+        with measure(record, "shutdown"):
+            driver.quit()
+
+
+def scenario_carsensor_bukken(record, m, download_dir: Path, headless: bool):
+    with measure(record, "startup"):
+        # carsensor_bukken は常にヘッドレスで起動する
+        driver = m.build_driver(str(download_dir))
+    try:
+        with measure(record, "login"):
+            m.login(driver, "benchmark", "benchmark")
+        with measure(record, "export"):
+            m.download_registration_list(driver, download_dir, "最初のページ")
+        with measure(record, "switch_store"):
+            m.carsensor_download.switch_store(driver, STUB_STORE_TEXTS)
+        with measure(record, "export"):
+            m.download_registration_list(driver, download_dir, "ハイエース専門店ページ")
+    finally:
+        with measure(record, "shutdown"):
+            driver.quit()
+
+
+def scenario_goonet_download(record, m, download_dir: Path, headless: bool):
+    with measure(record, "startup"):
+        driver = m.build_driver(download_dir, headless)
+    try:
+        with measure(record, "login"):
+            m.login_goonet(driver, "benchmark", "benchmark")
+        with measure(record, "export"):
+            m.download_stockeffect(driver, download_dir)
+    finally:
+        with measure(record, "shutdown"):
+            driver.quit()
+
+
+def scenario_goonet_bukken(record, m, download_dir: Path, headless: bool):
+    with measure(record, "startup"):
+        driver = m.build_driver(str(download_dir), headless)
+    try:
+        with measure(record, "login"):
+            m.login(driver, "benchmark", "benchmark")
+        with measure(record, "export"):
+            m.download_stock_search(driver, download_dir)
+    finally:
+        with measure(record, "shutdown"):
+            driver.quit()
+
+
+def scenario_carsensor_http(record, m, download_dir: Path, headless: bool):
+    """ブラウザ無し（carsensor_http）の場合の比較用"""
+    with measure(record, "startup"):
+        session = m.new_session()
+    try:
+        with measure(record, "login"):
+            m.login(session, "benchmark", "benchmark")
+        with measure(record, "export"):
+            m.download_page_export(session, m.ACCESS_URL, download_dir, "hankyobukken")
+            m.download_page_export(session, m.REGISTRATION_URL, download_dir, "torokubukken")
+        with measure(record, "switch_store"):
+            m.switch_store(session, m.ACCESS_URL)
+        with measure(record, "export"):
+            m.download_page_export(session, m.ACCESS_URL, download_dir, "hankyobukken")
+            m.download_page_export(session, m.REGISTRATION_URL, download_dir, "torokubukken")
+    finally:
+        with measure(record, "shutdown"):
+            session.close()
+
+
+# シナリオ名 → (ポータル, 対象モジュール, 関数)
+SCENARIOS = {
+    "carsensor_download": ("carsensor", "carsensor_download", scenario_carsensor_download),
+    "carsensor_bukken": ("carsensor", "carsensor_bukken", scenario_carsensor_bukken),
+    "goonet_download": ("goonet", "goonet_download", scenario_goonet_download),
+    "goonet_bukken": ("goonet", "goonet_bukken", scenario_goonet_bukken),
+    "carsensor_http": ("carsensor", "carsensor_http", scenario_carsensor_http),
+}
+
+
+# ===== 実行・集計 =====
+
+def run_scenario(name: str, repeat: int, headless: bool, keep_session: bool, server, lean: bool = False):
+    portal, module_name, func = SCENARIOS[name]
+    # driver_factory は起動のたびに LEAN_MODE を読む
+    os.environ["LEAN_MODE"] = "true" if lean else "false"
+    # 接続先（環境変数）を読んだ状態で import する
+    module = importlib.import_module(module_name)
+    records = []
+    for i in range(repeat):
+        if not keep_session:
+            session_cache.clear(portal)
+        download_dir = Path(tempfile.mkdtemp(prefix=f"bench_{name}_"))
+        record = new_record()
+        before = dict(server.stats)
+        print(f"\n##### {name}{' (軽量モード)' if lean else ''} ({i + 1}/{repeat}) #####")
+        started = time.perf_counter()
+        try:
+            with timed_waits(record):
+                func(record, module, download_dir, headless)
+            record["error"] = None
+        except Exception as e:
+            print(traceback.format_exc())
+            record["error"] = str(e)
+        record["total"] = time.perf_counter() - started
+        files = download_events.published_files(download_dir, exts=None)
+        record["files"] = len(files)
+        record["file_bytes"] = sum(p.stat().st_size for p in files)
+        record["requests"] = server.stats.get("requests", 0) - before.get("requests", 0)
+        record["bytes_sent"] = server.stats.get("bytes_sent", 0) - before.get("bytes_sent", 0)
+        record["assets"] = server.stats.get("assets", 0) - before.get("assets", 0)
+        shutil.rmtree(download_dir, ignore_errors=True)
+        records.append(record)
+    return records
+
+
+def print_report(results: dict):
+    print("\n" + "=" * 100)
+    print(f"{'シナリオ':<20}" + "".join(f"{s:>14}" for s in STAGES) + f"{'合計':>10}  最大の段階")
+    print("-" * 100)
+    for name, records in results.items():
+        ok = [r for r in records if not r["error"]] or records
+        mean = {s: sum(r[s] for r in ok) / len(ok) for s in STAGES + ("total",)}
+        dominant = max(STAGES, key=lambda s: mean[s])
+        share = mean[dominant] / mean["total"] * 100 if mean["total"] else 0
+        print(f"{name:<20}" + "".join(f"{mean[s]:>13.2f}s" for s in STAGES) + f"{mean['total']:>9.2f}s"
+              f"  {dominant} ({share:.0f}%)")
+        failed = [r["error"] for r in records if r["error"]]
+        files = sum(r["files"] for r in ok) / len(ok)
+        sent = sum(r["bytes_sent"] for r in ok) / len(ok)
+        print(f"{'':<20}ファイル {files:.1f} 件 / 受信 {sent:,.0f} バイト / リクエスト "
+              f"{sum(r['requests'] for r in ok) / len(ok):.0f} 回（うち画像等 "
+              f"{sum(r.get('assets', 0) for r in ok) / len(ok):.0f} 回）"
+              + (f" / 失敗 {len(failed)} 回: {failed[0][:60]}" if failed else ""))
+    print("=" * 100)
+
+
+def print_lean_comparison(results: dict):
+    """通常モードと軽量モードの受信量・所要時間の差"""
+    def mean(records, key):
+        ok = [r for r in records if not r["error"]] or records
+        return sum(r[key] for r in ok) / len(ok)
+
+    print("\n軽量モードの効果（通常 → 軽量）")
+    for name, records in results.items():
+        lean = results.get(f"{name}+lean")
+        if name.endswith("+lean") or not lean:
+            continue
+        before, after = mean(records, "bytes_sent"), mean(lean, "bytes_sent")
+        saved = (before - after) / before * 100 if before else 0
+        print(f"  {name:<20}受信 {before:,.0f} → {after:,.0f} バイト（{before - after:,.0f} バイト削減、{saved:.0f}%）"
+              f" / 合計 {mean(records, 'total'):.2f}s → {mean(lean, 'total'):.2f}s"
+              f" / リクエスト {mean(records, 'requests'):.0f} → {mean(lean, 'requests'):.0f} 回")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ローカル代替サーバーで各スクリプトの段階別所要時間を計測")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="実行するシナリオ（複数指定可。既定: すべて）")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0, help="各応答の遅延（ミリ秒）")
+    parser.add_argument("--export-delay", type=float, default=0, help="エクスポート生成の待ち（ミリ秒）")
+    parser.add_argument("--file-size", type=int, default=64, help="エクスポートファイルのサイズ（KB）")
+    parser.add_argument("--bandwidth", type=int, default=0, help="ダウンロードの帯域（KB/秒、0 で無制限）")
+    parser.add_argument("--asset-size", type=int, default=200, help="画面の画像・フォントのサイズ（KB、0 で無し）")
+    parser.add_argument("--lean", action="store_true", help="軽量モード（LEAN_MODE）で実行")
+    parser.add_argument("--compare-lean", action="store_true", help="通常モードと軽量モードの両方で実行して比較")
+    parser.add_argument("--show-browser", action="store_true", help="ヘッドレスにしない")
+    parser.add_argument("--keep-session", action="store_true",
+                        help="繰り返し間でセッションキャッシュを消さない（2回目以降のログイン省略を計測）")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    args = parser.parse_args(argv)
+
+    server = portal_stub.start_in_thread(latency=args.latency / 1000, export_delay=args.export_delay / 1000,
+                                         file_size=args.file_size * 1024, bandwidth=args.bandwidth * 1024,
+                                         asset_size=args.asset_size * 1024)
+    # スクリプトの import 前に接続先とキャッシュの置き場所を切り替える
+    os.environ.update(portal_stub.base_urls(server))
+    os.environ["CACHE_DIR"] = str(session_cache.cache_dir() / "benchmark")
+    print(f"代替サーバー: {portal_stub.base_urls(server)}")
+
+    results = {}
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            if args.compare_lean or not args.lean:
+                results[name] = run_scenario(name, args.repeat, not args.show_browser, args.keep_session, server)
+            if args.compare_lean or args.lean:
+                results[f"{name}+lean"] = run_scenario(name, args.repeat, not args.show_browser, args.keep_session,
+                                                       server, lean=True)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print_report(results)
+    if args.compare_lean:
+        print_lean_comparison(results)
+    if args.json:
+        config = {k: v for k, v in vars(args).items() if k != "json"}
+        Path(args.json).write_text(json.dumps({"config": config, "results": results}, ensure_ascii=False, indent=2),
+                                   encoding="utf-8")
+        print(f"結果を保存しました: {args.json}")
+    return 1 if any(r["error"] for records in results.values() for r in records) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
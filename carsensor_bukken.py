@@ -9,14 +9,19 @@
 import os
 import json
 import time
-import glob
+import traceback
 from pathlib import Path
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+
+import carsensor_download
+import download_events
+import driver_factory
+import session_cache
+import shops
+import timeouts
+import tracing
 
 # ===== 設定読込 =====
 def load_settings():
@@ -32,21 +37,6 @@ def load_settings():
         "設定ファイルが見つかりませんでした。'setting.json' もしくは 'settig.json' / 'settings.json' を実行フォルダに置いてください。"
     )
 
-settings = load_settings()
-
-username = settings.get("CARSENSOR_USERNAME")
-password = settings.get("CARSENSOR_PASSWORD")
-download_dir_str = settings.get("DOWNLOAD_DIR")
-
-if not username or not password:
-    raise RuntimeError("setting.json に 'CARSENSOR_USERNAME' と 'CARSENSOR_PASSWORD' を設定してください。")
-if not download_dir_str:
-    raise RuntimeError("setting.json に 'DOWNLOAD_DIR' を設定してください。（例: C:\\\\Users\\\\m-oka\\\\Downloads）")
-
-DOWNLOAD_DIR = Path(download_dir_str).expanduser().resolve()
-DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
-download_path = str(DOWNLOAD_DIR)
-
 # ===== ユーティリティ =====
 def list_data_files(root_dir: Path):
     exts = {".csv", ".xlsx", ".xls"}
@@ -58,15 +48,18 @@ def list_data_files(root_dir: Path):
                 files.append(str(p))
     return files
 
+@tracing.traced("download.wait", portal="carsensor", mode="poll")
 def wait_for_download(before_files, dir_path: Path, timeout=90):
-    """5秒待機して新規ファイルを返す"""
-    time.sleep(5)
+    """新規ファイルが現れた時点で返す（イベント非対応時のフォールバック）"""
     before_set = set(before_files)
-    now = list_data_files(dir_path)
-    new_files = [p for p in now if p not in before_set]
-    if new_files:
-        print(f"ダウンロード完了: {len(new_files)}件")
-        return new_files
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        now = list_data_files(dir_path)
+        new_files = [p for p in now if p not in before_set]
+        if new_files and not list(dir_path.glob("*.crdownload")):
+            print(f"ダウンロード完了: {len(new_files)}件")
+            return new_files
+        time.sleep(0.5)
     print("新規ファイルが見つかりませんでした")
     return []
 
@@ -82,10 +75,14 @@ def handle_alert_if_present(driver):
     except Exception:
         return False
 
+@tracing.traced("export.trigger", driver_arg=0)
 def start_download_once(driver, locator, before_files, dir_path: Path, trigger_wait=6):
     """ダウンロードボタンをクリック（シンプル版）"""
+    from selenium.webdriver.support import expected_conditions as EC
     try:
-        elem = WebDriverWait(driver, 20).until(EC.element_to_be_clickable(locator))
+        with tracing.span("selector", target=locator[1]):
+            elem = timeouts.wait(driver, "carsensor.registration.download_button", 20, "carsensor").until(
+                EC.element_to_be_clickable(locator))
         driver.execute_script("arguments[0].scrollIntoView({block:'center'});", elem)
         time.sleep(0.2)
         elem.click()
@@ -96,59 +93,56 @@ def start_download_once(driver, locator, before_files, dir_path: Path, trigger_w
         print(f"ダウンロードボタンクリック失敗: {e}")
         return False
 
-# ===== Chrome オプション =====
-options = webdriver.ChromeOptions()
-# 必要なら下の1行をコメントアウトしてブラウザ表示
-options.add_argument("--headless=new")
-options.add_argument("--disable-gpu")
-options.add_argument("--no-sandbox")
-options.add_argument("--disable-dev-shm-usage")
-options.add_argument("--window-size=1920,1080")
-
-prefs = {
-    "download.default_directory": download_path,   # JSONの DOWNLOAD_DIR
-    "download.prompt_for_download": False,
-    "download.directory_upgrade": True,
-    "safebrowsing.enabled": True,
-}
-options.add_experimental_option("prefs", prefs)
-
-# ===== WebDriver 準備（Selenium Manager → 失敗時 webdriver-manager）=====
-driver = None
-try:
-    driver = webdriver.Chrome(options=options)
-except Exception as e:
-    print("Selenium Manager での起動に失敗。webdriver-manager を試します:", e)
+# ===== Chrome 起動 =====
+@tracing.traced("driver.build", portal="carsensor")
+def build_driver(download_path: str):
+    options = webdriver.ChromeOptions()
+    # 必要なら下の1行をコメントアウトしてブラウザ表示
+    options.add_argument("--headless=new")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--window-size=1920,1080")
+
+    prefs = {
+        "download.default_directory": download_path,   # JSONの DOWNLOAD_DIR
+        "download.prompt_for_download": False,
+        "download.directory_upgrade": True,
+        "safebrowsing.enabled": True,
+    }
+    options.add_experimental_option("prefs", prefs)
+    download_events.enable_performance_log(options)
+
+    # ChromeDriver はバージョン別にキャッシュしたパスを使う（毎回のネットワーク問い合わせをしない）
+    driver = driver_factory.create_chrome(options, portal="carsensor")
+
+    # ヘッドレス時のダウンロード許可（未対応版は無視）
     try:
-        from webdriver_manager.chrome import ChromeDriverManager
-        driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    except Exception as e2:
-        raise RuntimeError(f"ChromeDriver の起動に失敗しました: {e2}")
-
-# ヘッドレス時のダウンロード許可（未対応版は無視）
-try:
-    driver.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": download_path})
-except Exception:
-    pass
+        driver.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": download_path})
+    except Exception:
+        pass
+    return driver
 
 # ===== ターゲット URL =====
-login_url = "https://c-match.carsensor.net/login/"
-target_url = "https://c-match.carsensor.net/vehicles/registrationList/"
+# 接続先（ローカルの代替サーバー等で検証する場合は CARSENSOR_BASE_URL で変更）
+base_url = os.getenv("CARSENSOR_BASE_URL", "https://c-match.carsensor.net/").rstrip("/") + "/"
+login_url = base_url + "login/"
+target_url = base_url + "vehicles/registrationList/"
 
-try:
-    # 実行前のファイル状態
-    print("実行前のファイル状態を確認:")
-    pre_files = list_data_files(DOWNLOAD_DIR)
-    try:
-        print(f"実行前に存在するCSV/Excel ファイル数: {len(pre_files)}")
-    except UnicodeEncodeError:
-        print(f"実行前に存在するCSV/Excel ファイル数: {len(pre_files)}")
+def is_logged_in(driver):
+    return "/login" not in driver.current_url and not driver.find_elements(By.NAME, "loginId")
+
+@tracing.traced("login", driver_arg=0, portal="carsensor")
+def login(driver, username, password):
+    from selenium.webdriver.support import expected_conditions as EC
+    # キャッシュ済みセッションが有効ならログインフォームを省略
+    if session_cache.restore_driver_session(driver, "carsensor", base_url, target_url, is_logged_in):
+        return
 
-    # --- ログイン ---
     driver.get(login_url)
     print(f"ログインページにアクセスしました: {driver.current_url}")
 
-    username_field = WebDriverWait(driver, 20).until(
+    username_field = timeouts.wait(driver, "carsensor.login.form", 20, "carsensor").until(
         EC.presence_of_element_located((By.XPATH, "//input[@name='loginId']"))
     )
     password_field = driver.find_element(By.XPATH, "//input[@name='passwordCd']")
@@ -158,126 +152,99 @@ try:
     login_button = driver.find_element(By.XPATH, "//input[@id='sbtLogin']")
     login_button.click()
 
-    wait = WebDriverWait(driver, 20)
+    wait = timeouts.wait(driver, "carsensor.login.redirect", 20, "carsensor")
     try:
         wait.until(EC.url_contains("login=true"))
     except Exception:
         wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
     print(f"ログイン後URL: {driver.current_url}")
-
-    # --- 対象ページへ ---
-    driver.get(target_url)
+    if is_logged_in(driver):
+        session_cache.save_driver_session(driver, "carsensor")
+
+@tracing.traced("export", dataset="carsensor_registration")
+def download_registration_list(driver, download_dir: Path, label: str = "最初のページ", job: str = "carsensor.registration"):
+    """registrationList ページでダウンロードを一度だけトリガーし、新規ファイル（download_dir/<job>/ に移したもの）を返す"""
+    tracing.annotate(label=label)
+    with tracing.span("navigate", driver=driver, url=target_url):
+        driver.get(target_url)
     print(f"目的のページに移動しました: {driver.current_url}")
     time.sleep(2)
 
-    # ダウンロードボタン（最初のページ）を一度だけトリガー
-    before = list_data_files(DOWNLOAD_DIR)
-    print("最初のページでのダウンロードを開始します（単発トリガー制御）。")
-    started = start_download_once(
-        driver,
-        (By.XPATH, "//*[contains(text(), 'ダウンロード')]"),
-        before,
-        DOWNLOAD_DIR,
-        trigger_wait=6
-    )
-    if not started:
-        raise RuntimeError("最初のページでダウンロード開始を検知できませんでした。")
+    # このジョブ専用の一時フォルダに保存させる（DOWNLOAD_DIR 全体は走査しない）
+    with download_events.staging(driver, download_dir) as (folder, armed):
+        before = list_data_files(folder)
+        print(f"{label}でのダウンロードを開始します（単発トリガー制御）。")
+        started = start_download_once(
+            driver,
+            (By.XPATH, "//*[contains(text(), 'ダウンロード')]"),
+            before,
+            folder,
+            trigger_wait=6
+        )
+        if not started:
+            raise RuntimeError(f"{label}でダウンロード開始を検知できませんでした。")
+
+        print("ダウンロードの完了を待機中...")
+        if armed:
+            new_files = [str(d["path"]) for d in download_events.wait_for_downloads(
+                driver, folder, timeout=timeouts.timeout("download.wait", 90, "carsensor"), portal="carsensor")]
+        else:
+            new_files = wait_for_download(before, folder, timeout=timeouts.timeout("download.wait", 90, "carsensor"))
+        if new_files:
+            new_files = [str(p) for p in download_events.publish(new_files, download_dir, job)]
+            print(f"ダウンロードされたファイル数: {len(new_files)}")
+        else:
+            print("ダウンロードされたファイルが見つかりませんでした")
+    return new_files
+
+def main():
+    settings = load_settings()
 
-    print("ダウンロードの完了を待機中...")
-    new_files = wait_for_download(before, DOWNLOAD_DIR, timeout=90)
-    if new_files:
-        print(f"ダウンロードされたファイル数: {len(new_files)}")
-    else:
-        print("ダウンロードされたファイルが見つかりませんでした")
-        print(f"現在のファイル数（デバッグ用）: {len(list_data_files(DOWNLOAD_DIR))}")
+    username = settings.get("CARSENSOR_USERNAME")
+    password = settings.get("CARSENSOR_PASSWORD")
+    download_dir_str = settings.get("DOWNLOAD_DIR")
 
-    # ===== 「他店舗参照」→「ハイエース専門店」での2回目DL（こちらも単発トリガー）=====
-    print("\n=== ハイエース専門店のクリック処理を開始 ===")
+    if not username or not password:
+        raise RuntimeError("setting.json に 'CARSENSOR_USERNAME' と 'CARSENSOR_PASSWORD' を設定してください。")
+    if not download_dir_str:
+        raise RuntimeError("setting.json に 'DOWNLOAD_DIR' を設定してください。（例: C:\\\\Users\\\\m-oka\\\\Downloads）")
 
+    DOWNLOAD_DIR = Path(download_dir_str).expanduser().resolve()
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    download_path = str(DOWNLOAD_DIR)
+
+    driver = None
     try:
-        handle_alert_if_present(driver)
+        driver = build_driver(download_path)
 
-        print("「他店舗参照」ボタンを検索中...")
-        tatenpobtn = WebDriverWait(driver, 20).until(
-            EC.element_to_be_clickable((By.ID, "tatenpoBtn"))
-        )
-        tatenpobtn.click()
-        print("「他店舗参照」ボタンをクリックしました")
-        time.sleep(2)
+        # --- ログイン ---
+        login(driver, username, password)
 
-        print("「ハイエース専門店」を含む要素を検索中...")
-        hiace_element = None
-        # 方法1
-        try:
-            hiace_element = WebDriverWait(driver, 10).until(
-                EC.element_to_be_clickable((By.XPATH, "//*[contains(text(), 'ハイエース専門店')]"))
-            )
-            print("方法1でハイエース専門店の要素を発見しました")
-        except Exception:
-            print("方法1では見つかりませんでした")
-        # 方法2
-        if hiace_element is None:
-            try:
-                hiace_element = WebDriverWait(driver, 5).until(
-                    EC.element_to_be_clickable((By.XPATH, "//h1[contains(text(), 'ハイエース専門店')]"))
-                )
-                print("方法2でハイエース専門店の要素を発見しました")
-            except Exception:
-                print("方法2では見つかりませんでした")
-        # 方法3
-        if hiace_element is None:
+        # --- shops.json の店舗を順に（既定の店舗 → 「他店舗参照」で切り替える店舗）---
+        for shop in shops.shops("carsensor"):
+            print(f"\n=== {shop['name']} のダウンロード処理（単発トリガー）開始 ===")
             try:
-                hiace_element = WebDriverWait(driver, 5).until(
-                    EC.element_to_be_clickable((By.XPATH, "//*[contains(text(), 'CAR PRODUCE')]"))
-                )
-                print("方法3でCAR PRODUCEの要素を発見しました")
-            except Exception:
-                print("方法3では見つかりませんでした")
-
-        if hiace_element:
-            driver.execute_script("arguments[0].scrollIntoView({block:'center'});", hiace_element)
-            hiace_element.click()
-            print("ハイエース専門店の要素をクリックしました")
-            time.sleep(2)
-
-            print("\n=== ハイエース専門店ページでのダウンロード処理（単発トリガー）開始 ===")
-            pre_hiace = list_data_files(DOWNLOAD_DIR)
-            started2 = start_download_once(
-                driver,
-                (By.XPATH, "//*[contains(text(), 'ダウンロード')]"),
-                pre_hiace,
-                DOWNLOAD_DIR,
-                trigger_wait=6
-            )
-            if started2:
-                print("ハイエース専門店ページのダウンロード完了待機...")
-                new_hiace = wait_for_download(pre_hiace, DOWNLOAD_DIR, timeout=90)
-                if new_hiace:
-                    print(f"ハイエース専門店でダウンロードされたファイル数: {len(new_hiace)}")
-                else:
-                    print("ハイエース専門店でダウンロードされたファイルが見つかりませんでした")
-            else:
-                print("ハイエース専門店ページでダウンロード開始を検知できませんでした")
-        else:
-            print("ハイエース専門店の要素が見つかりませんでした")
-            body_text = driver.find_element(By.TAG_NAME, "body").text
-            if "ハイエース" in body_text:
-                print("ページにはハイエースというテキストが含まれています")
-            else:
-                print("ページにハイエースというテキストが見つかりません")
+                if not shop.get("default"):
+                    carsensor_download.switch_store(driver, shop["switch"])
+                new_files = download_registration_list(driver, DOWNLOAD_DIR, shop["name"],
+                                                       shops.step_name("carsensor", "registration", shop))
+                carsensor_download.rename_for_shop(new_files, shop)
+            except Exception as e:
+                print(f"{shop['name']} の処理でエラーが発生しました: {e}")
+                print(traceback.format_exc())
+
     except Exception as e:
-        print(f"ハイエース専門店のクリック処理でエラーが発生しました: {e}")
-        import traceback
+        print(f"エラーが発生しました: {e}")
         print(traceback.format_exc())
 
-except Exception as e:
-    print(f"エラーが発生しました: {e}")
-    import traceback
-    print(traceback.format_exc())
+    finally:
+        try:
+            driver_factory.report_lean(driver)
+            driver.quit()
+        except Exception:
+            pass
+        print("処理を完了しました（ダウンロード先: " + download_path + "）")
+
 
-finally:
-    try:
-        driver.quit()
-    except Exception:
-        pass
-    print("処理を完了しました（ダウンロード先: " + download_path + "）")
+if __name__ == "__main__":
+    main()
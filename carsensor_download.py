@@ -1,19 +1,19 @@
 import os
 import json
 import time
-import glob
-import shutil
 import traceback
-import selenium
 from pathlib import Path
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 
-from webdriver_manager.chrome import ChromeDriverManager
+import download_events
+import driver_factory
+import locators
+import session_cache
+import shops
+import timeouts
+import tracing
 
 # ---- 設定の読み込み ---------------------------------------------------------
 
@@ -50,6 +50,7 @@ def load_settings():
         "CARSENSOR_PASSWORD": os.getenv("CARSENSOR_PASSWORD"),
         "HEADLESS": os.getenv("HEADLESS"),
         "DOWNLOAD_DIR": os.getenv("DOWNLOAD_DIR"),
+        "CARSENSOR_HTTP": os.getenv("CARSENSOR_HTTP"),
     }
     for k, v in env_map.items():
         if v is not None:
@@ -61,6 +62,12 @@ def load_settings():
         headless = headless.strip().lower() in ("1", "true", "yes", "on")
     settings["HEADLESS"] = bool(headless)
 
+    # ブラウザ無し（HTTP）での取得を先に試すか（既定: 試す）
+    use_http = settings.get("CARSENSOR_HTTP", "true")
+    if isinstance(use_http, str):
+        use_http = use_http.strip().lower() in ("1", "true", "yes", "on")
+    settings["CARSENSOR_HTTP"] = bool(use_http)
+
     # ダウンロード先（未指定なら OS のダウンロードフォルダ推定）
     dl = settings.get("DOWNLOAD_DIR")
     if dl:
@@ -84,6 +91,7 @@ def load_settings():
 
 # ---- WebDriver 構築 ---------------------------------------------------------
 
+@tracing.traced("driver.build", portal="carsensor")
 def build_driver(download_dir: Path, headless: bool):
     options = webdriver.ChromeOptions()
     if headless:
@@ -104,9 +112,10 @@ def build_driver(download_dir: Path, headless: bool):
     options.add_experimental_option("prefs", prefs)
     options.add_experimental_option("excludeSwitches", ["enable-automation"])
     options.add_argument("--disable-blink-features=AutomationControlled")
+    download_events.enable_performance_log(options)
 
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=options)
+    # ChromeDriver はバージョン別にキャッシュしたパスを使う（毎回のネットワーク問い合わせをしない）
+    driver = driver_factory.create_chrome(options, portal="carsensor")
     driver.set_page_load_timeout(60)
     return driver
 
@@ -118,217 +127,233 @@ DATA_EXTS = (".csv", ".xlsx", ".xls")
 def snapshot_files(directory: Path):
     return {p for p in directory.glob("*") if p.suffix.lower() in DATA_EXTS}
 
+@tracing.traced("download.wait", portal="carsensor", mode="poll")
 def wait_for_new_downloads(before: set, directory: Path, timeout: int = 120):
-    """新規ダウンロードファイル（.csv/.xlsx/.xls）を待つ。5秒待機して新規ファイルを返す"""
-    time.sleep(5)
-    after = snapshot_files(directory)
-    new_files = [p for p in after - before if p.exists()]
-    if new_files:
-        print(f"ダウンロード完了: {len(new_files)}件")
-        return new_files
+    """新規ダウンロードファイル（.csv/.xlsx/.xls）を待つ（イベント非対応時のフォールバック）。
+    .crdownload が無くなり新規ファイルが現れた時点で返す"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not any(directory.glob("*.crdownload")):
+            new_files = [p for p in snapshot_files(directory) - before if p.exists()]
+            if new_files:
+                print(f"ダウンロード完了: {len(new_files)}件")
+                return new_files
+        time.sleep(0.5)
     print("新規ファイルが見つかりませんでした")
     return []
 
 
-# ---- メイン処理 -------------------------------------------------------------
-
-def main():
-    settings = load_settings()
-    DOWNLOAD_DIR = Path(settings["DOWNLOAD_DIR"])
-    HEADLESS = settings["HEADLESS"]
-    username = settings["CARSENSOR_USERNAME"]
-    password = settings["CARSENSOR_PASSWORD"]
-
-    login_url = "https://c-match.carsensor.net/login/"
-    target_url = "https://c-match.carsensor.net/counter/byVehicle/"
+# ---- 画面操作 ---------------------------------------------------------------
 
-    driver = None
-    try:
-        print(f"ダウンロード先: {DOWNLOAD_DIR}")
-        driver = build_driver(DOWNLOAD_DIR, HEADLESS)
+# 接続先（ローカルの代替サーバー等で検証する場合は CARSENSOR_BASE_URL で変更）
+BASE_URL = os.getenv("CARSENSOR_BASE_URL", "https://c-match.carsensor.net/").rstrip("/") + "/"
+LOGIN_URL = BASE_URL + "login/"
+TARGET_URL = BASE_URL + "counter/byVehicle/"
 
-        # 既存ファイルのスナップショット
-        print("実行前のファイル状態を確認:")
-        pre_files = snapshot_files(DOWNLOAD_DIR)
-        print(f"既存ファイル数: {len(pre_files)}")
+def is_logged_in(driver) -> bool:
+    """ログインページに戻されていなければログイン済み"""
+    return "/login" not in driver.current_url and not driver.find_elements(By.NAME, "loginId")
 
-        # ログイン
-        driver.get(login_url)
-        print(f"ログインページにアクセス: {driver.current_url}")
+@tracing.traced("login", driver_arg=0, portal="carsensor")
+def login_carsensor(driver, username: str, password: str, cached: bool = True):
+    """ログインする。cached=False ならキャッシュの Cookie を使わず新しいセッションでログインし、保存もしない"""
+    from selenium.webdriver.support import expected_conditions as EC
+    # キャッシュ済みセッションが有効ならログインフォームを省略
+    if cached and session_cache.restore_driver_session(driver, "carsensor", BASE_URL, TARGET_URL, is_logged_in):
+        return
 
-        wait = WebDriverWait(driver, 30)
-        username_field = wait.until(EC.presence_of_element_located((By.XPATH, "//input[@name='loginId']")))
-        password_field = driver.find_element(By.XPATH, "//input[@name='passwordCd']")
-        username_field.clear(); username_field.send_keys(username)
-        password_field.clear(); password_field.send_keys(password)
+    driver.get(LOGIN_URL)
+    print(f"ログインページにアクセス: {driver.current_url}")
 
-        login_button = driver.find_element(By.XPATH, "//input[@id='sbtLogin']")
-        login_button.click()
+    username_field = timeouts.wait(driver, "carsensor.login.form", 30, "carsensor").until(EC.presence_of_element_located((By.XPATH, "//input[@name='loginId']")))
+    password_field = driver.find_element(By.XPATH, "//input[@name='passwordCd']")
+    username_field.clear(); username_field.send_keys(username)
+    password_field.clear(); password_field.send_keys(password)
 
-        # ログイン完了待ち
-        wait.until(EC.any_of(EC.url_contains("login=true"),
-                             EC.url_contains("counter"),
-                             EC.presence_of_element_located((By.XPATH, "//a|//button"))))
-        print(f"ログイン成功: {driver.current_url}")
+    login_button = driver.find_element(By.XPATH, "//input[@id='sbtLogin']")
+    login_button.click()
 
-        # カウント対象ページへ
-        driver.get(target_url)
-        print(f"目的ページへ遷移: {driver.current_url}")
-        time.sleep(3)
+    # ログイン完了待ち
+    timeouts.wait(driver, "carsensor.login.redirect", 30, "carsensor").until(
+        EC.any_of(EC.url_contains("login=true"),
+                  EC.url_contains("counter"),
+                  EC.presence_of_element_located((By.XPATH, "//a|//button"))))
+    print(f"ログイン成功: {driver.current_url}")
+    if cached:
+        session_cache.save_driver_session(driver, "carsensor")
 
-        # ダウンロードボタンを検出
-        try:
-            download_button = WebDriverWait(driver, 15).until(
+def accept_alert_if_present(driver, label: str = ""):
+    try:
+        alert = driver.switch_to.alert
+        print(f"{label}アラート検出: {alert.text}")
+        alert.accept()
+        print(f"{label}アラート OK")
+        return True
+    except Exception:
+        return False
+
+@tracing.traced("export", dataset="carsensor_access")
+def download_access_counts(driver, download_dir: Path, label: str = "メイン", job: str = "carsensor.access"):
+    """byVehicle ページでダウンロードを1回だけ発火し、新規ファイル（最新1件。download_dir/<job>/ に移したもの）を返す"""
+    from selenium.webdriver.support import expected_conditions as EC
+    tracing.annotate(label=label)
+    with tracing.span("navigate", driver=driver, url=TARGET_URL):
+        driver.get(TARGET_URL)
+    print(f"目的ページへ遷移: {driver.current_url}")
+    time.sleep(3)
+
+    # ダウンロードボタンを検出
+    try:
+        with tracing.span("selector", target="ダウンロード"):
+            download_button = timeouts.wait(driver, "carsensor.access.download_button", 15, "carsensor").until(
                 EC.element_to_be_clickable((By.XPATH, "//*[contains(text(), 'ダウンロード')]"))
             )
-            print(f"ダウンロードボタン検出: タグ={download_button.tag_name}")
-        except Exception:
-            # デバッグ情報出力
-            all_links = driver.find_elements(By.TAG_NAME, "a")
-            all_buttons = driver.find_elements(By.TAG_NAME, "button")
-            print(f"リンク数: {len(all_links)}, ボタン数: {len(all_buttons)}")
-            raise RuntimeError("ダウンロードボタンが見つかりませんでした。")
-
-        # クリック前スナップショット
-        before_main = snapshot_files(DOWNLOAD_DIR)
-
-        # ★「直アクセス or クリック」どちらか1回だけ
-        did_action = False
-        if download_button.tag_name.lower() == "a":
-            href = (download_button.get_attribute("href") or "").strip()
-            if href and not href.lower().startswith("javascript"):
-                print(f"href 直アクセスのみ実行: {href}")
-                driver.get(href)
-                did_action = True
-
-        if not did_action:
-            download_button.click()
-            print("ダウンロードボタンをクリック（1回のみ）")
-
-        # 可能なアラート処理
-        time.sleep(1)
-        try:
-            alert = driver.switch_to.alert
-            print(f"アラート検出: {alert.text}")
-            alert.accept()
-            print("アラート OK")
-        except Exception:
-            pass
-
-        # ダウンロード完了待ち（★最新の1ファイルだけ採用）
-        new_main_files = wait_for_new_downloads(before_main, DOWNLOAD_DIR, timeout=180)
-        if new_main_files:
-            new_main_files = sorted(new_main_files, key=lambda p: p.stat().st_mtime, reverse=True)[:1]
-            print("ダウンロード完了（メイン）:")
-            for p in new_main_files:
-                print(f"- {p}")
-        else:
-            print("ダウンロードされたファイルが見つかりませんでした（メイン）。")
+        print(f"({label}) ダウンロードボタン検出: タグ={download_button.tag_name}")
+    except Exception:
+        # デバッグ情報出力
+        all_links = driver.find_elements(By.TAG_NAME, "a")
+        all_buttons = driver.find_elements(By.TAG_NAME, "button")
+        print(f"({label}) リンク数: {len(all_links)}, ボタン数: {len(all_buttons)}")
+        raise RuntimeError(f"({label}) ダウンロードボタンが見つかりませんでした。")
 
-        # ===== ハイエース専門店のクリック処理 =====
-        print("\n=== ハイエース専門店のクリック処理を開始 ===")
-        try:
-            # アラートが残っていれば処理
-            try:
-                alert = driver.switch_to.alert
-                print(f"アラート検出: {alert.text}")
-                alert.dismiss()
-                time.sleep(1)
-            except Exception:
-                pass
-
-            # 「他店舗参照」押下
-            tatenpo = WebDriverWait(driver, 15).until(EC.element_to_be_clickable((By.ID, "tatenpoBtn")))
-            tatenpo.click()
-            print("「他店舗参照」をクリック")
-            time.sleep(2)
-
-            # 「ハイエース専門店」を探してクリック（複数パターン）
-            hiace_element = None
-            for xp in [
-                "//*[contains(text(), 'ハイエース専門店')]",
-                "//h1[contains(text(), 'ハイエース専門店')]",
-                "//*[contains(text(), 'CAR PRODUCE')]",
-            ]:
-                try:
-                    hiace_element = WebDriverWait(driver, 8).until(EC.element_to_be_clickable((By.XPATH, xp)))
-                    print(f"要素検出: {xp}")
-                    break
-                except Exception:
-                    pass
-
-            if not hiace_element:
-                # ページ内テキスト確認
-                body_text = driver.find_element(By.TAG_NAME, "body").text
-                if "ハイエース" in body_text:
-                    print("ページ内に『ハイエース』テキストは存在しますが、クリック可能要素が見つかりません。")
-                else:
-                    print("ページ内に『ハイエース』テキストが見つかりません。")
-                raise RuntimeError("ハイエース専門店の要素が見つかりませんでした。")
-
-            hiace_element.click()
-            print("『ハイエース専門店』をクリック")
-            time.sleep(2)
-
-            # ハイエースページでのダウンロード
-            try:
-                download_button_hiace = WebDriverWait(driver, 15).until(
-                    EC.element_to_be_clickable((By.XPATH, "//*[contains(text(), 'ダウンロード')]"))
-                )
-                print(f"ハイエースページのダウンロードボタン検出: タグ={download_button_hiace.tag_name}")
-            except Exception:
-                all_links = driver.find_elements(By.TAG_NAME, "a")
-                all_buttons = driver.find_elements(By.TAG_NAME, "button")
-                print(f"(ハイエース) リンク数: {len(all_links)}, ボタン数: {len(all_buttons)}")
-                raise RuntimeError("ハイエースページでダウンロードボタンが見つかりませんでした。")
-
-            before_hiace = snapshot_files(DOWNLOAD_DIR)
+    # このジョブ専用の一時フォルダに保存させる（クリック前スナップショットは空のフォルダ）
+    with download_events.staging(driver, download_dir) as (folder, armed):
+        before = snapshot_files(folder)
 
+        with tracing.span("export.trigger", driver=driver, label=label):
             # ★「直アクセス or クリック」どちらか1回だけ
             did_action = False
-            if download_button_hiace.tag_name.lower() == "a":
-                href = (download_button_hiace.get_attribute("href") or "").strip()
+            if download_button.tag_name.lower() == "a":
+                href = (download_button.get_attribute("href") or "").strip()
                 if href and not href.lower().startswith("javascript"):
-                    print(f"(ハイエース) href 直アクセスのみ実行: {href}")
+                    print(f"({label}) href 直アクセスのみ実行: {href}")
                     driver.get(href)
                     did_action = True
 
             if not did_action:
-                download_button_hiace.click()
-                print("(ハイエース) ダウンロードボタンをクリック（1回のみ）")
+                download_button.click()
+                print(f"({label}) ダウンロードボタンをクリック（1回のみ）")
 
+            # 可能なアラート処理
             time.sleep(1)
-            try:
-                alert = driver.switch_to.alert
-                print(f"(ハイエース) アラート検出: {alert.text}")
-                alert.accept()
-                print("(ハイエース) アラート OK")
-            except Exception:
-                pass
-
-            # ダウンロード完了待ち（★最新の1ファイルだけ採用）
-            new_hiace_files = wait_for_new_downloads(before_hiace, DOWNLOAD_DIR, timeout=180)
-            if new_hiace_files:
-                new_hiace_files = sorted(new_hiace_files, key=lambda p: p.stat().st_mtime, reverse=True)[:1]
-                print("ダウンロード完了（ハイエース）:")
-                for p in new_hiace_files:
-                    print(f"- {p}")
-                    # ★コピーではなくリネーム（*_hiace へ）
-                    name, ext = p.stem, p.suffix
-                    hiace_renamed = p.with_name(f"{name}_hiace{ext}")
-                    try:
-                        if hiace_renamed.exists():
-                            hiace_renamed.unlink()  # 同名があれば削除して置き換え
-                        p.rename(hiace_renamed)
-                        print(f"ハイエース用にリネーム: {hiace_renamed}")
-                    except Exception as e:
-                        print(f"リネームに失敗: {e}")
-            else:
-                print("ダウンロードされたファイルが見つかりませんでした（ハイエース）。")
+            accept_alert_if_present(driver, f"({label}) ")
+
+        # ダウンロード完了待ち（★最新の1ファイルだけ採用）
+        if armed:
+            new_files = [d["path"] for d in download_events.wait_for_downloads(
+                driver, folder, timeout=timeouts.timeout("download.wait", 180, "carsensor"), portal="carsensor")]
+        else:
+            new_files = wait_for_new_downloads(before, folder, timeout=timeouts.timeout("download.wait", 180, "carsensor"))
+        if not new_files:
+            print(f"ダウンロードされたファイルが見つかりませんでした（{label}）。")
+            return []
+        new_files = sorted(new_files, key=lambda p: p.stat().st_mtime, reverse=True)[:1]
+        new_files = download_events.publish(new_files, download_dir, job)
+    print(f"ダウンロード完了（{label}）:")
+    for p in new_files:
+        print(f"- {p}")
+    return new_files
+
+@tracing.traced("switch_store", driver_arg=0, portal="carsensor")
+def switch_store(driver, texts):
+    """「他店舗参照」→ texts（店舗名の候補）のいずれかを含む店舗へ切り替える（以降のページはその店舗のデータ）"""
+    from selenium.webdriver.support import expected_conditions as EC
+    tracing.annotate(store=texts[0])
+    # アラートが残っていれば処理
+    try:
+        alert = driver.switch_to.alert
+        print(f"アラート検出: {alert.text}")
+        alert.dismiss()
+        time.sleep(1)
+    except Exception:
+        pass
+
+    # 「他店舗参照」押下
+    tatenpo = timeouts.wait(driver, "carsensor.store.tatenpo", 15, "carsensor").until(
+        EC.element_to_be_clickable((By.ID, "tatenpoBtn")))
+    tatenpo.click()
+    print("「他店舗参照」をクリック")
+    time.sleep(2)
+
+    # 店舗名を探してクリック（候補をまとめて1回で探す。前回当たった候補を優先）
+    try:
+        store_element = locators.resolve(driver, "carsensor.store.select",
+                                         [(By.XPATH, f"//*[contains(text(), '{text}')]") for text in texts],
+                                         8, portal="carsensor")
+    except Exception:
+        store_element = None
+
+    if not store_element:
+        # ページ内テキスト確認
+        body_text = driver.find_element(By.TAG_NAME, "body").text
+        if any(text in body_text for text in texts):
+            print(f"ページ内に『{texts[0]}』テキストは存在しますが、クリック可能要素が見つかりません。")
+        else:
+            print(f"ページ内に『{texts[0]}』テキストが見つかりません。")
+        raise RuntimeError(f"店舗（{' / '.join(texts)}）の要素が見つかりませんでした。")
 
+    driver.execute_script("arguments[0].scrollIntoView({block:'center'});", store_element)
+    store_element.click()
+    print(f"『{texts[0]}』をクリック")
+    time.sleep(2)
+
+def rename_with_suffix(files, suffix: str):
+    """ダウンロードファイルを <name><suffix><ext> にリネーム（コピーではなくリネーム）"""
+    return _rename([(p, p.with_name(f"{p.stem}{suffix}{p.suffix}")) for p in files])
+
+
+def rename_for_shop(files, shop):
+    """ダウンロードファイルに店舗の suffix を付ける（shops.suffixed）"""
+    return _rename([(Path(p), shops.suffixed(p, shop)) for p in files])
+
+
+@tracing.traced("rename")
+def _rename(pairs):
+    renamed = []
+    for p, dst in pairs:
+        if dst == p:
+            renamed.append(p)
+            continue
+        try:
+            if dst.exists():
+                dst.unlink()  # 同名があれば削除して置き換え
+            p.rename(dst)
+            print(f"リネーム: {dst}")
+            renamed.append(dst)
         except Exception as e:
-            print(f"ハイエース専門店処理でエラー: {e}")
-            print(traceback.format_exc())
+            print(f"リネームに失敗: {e}")
+    return renamed
+
+
+# ---- メイン処理 -------------------------------------------------------------
+
+def main():
+    settings = load_settings()
+    DOWNLOAD_DIR = Path(settings["DOWNLOAD_DIR"])
+    HEADLESS = settings["HEADLESS"]
+    username = settings["CARSENSOR_USERNAME"]
+    password = settings["CARSENSOR_PASSWORD"]
+
+    driver = None
+    try:
+        print(f"ダウンロード先: {DOWNLOAD_DIR}")
+        driver = build_driver(DOWNLOAD_DIR, HEADLESS)
+
+        login_carsensor(driver, username, password)
+
+        # shops.json の店舗を順に（既定の店舗 → 他店舗参照で切り替える店舗）
+        for shop in shops.shops("carsensor"):
+            print(f"\n=== {shop['name']} ===")
+            try:
+                if not shop.get("default"):
+                    switch_store(driver, shop["switch"])
+                files = download_access_counts(driver, DOWNLOAD_DIR, shop["name"],
+                                               shops.step_name("carsensor", "access", shop))
+                # ★コピーではなくリネーム（*_<店舗id> へ）
+                rename_for_shop(files, shop)
+            except Exception as e:
+                print(f"{shop['name']} の処理でエラー: {e}")
+                print(traceback.format_exc())
 
     except Exception as e:
         print(f"エラーが発生しました: {e}")
@@ -336,6 +361,7 @@ def main():
 
     finally:
         if driver:
+            driver_factory.report_lean(driver)
             driver.quit()
         print("処理を完了しました。")
 
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+カーセンサー（c-match.carsensor.net）ブラウザ無し版
+- requests.Session（コネクションプール）で loginId / passwordCd のログインフォームを送信
+- counter/byVehicle・vehicles/registrationList の「ダウンロード」を HTML から解析して直接取得
+- 「他店舗参照」からの店舗切替（shops.json の switch）も同じセッションで実行
+- 画面が JavaScript 依存で辿れない場合は HttpFallbackRequired を送出（呼び出し側で Selenium に切替）
+"""
+
+import os
+import re
+import datetime
+from html.parser import HTMLParser
+from pathlib import Path
+from urllib.parse import urljoin
+
+import http_download
+import session_cache
+import shops
+import tracing
+
+# 接続先（ローカルの代替サーバー等で検証する場合は CARSENSOR_BASE_URL で変更）
+BASE_URL = os.getenv("CARSENSOR_BASE_URL", "https://c-match.carsensor.net/").rstrip("/") + "/"
+LOGIN_URL = urljoin(BASE_URL, "login/")
+ACCESS_URL = urljoin(BASE_URL, "counter/byVehicle/")
+REGISTRATION_URL = urljoin(BASE_URL, "vehicles/registrationList/")
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+
+class HttpFallbackRequired(RuntimeError):
+    """HTTP だけでは辿れない画面（Selenium での実行が必要）"""
+
+
+# ===== HTML 解析 =====
+
+class _PageParser(HTMLParser):
+    """フォーム（action / 入力値）とクリック可能な要素（リンク・ボタン・onclick・id）を集める"""
+
+    CLICKABLE = {"a", "button", "input", "li", "div", "span", "h1", "h2", "td", "p"}
+    VOID = {"input", "br", "img", "meta", "link", "hr", "option"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.forms = []
+        self.elements = []
+        self._form = None
+        self._stack = []          # 開いている要素（テキストを積む対象）
+        self._select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: (v or "") for k, v in attrs}
+        if tag == "form":
+            self._form = {"action": attrs.get("action", ""), "method": attrs.get("method", "get").lower(),
+                          "id": attrs.get("id", ""), "name": attrs.get("name", ""), "fields": {}}
+            self.forms.append(self._form)
+            return
+        form_index = len(self.forms) - 1 if self._form is not None else None
+
+        if self._form is not None:
+            name = attrs.get("name")
+            if tag == "input" and name:
+                kind = attrs.get("type", "text").lower()
+                if kind in ("checkbox", "radio"):
+                    if "checked" in attrs:
+                        self._form["fields"][name] = attrs.get("value", "on")
+                elif kind not in ("submit", "button", "image", "reset"):
+                    self._form["fields"][name] = attrs.get("value", "")
+            elif tag == "select" and name:
+                self._select = name
+                self._form["fields"].setdefault(name, "")
+            elif tag == "option" and self._select:
+                if "selected" in attrs or not self._form["fields"].get(self._select):
+                    self._form["fields"][self._select] = attrs.get("value", "")
+            elif tag == "textarea" and name:
+                self._form["fields"][name] = ""
+
+        interesting = (tag in ("a", "button") or attrs.get("onclick") or attrs.get("id")
+                       or (tag == "input" and attrs.get("type", "").lower() in ("submit", "button", "image")))
+        if tag in self.CLICKABLE and interesting:
+            element = {"tag": tag, "attrs": attrs, "text": attrs.get("value", "") if tag == "input" else "",
+                       "form": form_index}
+            self.elements.append(element)
+            if tag not in self.VOID:
+                self._stack.append((tag, element))
+        elif tag not in self.VOID:
+            self._stack.append((tag, None))
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._form = None
+            return
+        if tag == "select":
+            self._select = None
+        # 対応する開始タグまで閉じる（閉じ忘れの多い HTML にも耐える）
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i][0] == tag:
+                del self._stack[i:]
+                break
+
+    def handle_data(self, data):
+        text = data.strip()
+        if not text:
+            return
+        for _, element in self._stack:
+            if element is not None:
+                element["text"] += text
+
+
+def parse_page(html: str):
+    parser = _PageParser()
+    parser.feed(html)
+    parser.close()
+    return parser
+
+
+def find_element(page, text=None, element_id=None):
+    """テキスト（部分一致）または id で要素を探す。内側の要素（テキストが短い方）を優先"""
+    if element_id:
+        for element in page.elements:
+            if element["attrs"].get("id") == element_id:
+                return element
+        return None
+    matches = [e for e in page.elements if text in e["text"]]
+    if not matches:
+        return None
+    # リンク/ボタンを優先し、その中で最も内側（テキストが短い）要素
+    matches.sort(key=lambda e: (e["tag"] not in ("a", "button", "input"), len(e["text"])))
+    return matches[0]
+
+
+_LOCATION_RE = re.compile(r"""location(?:\.href)?\s*=\s*['"]([^'"]+)['"]""")
+
+
+def resolve_action(page, element, page_url: str):
+    """要素のクリックに相当するリクエスト (method, url, data) を返す。辿れなければ例外"""
+    attrs = element["attrs"]
+    href = attrs.get("href", "").strip()
+    if element["tag"] == "a" and href and not href.lower().startswith("javascript") and href != "#":
+        return "get", urljoin(page_url, href), None
+
+    onclick = attrs.get("onclick", "") + " " + (href if href.lower().startswith("javascript") else "")
+    m = _LOCATION_RE.search(onclick)
+    if m:
+        return "get", urljoin(page_url, m.group(1)), None
+
+    is_submit = (element["tag"] in ("button", "input")
+                 and attrs.get("type", "submit" if element["tag"] == "button" else "").lower() in ("submit", "image"))
+    if element["form"] is not None and (is_submit or "submit" in onclick):
+        form = page.forms[element["form"]]
+        data = dict(form["fields"])
+        if attrs.get("name"):
+            data[attrs["name"]] = attrs.get("value", "")
+        url = urljoin(page_url, form["action"] or page_url)
+        return form["method"], url, data
+
+    raise HttpFallbackRequired(f"要素の遷移先を HTTP で解決できません: <{element['tag']}> {element['text'][:30]}")
+
+
+# ===== セッション =====
+
+def new_session(pool_size: int = 4):
+    """リトライ付きコネクションプールを持つ Session を作る"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"User-Agent": USER_AGENT, "Accept-Language": "ja,en;q=0.8"})
+    return session
+
+
+def _request(session, method, url, data=None, referer=None, **kwargs):
+    headers = {"Referer": referer} if referer else {}
+    if method == "post":
+        response = session.post(url, data=data, headers=headers, timeout=60, **kwargs)
+    else:
+        response = session.get(url, params=data, headers=headers, timeout=60, **kwargs)
+    # urllib3 が自動で再試行した回数を計測に加える
+    retries = getattr(getattr(response.raw, "retries", None), "history", None)
+    if retries:
+        tracing.add(retries=len(retries))
+    response.raise_for_status()
+    return response
+
+
+def is_login_page(response) -> bool:
+    return "/login" in response.url or 'name="loginId"' in response.text
+
+
+@tracing.traced("login", portal="carsensor", mode="http")
+def login(session, username: str, password: str, cached: bool = True):
+    """ログインフォームを送信する（キャッシュ済みセッションが有効なら省略）。失敗時は RuntimeError。
+    cached=False ならキャッシュの Cookie を使わず新しいセッションでログインし、保存もしない"""
+    if cached and session_cache.restore_requests_session(session, "carsensor"):
+        response = _request(session, "get", ACCESS_URL)
+        if not is_login_page(response):
+            print("[session] carsensor: キャッシュのセッションでログイン済み（ログインフォームを省略）")
+            return response
+        print("[session] carsensor: キャッシュのセッションは無効です。ログインし直します")
+        session_cache.clear("carsensor")
+        session.cookies.clear()
+
+    response = _request(session, "get", LOGIN_URL)
+    page = parse_page(response.text)
+    form = next((f for f in page.forms if "loginId" in f["fields"] or "passwordCd" in f["fields"]), None)
+    data = dict(form["fields"]) if form else {}
+    data["loginId"] = username
+    data["passwordCd"] = password
+    submit = find_element(page, element_id="sbtLogin")
+    if submit and submit["attrs"].get("name"):
+        data[submit["attrs"]["name"]] = submit["attrs"].get("value", "")
+    action = urljoin(response.url, form["action"]) if form and form["action"] else response.url
+
+    response = _request(session, "post", action, data=data, referer=LOGIN_URL)
+    if is_login_page(response):
+        raise RuntimeError("ログインに失敗しました（ログインページに戻されました）")
+    print(f"ログイン成功（HTTP）: {response.url}")
+    if cached:
+        session_cache.save_requests_session(session, "carsensor")
+    return response
+
+
+# ===== ダウンロード =====
+
+def save_response(response, download_dir: Path, default_name: str) -> Path:
+    """レスポンス本文をチャンク単位で一時ファイルに書き、完了後にリネームで確定する"""
+    name = os.path.basename(http_download.filename_from_headers(response) or default_name)
+    try:
+        # 店舗切替後も同じファイル名で返されるため、上書きせず 'name (1).ext' にする（ブラウザと同じ）
+        dst, size, digest = http_download.save_stream(response, Path(download_dir) / name)
+    except http_download.UnexpectedContent as e:
+        raise HttpFallbackRequired(str(e))
+    print(f"保存しました: {dst} ({size} bytes, sha256 {digest[:12]})")
+    return dst
+
+
+@tracing.traced("export", portal="carsensor", mode="http")
+def download_page_export(session, page_url: str, download_dir: Path, default_prefix: str):
+    """ページ内の「ダウンロード」を HTTP で実行し、保存したパスを返す"""
+    tracing.annotate(url=page_url)
+    with tracing.span("navigate", url=page_url):
+        response = _request(session, "get", page_url)
+    if is_login_page(response):
+        raise RuntimeError("セッションが切れています（ログインページが表示されました）")
+    page = parse_page(response.text)
+    button = find_element(page, text="ダウンロード")
+    if button is None:
+        raise HttpFallbackRequired(f"ダウンロードボタンが見つかりません: {page_url}")
+    method, url, data = resolve_action(page, button, response.url)
+    print(f"ダウンロード要求: {method.upper()} {url}")
+
+    # ブラウザのダウンロード待ち（download.wait）とは別の名前で記録する（速い HTTP 取得で学習値を縮めない）
+    with tracing.span("download.fetch", portal="carsensor", mode="http", url=url), \
+            _request(session, method, url, data=data, referer=response.url, stream=True) as dl:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        return save_response(dl, download_dir, f"{default_prefix}_{timestamp}.csv")
+
+
+@tracing.traced("switch_store", portal="carsensor", mode="http")
+def switch_store(session, page_url: str, texts):
+    """「他店舗参照」から texts のいずれかを含む店舗に切り替える"""
+    response = _request(session, "get", page_url)
+    page = parse_page(response.text)
+    page_url = response.url
+
+    def find_store(p):
+        for text in texts:
+            element = find_element(p, text=text)
+            if element is not None:
+                return element
+        return None
+
+    store = find_store(page)
+    if store is None:
+        tatenpo = find_element(page, element_id="tatenpoBtn")
+        if tatenpo is None:
+            raise HttpFallbackRequired("「他店舗参照」ボタンが見つかりません")
+        method, url, data = resolve_action(page, tatenpo, page_url)
+        response = _request(session, method, url, data=data, referer=page_url)
+        page, page_url = parse_page(response.text), response.url
+        store = find_store(page)
+    if store is None:
+        raise HttpFallbackRequired(f"店舗（{' / '.join(texts)}）が見つかりません")
+
+    method, url, data = resolve_action(page, store, page_url)
+    response = _request(session, method, url, data=data, referer=page_url)
+    print(f"店舗を切り替えました（HTTP）: {store['text'][:40]}")
+    return response
+
+
+# ===== エクスポート =====
+
+# エクスポート → (ページ, ファイル名が取れない場合の接頭辞)
+EXPORTS = {
+    "access": (ACCESS_URL, "hankyobukken"),
+    "registration": (REGISTRATION_URL, "torokubukken"),
+}
+
+
+def export(session, name: str, shop, download_dir: Path) -> Path:
+    """表示中の店舗の name（access / registration）を取得し、店舗の suffix を付けたファイルを返す"""
+    url, prefix = EXPORTS[name]
+    path = download_page_export(session, url, download_dir, prefix)
+    dst = shops.suffixed(path, shop)
+    if dst != path:
+        os.replace(path, dst)
+    return dst
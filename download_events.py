@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Chrome DevTools のダウンロードイベントで完了を検知する
+- Browser.setDownloadBehavior(allowAndName, eventsEnabled) で GUID 名のまま保存させる
+- downloadWillBegin / downloadProgress イベントをパフォーマンスログから受け取る
+- 完了した GUID ファイルを suggestedFilename にリネームし、正確なパスと GUID を返す
+- 一定時間内にダウンロードが始まらなければ即エラー（固定 sleep は使わない）
+- ジョブ（エクスポート1回）ごとに専用の一時フォルダ（download_dir/.job_*）へ保存させ、完了したファイルを
+  download_dir/<ジョブ名>/ へ os.replace で移す（staging / publish）
+  → どのジョブのファイルかは一時フォルダだけを見れば分かる（download_dir に溜まったファイル数に依存しない）
+
+使い方:
+    armed = arm_download_events(driver, download_dir)   # トリガー直前
+    ...ボタンをクリック...
+    if armed:
+        done = wait_for_downloads(driver, download_dir)  # [{"guid", "path", ...}]
+
+    with staging(driver, download_dir) as (folder, armed):   # ジョブ単位
+        ...ボタンをクリック...
+        done = wait_for_downloads(driver, folder)
+        files = publish([d["path"] for d in done], download_dir, "carsensor.access")
+"""
+
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import weakref
+from pathlib import Path
+
+import tracing
+
+# ドライバごとの未処理イベント（パフォーマンスログは読むと消えるため保持しておく）
+_pending = weakref.WeakKeyDictionary()
+
+DOWNLOAD_EVENTS = ("Page.download", "Browser.download")
+# 保持するイベントの上限（超えたら古いものから捨てる）
+MAX_PENDING = 5000
+
+POLL_INTERVAL = 0.2
+
+
+def enable_performance_log(options):
+    """ChromeOptions にパフォーマンスログ（Page ドメインのイベント）を有効化する。
+    計測（tracing）が有効なら Network ドメインも記録する"""
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": tracing.enabled(), "enablePage": True})
+    return options
+
+
+def _pull_events(driver):
+    """パフォーマンスログを読み出して未処理イベントに追加する。
+    取り出す側があるイベント（ダウンロード、計測が有効なら Network）だけを残し、上限を超えたら古いものから捨てる"""
+    buf = _pending.setdefault(driver, [])
+    try:
+        entries = driver.get_log("performance")
+    except Exception:
+        return buf
+    keep = DOWNLOAD_EVENTS + ("Network.",) if tracing.enabled() else DOWNLOAD_EVENTS
+    for entry in entries:
+        try:
+            msg = json.loads(entry["message"])["message"]
+        except Exception:
+            continue
+        if msg.get("method", "").startswith(keep):
+            buf.append(msg)
+    if len(buf) > MAX_PENDING:
+        del buf[:len(buf) - MAX_PENDING]
+    return buf
+
+
+def take_events(driver, prefixes):
+    """指定プレフィックス（例: "Page.download"）に一致するイベントを取り出す。他は残す"""
+    buf = _pull_events(driver)
+    taken = [m for m in buf if m.get("method", "").startswith(prefixes)]
+    if taken:
+        buf[:] = [m for m in buf if not m.get("method", "").startswith(prefixes)]
+    return taken
+
+
+def _download_method(msg):
+    """Page.downloadWillBegin / Browser.downloadWillBegin → downloadWillBegin"""
+    return msg.get("method", "").split(".", 1)[-1]
+
+
+def arm_download_events(driver, download_dir: Path) -> bool:
+    """ダウンロードを GUID 名で保存＋イベント通知に切り替える。未対応なら False"""
+    try:
+        driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+            "behavior": "allowAndName",
+            "downloadPath": str(Path(download_dir).resolve()),
+            "eventsEnabled": True,
+        })
+    except Exception as e:
+        print(f"ダウンロードイベントを有効化できませんでした（従来方式で待機）: {e}")
+        return False
+    # 以前のイベントを捨てて、これからのトリガー分だけを対象にする
+    take_events(driver, DOWNLOAD_EVENTS)
+    return True
+
+
+@contextlib.contextmanager
+def staging(driver, download_dir: Path):
+    """ジョブ専用の一時フォルダ（download_dir/.job_*。同じドライブなので移動は os.replace）に保存させる。
+    (保存先フォルダ, armed) を返す。イベント非対応なら Page.setDownloadBehavior で保存先だけ切り替え、
+    それも使えなければ download_dir のまま（従来どおり）。終了時に一時フォルダを消し、保存先を download_dir に戻す"""
+    download_dir = Path(download_dir)
+    folder = Path(tempfile.mkdtemp(prefix=".job_", dir=download_dir))
+    armed = arm_download_events(driver, folder)
+    if not armed:
+        try:
+            driver.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": str(folder.resolve())})
+        except Exception:
+            shutil.rmtree(folder, ignore_errors=True)
+            folder = download_dir
+    try:
+        yield folder, armed
+    finally:
+        if folder != download_dir:
+            # 消した一時フォルダに後から保存されないよう、保存先を戻す
+            try:
+                driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+                    "behavior": "allow", "downloadPath": str(download_dir.resolve())})
+            except Exception:
+                pass
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def job_dir(download_dir: Path, job: str) -> Path:
+    """ジョブの保存先（download_dir/<ジョブ名>）"""
+    return Path(download_dir) / job
+
+
+@tracing.traced("download.publish")
+def publish(files, download_dir: Path, job: str):
+    """一時フォルダのファイルを download_dir/<ジョブ名>/ へ移し、移した後のパスを返す。
+    同じドライブ内の os.replace なので、移した先に書きかけのファイルが見えることはない"""
+    folder = job_dir(download_dir, job)
+    folder.mkdir(parents=True, exist_ok=True)
+    moved = []
+    for path in files:
+        path = Path(path)
+        if path.parent == folder:
+            moved.append(path)
+            continue
+        dst = unique_path(folder / path.name)
+        os.replace(str(path), str(dst))
+        moved.append(dst)
+    return moved
+
+
+def published_files(download_dir: Path, exts=(".csv",)):
+    """download_dir 直下とジョブのフォルダのファイル（一時フォルダ・隠しファイルは除く）"""
+    found = []
+    for root, dirs, names in os.walk(str(download_dir)):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        found.extend(Path(root) / n for n in names
+                     if not n.startswith(".") and (exts is None or Path(n).suffix.lower() in exts))
+    return sorted(found)
+
+
+def unique_path(path: Path) -> Path:
+    """同名があれば 'name (1).ext' 形式で空きを探す（Chrome と同じ命名）"""
+    if not path.exists():
+        return path
+    for i in range(1, 1000):
+        candidate = path.with_name(f"{path.stem} ({i}){path.suffix}")
+        if not candidate.exists():
+            return candidate
+    raise RuntimeError(f"保存先のファイル名を決められませんでした: {path}")
+
+
+@tracing.traced("download.rename")
+def _finalize(download_dir: Path, info: dict) -> Path:
+    """GUID ファイルを本来のファイル名にリネームする"""
+    src = Path(download_dir) / info["guid"]
+    name = info.get("suggestedFilename") or info["guid"]
+    dst = unique_path(Path(download_dir) / name)
+    os.replace(str(src), str(dst))
+    return dst
+
+
+@tracing.traced("download.wait", driver_arg=0)
+def wait_for_downloads(driver, download_dir: Path, expected: int = 1,
+                       start_timeout: float = 20, timeout: float = 180, portal: str = None):
+    """arm_download_events 後にトリガーしたダウンロードの完了を待つ。
+
+    expected 件が完了した時点で即座に返す。戻り値は
+    [{"guid", "path", "url", "filename", "bytes"}]（開始順）。
+    start_timeout 秒以内に開始イベントが無い、キャンセルされた、
+    timeout 秒以内に完了しない場合は RuntimeError。
+    """
+    # ポータルごとに待ち時間を学習するため、スパンにポータルを記録する（timeouts.timeout("download.wait", ..., portal)）
+    tracing.annotate(portal=portal)
+    started_at = time.time()
+    begun = {}        # guid -> downloadWillBegin params
+    order = []
+    completed = {}
+
+    while True:
+        for msg in take_events(driver, DOWNLOAD_EVENTS):
+            method = _download_method(msg)
+            params = msg.get("params", {})
+            guid = params.get("guid")
+            if not guid:
+                continue
+            if method == "downloadWillBegin":
+                if guid not in begun:
+                    begun[guid] = params
+                    order.append(guid)
+                    print(f"ダウンロード開始: {params.get('suggestedFilename')} (GUID: {guid})")
+            elif method == "downloadProgress" and guid in begun and guid not in completed:
+                state = params.get("state")
+                if state == "completed":
+                    path = _finalize(download_dir, begun[guid])
+                    completed[guid] = {
+                        "guid": guid,
+                        "path": path,
+                        "url": begun[guid].get("url"),
+                        "filename": path.name,
+                        "bytes": int(params.get("receivedBytes") or params.get("totalBytes") or 0),
+                    }
+                    tracing.add(bytes=completed[guid]["bytes"])
+                    print(f"ダウンロード完了: {path} ({completed[guid]['bytes']} bytes)")
+                elif state == "canceled":
+                    raise RuntimeError(f"ダウンロードがキャンセルされました: {begun[guid].get('suggestedFilename')}")
+
+        if len(completed) >= expected:
+            # 完了した GUID の後続イベント（downloadProgress の残り）は待つ側がいないため捨てる
+            buf = _pending.get(driver)
+            if buf:
+                buf[:] = [m for m in buf if m.get("params", {}).get("guid") not in begun]
+            return [completed[g] for g in order if g in completed]
+
+        elapsed = time.time() - started_at
+        if not begun and elapsed > start_timeout:
+            raise RuntimeError(f"{start_timeout}秒以内にダウンロードが開始されませんでした")
+        if elapsed > timeout:
+            raise RuntimeError(f"タイムアウト: {timeout}秒以内にダウンロードが完了しませんでした "
+                               f"（開始 {len(begun)}件 / 完了 {len(completed)}件）")
+        time.sleep(POLL_INTERVAL)
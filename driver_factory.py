@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+ChromeDriver の解決と Chrome の起動（各スクリプト共通）
+- インストール済み Chrome のバージョンをローカルで調べ（ネットワーク無し）、
+  メジャーバージョンごとに chromedriver のパスを .cache/chromedriver.json に保存
+- 次回以降はキャッシュのパスを Service に直接渡すため、Selenium Manager / webdriver-manager の
+  バージョン問い合わせ（ネットワーク）を行わずに起動する
+- キャッシュが無い・ファイルが消えた・Chrome が更新された場合だけ解決し直す
+  （Selenium Manager → webdriver-manager の順）
+- CHROMEDRIVER_PATH / CHROME_BINARY を指定した場合はそれを常に使う
+- 起動に掛かった時間（ドライバ解決 / Chrome 起動）を表示し、計測（tracing）にも記録する
+- LEAN_MODE=true で軽量モード: ページ読込は eager、画像・動画・フォント・広告/解析タグを
+  CDP の Network.setBlockedURLs で読み込まない（ポータル別の許可リストに一致する URL は除く）
+
+使い方:
+    options = webdriver.ChromeOptions()
+    ...
+    driver = driver_factory.create_chrome(options, portal="carsensor")
+    ...
+    driver_factory.report_lean(driver)   # 軽量モード時、ブロック件数・転送量を表示
+"""
+
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from selenium import webdriver
+
+import session_cache
+import tracing
+
+_lock = threading.Lock()
+
+CHROME_CANDIDATES = {
+    "Linux": ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser"),
+    "Darwin": ("/Applications/Google Chrome.app/Contents/MacOS/Google Chrome",),
+}
+
+
+def _cache_file() -> Path:
+    return session_cache.cache_dir() / "chromedriver.json"
+
+
+def _load_cache():
+    try:
+        return json.loads(_cache_file().read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def _save_cache(cache):
+    path = _cache_file()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[driver] キャッシュを保存できませんでした: {e}")
+
+
+def chrome_version():
+    """インストール済み Chrome のバージョン文字列（例: '120.0.6099.109'）。分からなければ None"""
+    if platform.system() == "Windows":
+        try:
+            import winreg
+            for root in (winreg.HKEY_CURRENT_USER, winreg.HKEY_LOCAL_MACHINE):
+                try:
+                    with winreg.OpenKey(root, r"Software\Google\Chrome\BLBeacon") as key:
+                        return winreg.QueryValueEx(key, "version")[0]
+                except OSError:
+                    continue
+        except ImportError:
+            pass
+        return None
+
+    binary = os.getenv("CHROME_BINARY")
+    candidates = [binary] if binary else CHROME_CANDIDATES.get(platform.system(), ())
+    for name in candidates:
+        path = name if os.path.isabs(name) else shutil.which(name)
+        if not path or not os.path.exists(path):
+            continue
+        try:
+            out = subprocess.run([path, "--version"], capture_output=True, text=True, timeout=10).stdout
+        except (OSError, subprocess.SubprocessError):
+            continue
+        m = re.search(r"(\d+\.\d+\.\d+\.\d+)", out)
+        if m:
+            return m.group(1)
+    return None
+
+
+def _resolve(version):
+    """chromedriver（と必要ならブラウザ）のパスを解決する。{"driver_path", "browser_path", "source"} を返す"""
+    errors = []
+    try:
+        from selenium.webdriver.common.selenium_manager import SeleniumManager
+        args = ["--browser", "chrome"] + (["--browser-version", version.split(".")[0]] if version else [])
+        paths = SeleniumManager().binary_paths(args)
+        if Path(paths.get("driver_path") or "").is_file():
+            browser = paths.get("browser_path")
+            return {"driver_path": paths["driver_path"],
+                    "browser_path": browser if browser and Path(browser).is_file() else None,
+                    "source": "selenium-manager"}
+    except Exception as e:
+        errors.append(f"Selenium Manager: {e}")
+
+    try:
+        from webdriver_manager.chrome import ChromeDriverManager
+        return {"driver_path": ChromeDriverManager().install(), "browser_path": None, "source": "webdriver-manager"}
+    except Exception as e:
+        errors.append(f"webdriver-manager: {e}")
+    raise RuntimeError("ChromeDriver を解決できませんでした: " + " / ".join(errors))
+
+
+def driver_paths(refresh: bool = False):
+    """Chrome のバージョンに合う chromedriver の情報を返す（キャッシュがあればネットワーク無し）。
+    戻り値: ({"driver_path", "browser_path", "source", ...}, キャッシュを使ったか)"""
+    explicit = os.getenv("CHROMEDRIVER_PATH")
+    if explicit and Path(explicit).is_file():
+        # 明示指定（CI でインストールしたドライバ等）は常に優先し、バージョン確認もしない
+        return {"driver_path": explicit, "browser_path": None, "source": "CHROMEDRIVER_PATH"}, True
+    version = chrome_version()
+    key = version.split(".")[0] if version else "unknown"
+    with _lock:
+        cache = _load_cache()
+        entry = cache.get(key)
+        if entry and not refresh and Path(entry["driver_path"]).is_file():
+            return entry, True
+        print(f"[driver] ChromeDriver を解決します（Chrome {version or '不明'}）")
+        entry = _resolve(version)
+        entry.update({"chrome_version": version, "resolved_at": time.time()})
+        cache[key] = entry
+        _save_cache(cache)
+        print(f"[driver] ChromeDriver: {entry['driver_path']}（{entry['source']}）")
+        return entry, False
+
+
+# ===== 軽量モード =====
+
+# 読み込まない資源（拡張子）
+BLOCKED_RESOURCES = (
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico", "*.bmp",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*.mp4", "*.webm", "*.mp3", "*.m4a", "*.ogg",
+)
+
+# 読み込まない第三者（広告・アクセス解析）
+BLOCKED_THIRD_PARTY = (
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*googlesyndication.com*",
+    "*googleadservices.com*", "*adservice.google.*", "*connect.facebook.net*", "*clarity.ms*",
+    "*hotjar.com*", "*criteo.*", "*adsrvr.org*", "*yjtag.jp*", "*ads.yahoo.co.jp*", "*b92.yahoo.co.jp*",
+    "*/gtag/js*", "*/analytics.js*",
+)
+
+# ポータル別の許可リスト（ログイン・エクスポートに必要なものは常に読み込む）
+LEAN_ALLOW = {
+    "carsensor": ("*/login*", "*download*"),
+    "goonet": ("*/login*", "*/csv*", "*export*"),
+}
+
+
+def lean_enabled() -> bool:
+    return os.getenv("LEAN_MODE", "false").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_patterns(name):
+    return tuple(p.strip() for p in os.getenv(name, "").split(",") if p.strip())
+
+
+def apply_lean(driver, portal=None):
+    """Network.setBlockedURLs で不要な資源を止める。許可リストは先に評価される（対応していない Chrome では
+    ブロック対象から許可リストと同じパターンを除くだけ）"""
+    allow = LEAN_ALLOW.get(portal, ()) + _env_patterns("LEAN_ALLOW")
+    block = [p for p in BLOCKED_RESOURCES + BLOCKED_THIRD_PARTY + _env_patterns("LEAN_BLOCK") if p not in allow]
+    driver.execute_cdp_cmd("Network.enable", {})
+    try:
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {
+            "urlPatterns": [{"urlPattern": p, "block": False} for p in allow]
+                           + [{"urlPattern": p, "block": True} for p in block],
+        })
+    except Exception:
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": block})
+    print(f"[lean] 軽量モード: ブロック {len(block)} パターン / 許可 {len(allow)} パターン（{portal or '共通'}）")
+
+
+def report_lean(driver, label: str = ""):
+    """軽量モード時、起動からの通信件数・転送量・ブロック件数を表示して返す"""
+    if not lean_enabled() or driver is None:
+        return None
+    try:
+        totals = tracing.network_totals(driver)
+    except Exception as e:
+        print(f"[lean] 集計できませんでした: {e}")
+        return None
+    print(f"[lean] {label}通信 {totals['requests']} 件 / 転送 {totals['bytes']:,} バイト / "
+          f"ブロック {totals['blocked']} 件")
+    return totals
+
+
+def create_chrome(options, portal=None):
+    """options で Chrome を起動する。キャッシュのドライバで起動できなければ1回だけ解決し直す"""
+    started = time.perf_counter()
+    if os.getenv("CHROME_BINARY") and not options.binary_location:
+        options.binary_location = os.getenv("CHROME_BINARY")
+    lean = lean_enabled()
+    if lean:
+        # DOMContentLoaded で操作を始める（画像等の読込完了を待たない）
+        options.page_load_strategy = "eager"
+        # ブロック件数・転送量を集計するため Network イベントもログに残す
+        perf = options.experimental_options.get("perfLoggingPrefs")
+        if perf is not None:
+            perf["enableNetwork"] = True
+    from selenium.webdriver.chrome.service import Service
+    entry, cached = driver_paths()
+    resolved = time.perf_counter()
+    for attempt in (1, 2):
+        if entry.get("browser_path") and not options.binary_location:
+            options.binary_location = entry["browser_path"]
+        try:
+            driver = webdriver.Chrome(service=Service(entry["driver_path"]), options=options)
+            break
+        except Exception as e:
+            if attempt == 2 or not cached:
+                raise RuntimeError(f"ChromeDriver の起動に失敗しました: {e}")
+            # Chrome の更新直後などでキャッシュのドライバが合わない → 解決し直す
+            print(f"[driver] キャッシュの ChromeDriver で起動できません。解決し直します: {e}")
+            entry, cached = driver_paths(refresh=True)
+            resolved = time.perf_counter()
+    if lean:
+        try:
+            apply_lean(driver, portal)
+        except Exception as e:
+            print(f"[lean] 軽量モードを適用できませんでした（通常モードで続行）: {e}")
+    finished = time.perf_counter()
+    print(f"[driver] Chrome 起動 {finished - started:.2f}秒（ドライバ解決 {resolved - started:.2f}秒"
+          f"{'・キャッシュ' if cached else ''} / ブラウザ起動 {finished - resolved:.2f}秒）")
+    tracing.annotate(resolve_ms=round((resolved - started) * 1000, 1),
+                     launch_ms=round((finished - resolved) * 1000, 1),
+                     driver_cache=cached, driver_source=entry.get("source"), lean=lean)
+    return driver
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+エクスポート CSV（4種類）の読み込み
+- carsensor_access（hankyobukken）/ goonet_access（効果分析（在庫））/
+  carsensor_registration（torokubukken）/ goonet_registration（在庫検索一覧・goonet_bukken）
+- 文字コードは先頭を見て判定（BOM 付き UTF-8 / UTF-8 / cp932）
+- ヘッダー行を SCHEMAS の列（別名を含む）に対応付け、型変換した値を列ごとに array に格納する
+  （1行 = 1 dict にしないため、行数が多くてもメモリが小さい）
+- ファイル全体を読み込まず、batch_size 行ごとに Table を返しながら読み進める（iter_batches）
+
+列の型と欠損値:
+    int   → array('q')、欠損は MISSING_INT
+    float → array('d')、欠損は NaN
+    date  → array('l')（date.toordinal()）、欠損は 0
+    str   → list（同じ文字列は sys.intern で共有）
+
+使い方:
+    table = export_parser.read("downloads/torokubukken_main_20240101.csv")
+    table.dataset, len(table), table["price"][:10]
+    for batch in export_parser.iter_batches(path, batch_size=10000):
+        ...
+"""
+
+import codecs
+import csv
+import datetime
+import functools
+import math
+import re
+import sys
+import unicodedata
+from array import array
+from pathlib import Path
+
+MISSING_INT = -(2 ** 63)
+MISSING_DATE = 0
+DETECT_BYTES = 64 * 1024
+BATCH_SIZE = 10000
+
+# データセット → [(列名, 型, ヘッダーの候補)]（候補は正規化後の文字列で比較する）
+SCHEMAS = {
+    "carsensor_access": [
+        ("vehicle_id", "str", ("物件管理番号", "物件番号", "管理番号")),
+        ("name", "str", ("車名", "車種名")),
+        ("grade", "str", ("グレード",)),
+        ("price", "int", ("本体価格", "車両本体価格", "価格")),
+        ("detail_views", "int", ("詳細閲覧数", "詳細PV", "詳細ページ閲覧数")),
+        ("favorites", "int", ("お気に入り数", "お気に入り登録数")),
+        ("inquiries", "int", ("問い合わせ数", "問合せ数", "お問い合わせ数")),
+    ],
+    "carsensor_registration": [
+        ("vehicle_id", "str", ("物件管理番号", "物件番号", "管理番号")),
+        ("name", "str", ("車名", "車種名")),
+        ("year", "int", ("年式", "初度登録年")),
+        ("mileage", "int", ("走行距離",)),
+        ("price", "int", ("本体価格", "車両本体価格", "価格")),
+        ("listed_on", "date", ("掲載開始日", "掲載日")),
+        ("status", "str", ("掲載状態", "ステータス")),
+    ],
+    "goonet_access": [
+        ("vehicle_id", "str", ("在庫ID", "在庫番号", "物件ID")),
+        ("name", "str", ("車名", "車種名")),
+        ("price", "int", ("本体価格", "車両本体価格", "価格")),
+        ("list_views", "int", ("一覧表示回数", "一覧表示数")),
+        ("detail_views", "int", ("詳細表示回数", "詳細表示数")),
+        ("favorites", "int", ("お気に入り登録数", "お気に入り数")),
+        ("inquiries", "int", ("問い合わせ数", "問合せ数", "お問い合わせ数")),
+    ],
+    "goonet_registration": [
+        ("vehicle_id", "str", ("在庫ID", "在庫番号", "物件ID")),
+        ("maker", "str", ("メーカー", "メーカー名")),
+        ("model", "str", ("車種", "車種名", "車名")),
+        ("year", "int", ("年式", "初度登録年")),
+        ("mileage", "int", ("走行距離",)),
+        ("price", "int", ("本体価格", "車両本体価格", "価格")),
+        ("registered_on", "date", ("登録日", "在庫登録日")),
+    ],
+}
+
+_TYPECODES = {"int": "q", "float": "d", "date": "l"}
+
+
+def _normalize(name: str) -> str:
+    """ヘッダーの比較用（全角英数・空白・括弧の違いを吸収）"""
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", name).strip().lstrip("\ufeff"))
+
+
+# ===== 文字コード =====
+
+def detect_encoding(head: bytes) -> str:
+    """先頭のバイト列から 'utf-8-sig' / 'utf-8' / 'cp932' を判定する"""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.isascii():
+        # 判定できない（ASCII のみ）場合はポータルの既定の cp932
+        return "cp932"
+    try:
+        # 途中で切れた多バイト文字はエラーにしない（final=False）
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp932"
+
+
+# ===== 値の変換 =====
+
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+_DATE = re.compile(r"(\d{4})\D{0,2}?(\d{1,2})\D{0,2}?(\d{1,2})")
+
+
+def to_int(text: str) -> int:
+    """'1,234,000円' / '12.3万km' / '2019年(H31)' → 整数。読めなければ MISSING_INT"""
+    try:
+        # ほとんどの値は数字だけ（正規化・正規表現を通さない）
+        return int(text)
+    except ValueError:
+        pass
+    text = unicodedata.normalize("NFKC", text).replace(",", "").strip()
+    m = _NUMBER.search(text)
+    if not m:
+        return MISSING_INT
+    value = float(m.group())
+    if "万" in text[m.end():m.end() + 2]:
+        value *= 10000
+    return int(round(value))
+
+
+def to_float(text: str) -> float:
+    text = unicodedata.normalize("NFKC", text).replace(",", "").strip()
+    m = _NUMBER.search(text)
+    return float(m.group()) if m else math.nan
+
+
+@functools.lru_cache(maxsize=4096)
+def to_date(text: str) -> int:
+    """'2024/01/05' / '2024-01-05' / '20240105' / '2024年1月5日' → date.toordinal()。読めなければ MISSING_DATE"""
+    m = _DATE.search(unicodedata.normalize("NFKC", text))
+    if not m:
+        return MISSING_DATE
+    try:
+        return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3))).toordinal()
+    except ValueError:
+        return MISSING_DATE
+
+
+_CONVERTERS = {"int": to_int, "float": to_float, "date": to_date, "str": lambda text: sys.intern(text.strip())}
+
+
+# ===== ヘッダー → スキーマ =====
+
+def match_schema(header, dataset=None):
+    """ヘッダー行を SCHEMAS に対応付け、(dataset, [(列名, 型, 列番号)]) を返す。
+    dataset 未指定なら最も多くの列が一致したデータセット（同数ならキー列が一致する方）"""
+    normalized = [_normalize(h) for h in header]
+    candidates = [dataset] if dataset else list(SCHEMAS)
+    best = None
+    for key in candidates:
+        if key not in SCHEMAS:
+            raise RuntimeError(f"未対応のデータセットです: {key}")
+        fields = []
+        for name, kind, aliases in SCHEMAS[key]:
+            index = next((normalized.index(_normalize(a)) for a in aliases if _normalize(a) in normalized), None)
+            if index is not None:
+                fields.append((name, kind, index))
+        score = (len(fields), any(f[0] == "vehicle_id" for f in fields), -len(SCHEMAS[key]))
+        if best is None or score > best[0]:
+            best = (score, key, fields)
+    score, key, fields = best
+    if not any(f[0] == "vehicle_id" for f in fields) or len(fields) < 2:
+        raise RuntimeError(f"ヘッダーがどのエクスポート形式にも一致しません: {','.join(header)[:200]}")
+    return key, fields
+
+
+# ===== 列指向のテーブル =====
+
+class Table:
+    """列名 → array（または list）の表。table["price"] で列、table.row(i) で1行（dict）"""
+
+    def __init__(self, dataset: str, fields):
+        self.dataset = dataset
+        self.types = {name: kind for name, kind, _ in fields}
+        self.columns = {name: array(_TYPECODES[kind]) if kind in _TYPECODES else []
+                        for name, kind, _ in fields}
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def row(self, i: int) -> dict:
+        values = {}
+        for name, column in self.columns.items():
+            value = column[i]
+            kind = self.types[name]
+            if (kind == "int" and value == MISSING_INT) or (kind == "date" and value == MISSING_DATE) \
+                    or (kind == "float" and math.isnan(value)):
+                value = None
+            elif kind == "date":
+                value = datetime.date.fromordinal(value)
+            values[name] = value
+        return values
+
+    def rows(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def extend(self, other: "Table"):
+        for name, column in other.columns.items():
+            self.columns[name].extend(column)
+
+    def nbytes(self) -> int:
+        """列データのおおよそのバイト数（文字列列は参照分のみ）"""
+        return sum(c.itemsize * len(c) if isinstance(c, array) else 8 * len(c) for c in self.columns.values())
+
+
+# ===== 読み込み =====
+
+def _open_text(path: Path):
+    with open(path, "rb") as f:
+        encoding = detect_encoding(f.read(DETECT_BYTES))
+    # cp932 で判定した後に読めない文字があっても止めない（外字など）
+    return open(path, "r", encoding=encoding, errors="replace" if encoding == "cp932" else "strict",
+                newline=""), encoding
+
+
+def detect(path, dataset=None) -> str:
+    """ヘッダー行だけを読んでデータセットを判定する（行が無いファイルでも判定できる）"""
+    path = Path(path)
+    text, _ = _open_text(path)
+    with text:
+        header = next(csv.reader(text), None)
+    if not header:
+        raise RuntimeError(f"空のファイルです: {path.name}")
+    return match_schema(header, dataset)[0]
+
+
+def iter_batches(path, dataset=None, batch_size: int = BATCH_SIZE):
+    """batch_size 行ごとに Table を返す。ファイル全体は読み込まない"""
+    path = Path(path)
+    text, encoding = _open_text(path)
+    with text:
+        reader = csv.reader(text)
+        header = next(reader, None)
+        if not header:
+            raise RuntimeError(f"空のファイルです: {path.name}")
+        key, fields = match_schema(header, dataset)
+        width = max(index for _, _, index in fields) + 1
+        yielded = False
+        while True:
+            # batch_size 行だけ読み、列ごとにまとめて変換する（行ごとの dict は作らない）
+            rows = []
+            for record in reader:
+                if len(record) < width:
+                    if not any(cell.strip() for cell in record):
+                        continue
+                    record = record + [""] * (width - len(record))
+                rows.append(record)
+                if len(rows) >= batch_size:
+                    break
+            if not rows and yielded:
+                return
+            table = Table(key, fields)
+            for name, kind, index in fields:
+                table.columns[name].extend(map(_CONVERTERS[kind], [r[index] for r in rows]))
+            yield table
+            yielded = True
+            if len(rows) < batch_size:
+                return
+
+def read(path, dataset=None) -> Table:
+    """ファイル全体を1つの Table にする（列ごとに array へ追記するだけなので行数に比例した小さなメモリ）"""
+    result = None
+    for batch in iter_batches(path, dataset):
+        if result is None:
+            result = batch
+        else:
+            result.extend(batch)
+    return result
+
+
+def main(argv=None):
+    """python export_parser.py <CSV>... で行数・判定結果・先頭行を表示する"""
+    argv = sys.argv[1:] if argv is None else argv
+    for name in argv:
+        with open(name, "rb") as f:
+            encoding = detect_encoding(f.read(DETECT_BYTES))
+        table = read(name)
+        print(f"{name}: {table.dataset} / {encoding} / {len(table)} 行 / 列 {', '.join(table.columns)}"
+              f" / 約 {table.nbytes():,} バイト")
+        if len(table):
+            print(f"  先頭: {table.row(0)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
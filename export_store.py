@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+エクスポートの蓄積（ローカルの SQLite）
+- アップロードでローカルのファイルが消える前に、各エクスポートを .cache/exports.sqlite3 に追記する
+  （EXPORT_DB で変更、EXPORT_STORE=false で無効）
+- access（アクセス数）/ registration（登録物件）の2表。主キーは (portal, shop, vehicle_id, date)
+  → 車両ごとの履歴は (vehicle_id, date)、日ごとの集計は (date, portal, shop) の索引で引く
+- 同じデータセット・店舗・日付に同じ内容（SHA-256）を取り込み済みならスキップ。内容が違えば置き換える
+  （何度取り込んでも同じ結果。前日と内容が同じ日も、その日の行として残る）
+- 読み込みは export_parser（列指向・分割読み込み）
+
+使い方:
+    python export_store.py ingest downloads/*.csv
+    python export_store.py history MAIN000001 --days 90
+    python export_store.py daily 2024-01-05
+"""
+
+import argparse
+import datetime
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import export_parser
+import session_cache
+import shops
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exports (
+    dataset     TEXT NOT NULL,
+    shop        TEXT NOT NULL,
+    date        TEXT NOT NULL,
+    portal      TEXT NOT NULL,
+    sha256      TEXT NOT NULL,
+    source      TEXT NOT NULL,
+    rows        INTEGER NOT NULL,
+    ingested_at REAL NOT NULL,
+    PRIMARY KEY (dataset, shop, date)
+);
+CREATE TABLE IF NOT EXISTS access (
+    portal       TEXT NOT NULL,
+    shop         TEXT NOT NULL,
+    vehicle_id   TEXT NOT NULL,
+    date         TEXT NOT NULL,
+    name         TEXT,
+    grade        TEXT,
+    price        INTEGER,
+    list_views   INTEGER,
+    detail_views INTEGER,
+    favorites    INTEGER,
+    inquiries    INTEGER,
+    PRIMARY KEY (portal, shop, vehicle_id, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS access_by_vehicle ON access (vehicle_id, date);
+CREATE INDEX IF NOT EXISTS access_by_date ON access (date, portal, shop);
+CREATE TABLE IF NOT EXISTS registration (
+    portal        TEXT NOT NULL,
+    shop          TEXT NOT NULL,
+    vehicle_id    TEXT NOT NULL,
+    date          TEXT NOT NULL,
+    name          TEXT,
+    maker         TEXT,
+    model         TEXT,
+    year          INTEGER,
+    mileage       INTEGER,
+    price         INTEGER,
+    listed_on     TEXT,
+    registered_on TEXT,
+    status        TEXT,
+    PRIMARY KEY (portal, shop, vehicle_id, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS registration_by_vehicle ON registration (vehicle_id, date);
+CREATE INDEX IF NOT EXISTS registration_by_date ON registration (date, portal, shop);
+"""
+
+# データセット → (表, 表の列)
+TABLES = {
+    "carsensor_access": "access",
+    "goonet_access": "access",
+    "carsensor_registration": "registration",
+    "goonet_registration": "registration",
+}
+COLUMNS = {
+    "access": ("name", "grade", "price", "list_views", "detail_views", "favorites", "inquiries"),
+    "registration": ("name", "maker", "model", "year", "mileage", "price", "listed_on", "registered_on", "status"),
+}
+
+# ファイル名の日付（YYYYMMDD、続く時刻は任意）
+_DATE_IN_NAME = re.compile(r"(?<!\d)(20\d{2})(\d{2})(\d{2})(?:[_-]?\d{6})?(?!\d)")
+
+
+def enabled() -> bool:
+    return os.getenv("EXPORT_STORE", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+def db_path() -> Path:
+    path = os.getenv("EXPORT_DB")
+    return Path(path).expanduser() if path else session_cache.cache_dir() / "exports.sqlite3"
+
+
+def connect(path: Path = None):
+    path = Path(path or db_path())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def snapshot_date(path: Path) -> str:
+    """ファイル名の日付（YYYYMMDD）。無ければ更新日時"""
+    m = _DATE_IN_NAME.search(path.name)
+    if m:
+        try:
+            return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3))).isoformat()
+        except ValueError:
+            pass
+    return datetime.date.fromtimestamp(path.stat().st_mtime).isoformat()
+
+
+def shop_of(path: Path, portal: str = None) -> str:
+    """ファイル名から店舗 id を決める（カーセンサーは店舗の suffix / id、グーネットは店舗の filename_prefix）。
+    どの店舗にも当たらなければ main"""
+    stem = re.sub(r"\s*\(\d+\)$", "", path.stem)  # 'name (1).csv'（同名の保存）
+    words = re.split(r"[_\s-]+", stem)
+    if portal in (None, "carsensor"):
+        for shop in shops.shops("carsensor"):
+            if shops.suffix(shop) and (stem.endswith(shops.suffix(shop)) or shop["id"] in words):
+                return shop["id"]
+    if portal in (None, "goonet"):
+        for shop in shops.shops("goonet"):
+            if shop.get("filename_prefix") and path.name.startswith(shop["filename_prefix"]):
+                return shop["id"]
+    return "main"
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _iso(ordinal: int):
+    return datetime.date.fromordinal(ordinal).isoformat() if ordinal != export_parser.MISSING_DATE else None
+
+
+def _rows(batch, table: str, portal: str, shop: str, date: str):
+    """export_parser の Table から INSERT 用のタプルを列単位で組み立てる"""
+    n = len(batch)
+    values = []
+    for name in COLUMNS[table]:
+        if name not in batch.columns:
+            values.append([None] * n)
+            continue
+        column, kind = batch.columns[name], batch.types[name]
+        if kind == "int":
+            values.append([None if v == export_parser.MISSING_INT else v for v in column])
+        elif kind == "date":
+            values.append([_iso(v) for v in column])
+        else:
+            values.append([v or None for v in column])
+    return zip([portal] * n, [shop] * n, batch.columns["vehicle_id"], [date] * n, *values)
+
+
+def ingest_file(conn, path, dataset=None) -> int:
+    """1ファイルを取り込み、取り込んだ行数を返す（取り込み済み・対象外は 0）"""
+    path = Path(path)
+    if path.stem.endswith("_delta"):
+        return 0  # 差分ファイル（snapshot_delta）は全件から取り込む
+    digest = _sha256(path)
+    # 行が無い（ヘッダーだけの）エクスポートでも、前の取り込みを置き換えて取り込み済みとして記録する
+    dataset = export_parser.detect(path, dataset)
+    table, portal = TABLES[dataset], dataset.split("_", 1)[0]
+    shop, date = shop_of(path, portal), snapshot_date(path)
+    names = ("portal", "shop", "vehicle_id", "date") + COLUMNS[table]
+    count = 0
+    with conn:
+        done = conn.execute("SELECT sha256 FROM exports WHERE dataset = ? AND shop = ? AND date = ?",
+                            (dataset, shop, date)).fetchone()
+        if done and done[0] == digest:
+            return 0
+        # 同じ日・同じ店舗の取り直し → 前の取り込みを置き換える
+        conn.execute(f"DELETE FROM {table} WHERE portal = ? AND shop = ? AND date = ?", (portal, shop, date))
+        for batch in export_parser.iter_batches(path, dataset):
+            conn.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(names)}) "
+                             f"VALUES ({', '.join('?' * len(names))})", _rows(batch, table, portal, shop, date))
+            count += len(batch)
+        conn.execute("INSERT OR REPLACE INTO exports VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (dataset, shop, date, portal, digest, path.name, count, time.time()))
+    return count
+
+
+def ingest_files(paths, dataset=None):
+    """ファイルをまとめて取り込む。取り込めないファイルは警告だけ出して続ける（アップロードを止めない）"""
+    if not enabled():
+        return 0
+    started = time.perf_counter()
+    total, done = 0, 0
+    conn = connect()
+    try:
+        for path in paths:
+            try:
+                n = ingest_file(conn, path, dataset)
+            except Exception as e:
+                print(f"[STORE] 取り込みに失敗しました: {Path(path).name} | {e}")
+                continue
+            if n:
+                total += n
+                done += 1
+    finally:
+        conn.close()
+    if done:
+        print(f"[STORE] {done} ファイル / {total:,} 行を取り込みました（{time.perf_counter() - started:.2f}秒, {db_path()}）")
+    return total
+
+
+# ===== 参照 =====
+
+def vehicle_history(conn, vehicle_id: str, days: int = 90, table: str = "access", portal=None, shop=None):
+    """車両の直近 days 日の行（古い順）"""
+    since = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+    sql = f"SELECT * FROM {table} WHERE vehicle_id = ? AND date >= ?"
+    args = [vehicle_id, since]
+    if portal:
+        sql += " AND portal = ?"
+        args.append(portal)
+    if shop:
+        sql += " AND shop = ?"
+        args.append(shop)
+    cur = conn.execute(sql + " ORDER BY date", args)
+    names = [d[0] for d in cur.description]
+    return [dict(zip(names, row)) for row in cur]
+
+
+def daily_totals(conn, date: str):
+    """1日分のポータル・店舗別の台数とアクセス数の合計"""
+    cur = conn.execute(
+        "SELECT portal, shop, COUNT(*), SUM(detail_views), SUM(favorites), SUM(inquiries) "
+        "FROM access WHERE date = ? GROUP BY portal, shop ORDER BY portal, shop", (date,))
+    return [dict(zip(("portal", "shop", "vehicles", "detail_views", "favorites", "inquiries"), row)) for row in cur]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="エクスポートの蓄積（SQLite）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("ingest", help="CSV を取り込む")
+    p.add_argument("paths", nargs="+")
+    p = sub.add_parser("history", help="車両の履歴")
+    p.add_argument("vehicle_id")
+    p.add_argument("--days", type=int, default=90)
+    p.add_argument("--table", choices=list(COLUMNS), default="access")
+    p = sub.add_parser("daily", help="1日分の集計")
+    p.add_argument("date", help="YYYY-MM-DD")
+    args = parser.parse_args(argv)
+
+    if args.command == "ingest":
+        ingest_files([Path(p) for p in args.paths])
+        return 0
+    conn = connect()
+    try:
+        started = time.perf_counter()
+        if args.command == "history":
+            rows = vehicle_history(conn, args.vehicle_id, args.days, args.table)
+        else:
+            rows = daily_totals(conn, args.date)
+        elapsed = (time.perf_counter() - started) * 1000
+    finally:
+        conn.close()
+    for row in rows:
+        print(row)
+    print(f"{len(rows)} 行（{elapsed:.1f}ミリ秒）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,15 +10,20 @@
 import os
 import json
 import time
-import glob
+import traceback
+from datetime import datetime
 from pathlib import Path
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.action_chains import ActionChains
+
+import download_events
+import driver_factory
+import http_download
+import locators
+import session_cache
+import timeouts
+import tracing
 
 # ===================== 設定読み込み =====================
 def load_settings():
@@ -40,26 +45,6 @@ def to_bool(v, default=False):
         return v.strip().lower() in ("1", "true", "yes", "on")
     return default
 
-settings = load_settings()
-username = os.getenv("GOONET_USERNAME") or settings.get("GOONET_USERNAME")
-password = os.getenv("GOONET_PASSWORD") or settings.get("GOONET_PASSWORD")
-download_dir_str = os.getenv("DOWNLOAD_DIR") or settings.get("DOWNLOAD_DIR")
-# 環境変数 HEADLESS を優先（GitHub Actions用）
-headless_env = os.getenv("HEADLESS")
-if headless_env is not None:
-    headless = to_bool(headless_env, default=True)
-else:
-    headless = to_bool(settings.get("HEADLESS", True), default=True)
-
-if not username or not password:
-    raise RuntimeError("setting.json に 'GOONET_USERNAME' と 'GOONET_PASSWORD' を設定してください。")
-if not download_dir_str:
-    raise RuntimeError("setting.json に 'DOWNLOAD_DIR' を設定してください。（例: C:\\\\Users\\\\m-oka\\\\Downloads）")
-
-DOWNLOAD_DIR = Path(download_dir_str).expanduser().resolve()
-DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
-download_path = str(DOWNLOAD_DIR)
-
 # ===================== ユーティリティ =====================
 def list_data_files(root_dir: Path):
     exts = {".csv", ".xlsx", ".xls"}
@@ -71,80 +56,83 @@ def list_data_files(root_dir: Path):
                 files.append(str(p))
     return files
 
+@tracing.traced("download.wait", portal="goonet", mode="poll")
 def wait_for_download(before_files, dir_path: Path, timeout=90):
-    """15秒待機して新規ファイルを返す"""
-    time.sleep(15)
+    """新規ファイルが現れた時点で返す（イベント非対応時のフォールバック）"""
     before_set = set(before_files)
-    now = list_data_files(dir_path)
-    new_files = [p for p in now if p not in before_set]
-    if new_files:
-        print(f"ダウンロード完了: {len(new_files)}件")
-        return new_files
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        now = list_data_files(dir_path)
+        new_files = [p for p in now if p not in before_set]
+        if new_files and not list(dir_path.glob("*.crdownload")):
+            print(f"ダウンロード完了: {len(new_files)}件")
+            return new_files
+        time.sleep(0.5)
     print("新規ファイルが見つかりませんでした")
     return []
 
 # ===================== Chrome 起動 =====================
-options = webdriver.ChromeOptions()
-if headless:
-    options.add_argument("--headless=new")
-options.add_argument("--disable-gpu")
-options.add_argument("--no-sandbox")
-options.add_argument("--disable-dev-shm-usage")
-options.add_argument("--window-size=1920,1080")
-# User-Agent を設定してヘッドレス検出を回避
-options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-
-prefs = {
-    "download.default_directory": download_path,
-    "download.prompt_for_download": False,
-    "download.directory_upgrade": True,
-    "safebrowsing.enabled": True,
-    "profile.default_content_settings.popups": 0,
-}
-options.add_experimental_option("prefs", prefs)
-options.add_experimental_option("excludeSwitches", ["enable-automation"])
-options.add_experimental_option("useAutomationExtension", False)
-
-driver = None
-try:
-    # Selenium Manager（推奨）
-    driver = webdriver.Chrome(options=options)
-except Exception as e:
-    print("Selenium Manager での起動に失敗。webdriver-manager を試します:", e)
+@tracing.traced("driver.build", portal="goonet")
+def build_driver(download_path: str, headless: bool):
+    options = webdriver.ChromeOptions()
+    if headless:
+        options.add_argument("--headless=new")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--window-size=1920,1080")
+    # User-Agent を設定してヘッドレス検出を回避
+    options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+
+    prefs = {
+        "download.default_directory": download_path,
+        "download.prompt_for_download": False,
+        "download.directory_upgrade": True,
+        "safebrowsing.enabled": True,
+        "profile.default_content_settings.popups": 0,
+    }
+    options.add_experimental_option("prefs", prefs)
+    options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    options.add_experimental_option("useAutomationExtension", False)
+    download_events.enable_performance_log(options)
+
+    # ChromeDriver はバージョン別にキャッシュしたパスを使う（毎回のネットワーク問い合わせをしない）
+    driver = driver_factory.create_chrome(options, portal="goonet")
+
+    # ヘッドレス時のダウンロード許可（未対応版は無視）
     try:
-        from webdriver_manager.chrome import ChromeDriverManager
-        driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    except Exception as e2:
-        raise RuntimeError(f"ChromeDriver の起動に失敗しました: {e2}")
-
-# ヘッドレス時のダウンロード許可（未対応版は無視）
-try:
-    driver.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": download_path})
-except Exception:
-    pass
-
-# ネットワークログを有効化
-try:
-    driver.execute_cdp_cmd('Network.enable', {})
-except Exception:
-    pass
+        driver.execute_cdp_cmd("Page.setDownloadBehavior", {"behavior": "allow", "downloadPath": download_path})
+    except Exception:
+        pass
+
+    # ネットワークログを有効化
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+    except Exception:
+        pass
+    return driver
 
 # ===================== 対象URL =====================
-login_url = "https://motorgate.jp/"
-target_url = "https://motorgate.jp/group/stock/search"
+# 接続先（ローカルの代替サーバー等で検証する場合は GOONET_BASE_URL で変更）
+login_url = os.getenv("GOONET_BASE_URL", "https://motorgate.jp/").rstrip("/") + "/"
+target_url = login_url + "group/stock/search"
+csv_url = login_url + "group/stock/search/csv"
 
-try:
-    # 実行前のファイル状態
-    print("実行前のファイル状態を確認:")
-    pre_files = list_data_files(DOWNLOAD_DIR)
-    print(f"実行前に存在するCSV/Excel ファイル数: {len(pre_files)}")
+def is_logged_in(driver):
+    return not driver.find_elements(By.ID, "client_id")
+
+@tracing.traced("login", driver_arg=0, portal="goonet")
+def login(driver, username, password):
+    from selenium.webdriver.support import expected_conditions as EC
+    # キャッシュ済みセッションが有効ならログインフォームを省略
+    if session_cache.restore_driver_session(driver, "goonet", login_url, target_url, is_logged_in):
+        return
 
-    # --- ログイン ---
     driver.get(login_url)
     print(f"ログインページにアクセス: {driver.current_url}")
 
     # ログインフォーム要素
-    client_id_field = WebDriverWait(driver, 30).until(
+    client_id_field = timeouts.wait(driver, "goonet.login.form", 30, "goonet").until(
         EC.presence_of_element_located((By.ID, "client_id"))
     )
     password_field = driver.find_element(By.NAME, "client_pw")
@@ -158,15 +146,97 @@ try:
     login_button.click()
 
     # ログイン成功待ち（URL か body の遷移で判定）
-    wait = WebDriverWait(driver, 30)
+    wait = timeouts.wait(driver, "goonet.login.redirect", 30, "goonet")
     try:
         wait.until(EC.url_contains("/top"))
     except Exception:
         wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
     print(f"ログイン後URL: {driver.current_url}")
-
-    # --- 目的ページへ ---
-    driver.get(target_url)
+    if "/top" in driver.current_url or is_logged_in(driver):
+        session_cache.save_driver_session(driver, "goonet")
+
+@tracing.traced("export.post")
+def post_export_csv(driver, download_dir: Path):
+    """フォームデータを取得してHTTP POSTで直接CSVを取得する。保存したパス（失敗時 None）を返す"""
+    print("フォームデータを取得して直接POSTリクエストを送信...")
+
+    # Cookieとフォームデータを取得
+    cookies = driver.get_cookies()
+    cookie_dict = {cookie['name']: cookie['value'] for cookie in cookies}
+
+    # フォームデータを全て取得
+    form_data = driver.execute_script("""
+        var formData = {};
+        var form = document.getElementById('frm');
+        if (!form) return null;
+
+        // すべてのinput, select, textarea要素を取得
+        var inputs = form.querySelectorAll('input, select, textarea');
+        inputs.forEach(function(input) {
+            if (input.name) {
+                if (input.type === 'checkbox' || input.type === 'radio') {
+                    if (input.checked) {
+                        formData[input.name] = input.value;
+                    }
+                } else {
+                    formData[input.name] = input.value;
+                }
+            }
+        });
+
+        // export_flgを追加
+        formData['export_flg'] = '1';
+
+        return formData;
+    """)
+
+    if form_data is None:
+        print("エラー: フォームが見つかりません")
+        return None
+    print(f"取得したフォームデータ項目数: {len(form_data)}")
+
+    # requestsライブラリでPOST送信
+    import requests
+
+    headers = {
+        'User-Agent': driver.execute_script("return navigator.userAgent;"),
+        'Referer': target_url,
+        'Origin': login_url.rstrip("/")
+    }
+
+    print(f"POSTリクエスト送信先: {csv_url}")
+    # 本文はメモリに溜めず、チャンク単位で一時ファイルに書き出す
+    response = requests.post(csv_url, data=form_data, cookies=cookie_dict, headers=headers, stream=True, timeout=(10, 300))
+
+    print(f"レスポンスステータス: {response.status_code}")
+    print(f"Content-Type: {response.headers.get('Content-Type', 'N/A')}")
+
+    if response.status_code != 200:
+        print(f"エラー: ステータスコード {response.status_code}")
+        print(f"レスポンス本文（最初の500文字）: {response.text[:500]}")
+        response.close()
+        return None
+
+    # CSVファイルとして保存（HTML・空・途中で切れた応答は保存しない）
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    try:
+        filename, size, digest = http_download.save_stream(response, Path(download_dir) / f"goonet_bukken_{timestamp}.csv")
+    except (http_download.UnexpectedContent, http_download.IncompleteDownload) as e:
+        print(f"エラー: CSVを保存しませんでした: {e}")
+        return None
+    except requests.RequestException as e:
+        print(f"エラー: CSVの受信中に通信が切れました: {e}")
+        return None
+
+    print(f"CSVファイルを保存しました: {filename}")
+    print(f"ファイルサイズ: {size} bytes（sha256 {digest}）")
+    return filename
+
+@tracing.traced("export", dataset="goonet_registration")
+def download_stock_search(driver, download_dir: Path, job: str = "goonet.registration"):
+    """在庫検索ページでエクスポートを実行し、取得したファイル（download_dir/<job>/ に移したもの）の一覧を返す"""
+    with tracing.span("navigate", driver=driver, url=target_url):
+        driver.get(target_url)
     print(f"検索ページへ遷移: {driver.current_url}")
     time.sleep(3)  # 画面描画待ち
 
@@ -176,20 +246,31 @@ try:
     print(f"リンク数: {len(links)} / ボタン数: {len(buttons)}")
 
     # --- エクスポート実行 ---
-    # 1) CSS (li.export > a)
+    # 1) エクスポートリンク（li.export > a、無ければテキスト一致）
     export_link = None
     try:
-        export_link = WebDriverWait(driver, 10).until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, "li.export > a"))
-        )
+        export_link = locators.resolve(driver, "goonet.registration.export_link", [
+            (By.CSS_SELECTOR, "li.export > a"),
+            (By.XPATH, "//a[contains(text(), 'エクスポート')]"),
+        ], 10, portal="goonet")
         print(f"エクスポートリンク発見: テキスト={export_link.text} href={export_link.get_attribute('href')}")
     except Exception:
-        print("CSS 'li.export > a' では見つからず → 代替手段へ")
+        print("エクスポートリンクが見つからず → 代替手段へ")
+
+    # このジョブ専用の一時フォルダに保存させる（DOWNLOAD_DIR 全体は走査しない）
+    with download_events.staging(driver, download_dir) as (folder, armed):
+        files = _export_into(driver, folder, armed, export_link)
+        files = download_events.publish(files, download_dir, job)
+    for nf in files:
+        print(f"  - {nf}")
+    return files
 
-    # 実行前ファイル一覧を保存
-    before = list_data_files(DOWNLOAD_DIR)
+def _export_into(driver, folder: Path, armed: bool, export_link):
+    """エクスポートを実行し、folder（ジョブの一時フォルダ）に保存されたファイルを返す"""
+    before = list_data_files(folder)
 
     triggered = False
+    saved = None
 
     # 優先順位1: リンク要素を直接クリック（最も確実）
     if export_link:
@@ -208,80 +289,10 @@ try:
 
             # フォームデータを取得してHTTP POSTで直接リクエスト送信
             try:
-                print("フォームデータを取得して直接POSTリクエストを送信...")
-
-                # Cookieとフォームデータを取得
-                cookies = driver.get_cookies()
-                cookie_dict = {cookie['name']: cookie['value'] for cookie in cookies}
-
-                # フォームデータを全て取得
-                form_data = driver.execute_script("""
-                    var formData = {};
-                    var form = document.getElementById('frm');
-                    if (!form) return null;
-
-                    // すべてのinput, select, textarea要素を取得
-                    var inputs = form.querySelectorAll('input, select, textarea');
-                    inputs.forEach(function(input) {
-                        if (input.name) {
-                            if (input.type === 'checkbox' || input.type === 'radio') {
-                                if (input.checked) {
-                                    formData[input.name] = input.value;
-                                }
-                            } else {
-                                formData[input.name] = input.value;
-                            }
-                        }
-                    });
-
-                    // export_flgを追加
-                    formData['export_flg'] = '1';
-
-                    return formData;
-                """)
-
-                if form_data is None:
-                    print("エラー: フォームが見つかりません")
-                    triggered = False
-                else:
-                    print(f"取得したフォームデータ項目数: {len(form_data)}")
-
-                    # requestsライブラリでPOST送信
-                    import requests
-
-                    csv_url = "https://motorgate.jp/group/stock/search/csv"
-                    headers = {
-                        'User-Agent': driver.execute_script("return navigator.userAgent;"),
-                        'Referer': 'https://motorgate.jp/group/stock/search',
-                        'Origin': 'https://motorgate.jp'
-                    }
-
-                    print(f"POSTリクエスト送信先: {csv_url}")
-                    response = requests.post(csv_url, data=form_data, cookies=cookie_dict, headers=headers)
-
-                    print(f"レスポンスステータス: {response.status_code}")
-                    print(f"Content-Type: {response.headers.get('Content-Type', 'N/A')}")
-
-                    if response.status_code == 200:
-                        # CSVファイルとして保存
-                        from datetime import datetime
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        filename = os.path.join(DOWNLOAD_DIR, f"goonet_bukken_{timestamp}.csv")
-
-                        with open(filename, 'wb') as f:
-                            f.write(response.content)
-
-                        print(f"CSVファイルを保存しました: {filename}")
-                        print(f"ファイルサイズ: {len(response.content)} bytes")
-                        triggered = True
-                    else:
-                        print(f"エラー: ステータスコード {response.status_code}")
-                        print(f"レスポンス本文（最初の500文字）: {response.text[:500]}")
-                        triggered = False
-
+                saved = post_export_csv(driver, folder)
+                triggered = saved is not None
             except Exception as e_post:
                 print(f"POSTリクエストエラー: {e_post}")
-                import traceback
                 traceback.print_exc()
                 triggered = False
         except Exception as e1:
@@ -290,7 +301,6 @@ try:
             try:
                 driver.execute_script("arguments[0].click();", export_link)
                 print("エクスポートリンクをクリックしました（JS経由）")
-                time.sleep(20)
                 triggered = True
             except Exception as e2:
                 print(f"JS経由のクリックでもエラー: {e2}")
@@ -303,7 +313,6 @@ try:
 
             driver.execute_script("excel();")
             print("JavaScript 関数 excel() を実行しました")
-            time.sleep(15)
             triggered = True
         except Exception as e:
             print(f"excel() 実行でエラー: {e}")
@@ -329,42 +338,76 @@ try:
         raise RuntimeError("エクスポート操作を開始できませんでした。画面構造の変更が疑われます。")
 
     # 直接POSTでダウンロードした場合はここでの待機は不要
-    if not triggered:
-        # アラートが出る場合に備えてハンドリング
-        try:
-            alert = driver.switch_to.alert
-            print(f"ダウンロード時のアラート: {alert.text}")
-            alert.accept()
-            print("アラート OK")
-        except Exception:
-            pass
+    if saved is not None:
+        return [Path(saved)]
 
-        # --- ダウンロード完了待機 ---
-        print("ダウンロード完了待機中...")
-        print(f"ダウンロードディレクトリ: {DOWNLOAD_DIR}")
-        print(f"実行前ファイル数: {len(before)}")
-
-        new_files = wait_for_download(before, DOWNLOAD_DIR, timeout=120)
-        if new_files:
-            print(f"ダウンロードされたファイル数: {len(new_files)}")
-            for nf in new_files:
-                print(f"  - {nf}")
-        else:
-            print("ダウンロードされたファイルが見つかりませんでした。")
-            current_files = list_data_files(DOWNLOAD_DIR)
-            print(f"現在のファイル数（デバッグ用）: {len(current_files)}")
-            print("現在のファイル一覧:")
-            for cf in current_files:
-                print(f"  - {cf}")
-
-except Exception as e:
-    print(f"エラーが発生しました: {e}")
-    import traceback
-    print(traceback.format_exc())
-
-finally:
+    # アラートが出る場合に備えてハンドリング
     try:
-        driver.quit()
+        alert = driver.switch_to.alert
+        print(f"ダウンロード時のアラート: {alert.text}")
+        alert.accept()
+        print("アラート OK")
     except Exception:
         pass
-    print(f"処理を完了しました（ダウンロード先: {download_path} / ヘッドレス: {headless}）")
+
+    # --- ダウンロード完了待機 ---
+    print("ダウンロード完了待機中...")
+    print(f"ダウンロードディレクトリ: {folder}")
+
+    if armed:
+        new_files = [str(d["path"]) for d in download_events.wait_for_downloads(
+            driver, folder, timeout=timeouts.timeout("download.wait", 120, "goonet"), portal="goonet")]
+    else:
+        new_files = wait_for_download(before, folder, timeout=timeouts.timeout("download.wait", 120, "goonet"))
+    if new_files:
+        print(f"ダウンロードされたファイル数: {len(new_files)}")
+    else:
+        print("ダウンロードされたファイルが見つかりませんでした。")
+    return [Path(nf) for nf in new_files]
+
+def main():
+    settings = load_settings()
+    username = os.getenv("GOONET_USERNAME") or settings.get("GOONET_USERNAME")
+    password = os.getenv("GOONET_PASSWORD") or settings.get("GOONET_PASSWORD")
+    download_dir_str = os.getenv("DOWNLOAD_DIR") or settings.get("DOWNLOAD_DIR")
+    # 環境変数 HEADLESS を優先（GitHub Actions用）
+    headless_env = os.getenv("HEADLESS")
+    if headless_env is not None:
+        headless = to_bool(headless_env, default=True)
+    else:
+        headless = to_bool(settings.get("HEADLESS", True), default=True)
+
+    if not username or not password:
+        raise RuntimeError("setting.json に 'GOONET_USERNAME' と 'GOONET_PASSWORD' を設定してください。")
+    if not download_dir_str:
+        raise RuntimeError("setting.json に 'DOWNLOAD_DIR' を設定してください。（例: C:\\\\Users\\\\m-oka\\\\Downloads）")
+
+    DOWNLOAD_DIR = Path(download_dir_str).expanduser().resolve()
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    download_path = str(DOWNLOAD_DIR)
+
+    driver = None
+    try:
+        driver = build_driver(download_path, headless)
+
+        # --- ログイン ---
+        login(driver, username, password)
+
+        # --- 目的ページへ → エクスポート ---
+        download_stock_search(driver, DOWNLOAD_DIR)
+
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        print(traceback.format_exc())
+
+    finally:
+        try:
+            driver_factory.report_lean(driver)
+            driver.quit()
+        except Exception:
+            pass
+        print(f"処理を完了しました（ダウンロード先: {download_path} / ヘッドレス: {headless}）")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,23 @@ import os
 import json
 import time
 import glob
-import shutil
 import traceback
-import selenium
 import datetime
+import threading
+import contextlib
 from pathlib import Path
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.support import expected_conditions as EC
 
-from webdriver_manager.chrome import ChromeDriverManager
+import download_events
+import driver_factory
+import locators
+import scheduler
+import session_cache
+import shops
+import timeouts
+import tracing
 
 # ============================================================
 # 設定読み込み（.env → settings.json → 環境変数）
@@ -53,6 +57,7 @@ def load_settings():
         "DOWNLOAD_DIR": os.getenv("DOWNLOAD_DIR"),
         "GOONET_USERNAME": os.getenv("GOONET_USERNAME"),
         "GOONET_PASSWORD": os.getenv("GOONET_PASSWORD"),
+        "GOONET_MAX_WORKERS": os.getenv("GOONET_MAX_WORKERS"),
     }
     for k, v in env_map.items():
         if v is not None:
@@ -64,6 +69,12 @@ def load_settings():
         headless = headless.strip().lower() in ("1", "true", "yes", "on")
     settings["HEADLESS"] = bool(headless)
 
+    # 店舗別エクスポートの同時実行数（1 なら1セッションで順番に実行。既定は shops.json の max_concurrency）
+    try:
+        settings["GOONET_MAX_WORKERS"] = max(1, int(settings.get("GOONET_MAX_WORKERS") or shops.limit("goonet")))
+    except (TypeError, ValueError):
+        settings["GOONET_MAX_WORKERS"] = shops.limit("goonet")
+
     # ダウンロード先（未指定なら OS 既定の Downloads）
     dl = settings.get("DOWNLOAD_DIR")
     if dl:
@@ -88,6 +99,7 @@ def load_settings():
 # WebDriver 準備
 # ============================================================
 
+@tracing.traced("driver.build", portal="goonet")
 def build_driver(download_dir: Path, headless: bool):
     options = webdriver.ChromeOptions()
     if headless:
@@ -107,9 +119,10 @@ def build_driver(download_dir: Path, headless: bool):
     options.add_experimental_option("prefs", prefs)
     options.add_experimental_option("excludeSwitches", ["enable-automation"])
     options.add_argument("--disable-blink-features=AutomationControlled")
+    download_events.enable_performance_log(options)
 
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=options)
+    # ChromeDriver はバージョン別にキャッシュしたパスを使う（毎回のネットワーク問い合わせをしない）
+    driver = driver_factory.create_chrome(options, portal="goonet")
     driver.set_page_load_timeout(60)
     return driver
 
@@ -149,6 +162,7 @@ def is_file_stable(path: Path, checks: int = 4, interval: float = 0.5) -> bool:
         print(f"[DEBUG] 安定性チェック例外: {path.name} - {e}")
         return False
 
+@tracing.traced("download.wait", portal="goonet", mode="poll")
 def wait_for_new_downloads(before: set, directory: Path, timeout: int = 180):
     """新規ダウンロード完了を待つ（.crdownloadが消えたら即返す）"""
     deadline = time.time() + timeout
@@ -194,20 +208,40 @@ def safe_rename(src: Path, dst: Path, retries: int = 20, delay: float = 0.5) ->
 # メイン処理（グーネット）
 # ============================================================
 
-LOGIN_URL = "https://motorgate.jp/"
-TARGET_URL = "https://motorgate.jp/ana/stockeffect"
+# 接続先（ローカルの代替サーバー等で検証する場合は GOONET_BASE_URL で変更）
+LOGIN_URL = os.getenv("GOONET_BASE_URL", "https://motorgate.jp/").rstrip("/") + "/"
+TARGET_URL = LOGIN_URL + "ana/stockeffect"
 
-TARGET_SHOPS = [
-    {"value": "1000491", "name": "ハイエース専門店　ＣＡＲ　ＰＲＯＤＵＣＥ　｜　カープロデュース", "filename_prefix": "ハイエース専門店_", "wait_seconds": 5},
-    {"value": "1002529", "name": "輸入車専門店　ＣＡＲＡＤ", "filename_prefix": "CARAD_", "wait_seconds": 10},
+# 検索ボタン・エクスポートボタンの候補（優先順）
+SEARCH_BUTTONS = [
+    (By.XPATH, "//a[contains(@href, 'click_stock_search_btn')]"),
+    (By.XPATH, "//*[contains(@onclick, 'click_stock_search_btn')]"),
+    (By.XPATH, "//a[@href='javascript:click_stock_search_btn();']"),
+    (By.XPATH, "//*[contains(text(), '検索') and (self::a or self::button)]"),
 ]
+EXPORT_BUTTONS = [
+    (By.XPATH, "//*[contains(text(), '検索結果をエクスポート')]"),
+    (By.XPATH, "//*[contains(text(), 'エクスポート')]"),
+    (By.XPATH, "//a[contains(@class, 'export') or contains(@onclick, 'export')]"),
+    (By.XPATH, "//*[@id='export']"),
+]
+
+def is_logged_in(driver) -> bool:
+    """ログインフォーム（client_id）が出ていなければログイン済み"""
+    return not driver.find_elements(By.ID, "client_id")
+
+@tracing.traced("login", driver_arg=0, portal="goonet")
+def login_goonet(driver, username: str, password: str, cached: bool = True):
+    """ログインする。cached=False ならキャッシュの Cookie を使わず新しいセッションでログインし、保存もしない"""
+    from selenium.webdriver.support import expected_conditions as EC
+    # キャッシュ済みセッションが有効ならログインフォームを省略
+    if cached and session_cache.restore_driver_session(driver, "goonet", LOGIN_URL, TARGET_URL, is_logged_in):
+        return
 
-def login_goonet(driver, username: str, password: str):
     driver.get(LOGIN_URL)
     print(f"ログインページにアクセス: {driver.current_url}")
 
-    wait = WebDriverWait(driver, 30)
-    client_id_field = wait.until(EC.presence_of_element_located((By.ID, "client_id")))
+    client_id_field = timeouts.wait(driver, "goonet.login.form", 30, "goonet").until(EC.presence_of_element_located((By.ID, "client_id")))
     # パスワードは name="client_pw" のため name 指定
     password_field = driver.find_element(By.NAME, "client_pw")
 
@@ -218,18 +252,24 @@ def login_goonet(driver, username: str, password: str):
     login_button.click()
 
     # ログイン後の URL 変化を待つ
-    wait.until(EC.url_contains("/top"))
+    timeouts.wait(driver, "goonet.login.redirect", 30, "goonet").until(EC.url_contains("/top"))
     print(f"ログイン成功: {driver.current_url}")
+    if cached:
+        session_cache.save_driver_session(driver, "goonet")
 
+@tracing.traced("export.trigger", driver_arg=0)
 def trigger_download_for_shop(driver, shop_info: dict) -> bool:
     """指定店舗で検索→エクスポートボタンをクリック（ダウンロード待機なし）"""
+    from selenium.webdriver.support.ui import Select
+    from selenium.webdriver.support import expected_conditions as EC
     try:
         print(f"\n=== {shop_info['name']} のダウンロード開始 ===")
-        driver.get(TARGET_URL)
+        with tracing.span("navigate", driver=driver, url=TARGET_URL):
+            driver.get(TARGET_URL)
 
         # 店舗選択
         try:
-            shop_select = WebDriverWait(driver, 20).until(
+            shop_select = timeouts.wait(driver, "goonet.access.shop_select", 20, "goonet").until(
                 EC.presence_of_element_located((By.ID, "SelectGroupShop"))
             )
             Select(shop_select).select_by_value(shop_info["value"])
@@ -239,26 +279,15 @@ def trigger_download_for_shop(driver, shop_info: dict) -> bool:
             print(f"店舗選択に失敗: {e}")
             return False
 
-        # 検索ボタン
+        # 検索ボタン（候補をまとめて1回で探す。前回当たった候補を優先）
         try:
-            did_click = False
-            for xp in [
-                "//a[contains(@href, 'click_stock_search_btn')]",
-                "//*[contains(@onclick, 'click_stock_search_btn')]",
-                "//a[@href='javascript:click_stock_search_btn();']",
-                "//*[contains(text(), '検索') and (self::a or self::button)]",
-            ]:
-                try:
-                    btn = WebDriverWait(driver, 5).until(EC.element_to_be_clickable((By.XPATH, xp)))
-                    btn.click()
-                    print("検索ボタンをクリック")
-                    did_click = True
-                    break
-                except Exception:
-                    continue
-            if not did_click:
-                print("検索ボタンが見つかりませんでした")
-                return False
+            btn = locators.resolve(driver, "goonet.access.search_button", SEARCH_BUTTONS, 5, portal="goonet")
+        except Exception:
+            print("検索ボタンが見つかりませんでした")
+            return False
+        try:
+            btn.click()
+            print("検索ボタンをクリック")
             time.sleep(2)
         except Exception as e:
             print(f"検索ボタン操作でエラー: {e}")
@@ -266,26 +295,13 @@ def trigger_download_for_shop(driver, shop_info: dict) -> bool:
 
         # エクスポートボタンをクリック
         try:
-            export_button = None
-            for xp in [
-                "//*[contains(text(), '検索結果をエクスポート')]",
-                "//*[contains(text(), 'エクスポート')]",
-                "//a[contains(@class, 'export') or contains(@onclick, 'export')]",
-                "//*[@id='export']",
-            ]:
-                try:
-                    export_button = WebDriverWait(driver, 8).until(EC.element_to_be_clickable((By.XPATH, xp)))
-                    break
-                except Exception:
-                    continue
-
-            if not export_button:
-                print("エクスポートボタンが見つかりませんでした")
-                return False
-
+            export_button = locators.resolve(driver, "goonet.access.export_button", EXPORT_BUTTONS, 8, portal="goonet")
+        except Exception:
+            print("エクスポートボタンが見つかりませんでした")
+            return False
+        try:
             export_button.click()
             print("エクスポートボタンをクリック")
-
         except Exception as e:
             print(f"エクスポートボタン操作でエラー: {e}")
             return False
@@ -298,6 +314,113 @@ def trigger_download_for_shop(driver, shop_info: dict) -> bool:
         return False
 
 
+@tracing.traced("rename")
+def rename_for_shop(path: Path, shop_info: dict):
+    """ダウンロードファイルを <店舗prefix><日時>_<元の名前> にリネーム"""
+    current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    dst = path.with_name(f"{shop_info['filename_prefix']}{current_time}_{path.name}")
+    if dst.exists():
+        try:
+            dst.unlink()
+        except Exception:
+            pass
+    if safe_rename(path, dst):
+        print(f"リネーム完了: {shop_info['name']} ({path.name}) -> {dst.name}")
+        return dst
+    print(f"リネーム失敗: {path.name}")
+    return None
+
+
+@tracing.traced("export", dataset="goonet_access")
+def download_for_shop(driver, shop_info: dict, download_dir: Path, job: str = None):
+    """1店舗分のエクスポートを実行し、そのトリガーで保存されたファイル（download_dir/<job>/ に移したもの）を返す（失敗時 None）"""
+    tracing.annotate(shop=shop_info["value"])
+    job = job or shops.step_name("goonet", "access", shop_info)
+    # このジョブ専用の一時フォルダに保存させる（クリック前スナップショットは空のフォルダ）
+    with download_events.staging(driver, download_dir) as (folder, armed):
+        before = snapshot_files(folder)
+
+        if not trigger_download_for_shop(driver, shop_info):
+            print(f"{shop_info['name']}: ダウンロードボタンクリックに失敗")
+            return None
+        print(f"{shop_info['name']}: ダウンロードボタンをクリック完了")
+
+        if armed:
+            done = download_events.wait_for_downloads(
+                driver, folder, timeout=timeouts.timeout("download.wait", 180, "goonet"), portal="goonet")
+            files = [d["path"] for d in done]
+        else:
+            files = wait_for_new_downloads(before, folder, timeout=timeouts.timeout("download.wait", 180, "goonet"))
+        if not files:
+            print(f"{shop_info['name']}: 新規ファイルが見つかりませんでした")
+            return None
+        # このトリガーで保存されたファイルだけが対象（ファイルの新旧順による推測はしない）
+        dst = rename_for_shop(files[0], shop_info)
+        return download_events.publish([dst], download_dir, job)[0] if dst else None
+
+
+def download_stockeffect(driver, download_dir: Path):
+    """対象店舗（shops.json の goonet。value は店舗選択 SelectGroupShop の値）を順番にエクスポートし、
+    店舗ごとにリネームしたファイル一覧を返す"""
+    print("\n=== 各店舗のダウンロード処理開始 ===")
+    renamed = []
+    for shop in shops.shops("goonet"):
+        try:
+            dst = download_for_shop(driver, shop, download_dir)
+        except Exception as e:
+            print(f"{shop['name']}: ダウンロード待機でエラー: {e}")
+            dst = None
+        if dst:
+            renamed.append(dst)
+    return renamed
+
+
+@contextlib.contextmanager
+def own_session(settings: dict, download_dir: Path):
+    """専用の Chrome セッションを起動・ログインして返す（ダウンロードはジョブごとの一時フォルダに分かれる）。
+    店舗の選択（SelectGroupShop）はサーバー側のセッションに残るため、キャッシュの Cookie を使うのは
+    同時に1セッションだけ（session_cache.lease）。他のセッションはそれぞれ新しくログインする"""
+    driver = None
+    with session_cache.lease("goonet") as cached:
+        try:
+            driver = build_driver(download_dir, settings["HEADLESS"])
+            login_goonet(driver, settings["GOONET_USERNAME"], settings["GOONET_PASSWORD"], cached=cached)
+            yield driver
+        finally:
+            if driver:
+                driver_factory.report_lean(driver, f"{threading.current_thread().name}: ")
+                driver.quit()
+
+
+def export_shop_in_session(driver, shop_info: dict, download_dir: Path, job: str = None):
+    """own_session のセッションで1店舗をエクスポートし、download_dir/<job>/ のファイルを返す"""
+    path = download_for_shop(driver, shop_info, download_dir, job)
+    if path is None:
+        raise RuntimeError(f"{shop_info['name']}: エクスポートを取得できませんでした")
+    return path
+
+
+def download_stockeffect_concurrent(settings: dict, download_dir: Path, targets=None, max_workers=None):
+    """店舗ごとに別セッションで同時にエクスポートする（同時実行数は max_workers まで）。
+    1セッションが複数店舗を順に処理するため、店舗が増えてもログイン・起動は max_workers 回で済む。
+    ファイルは各ジョブの一時フォルダ・トリガーから直接特定するため、完了順に依存しない"""
+    jobs = shops.jobs("goonet")
+    if targets is not None:
+        jobs = [{"name": shops.step_name("goonet", "access", shop), "portal": "goonet", "export": "access",
+                 "shop": shop} for shop in targets]
+    jobs = [job for job in jobs if job["export"] == "access"]
+    max_workers = min(max_workers or settings["GOONET_MAX_WORKERS"], len(jobs)) or 1
+    print(f"\n=== 各店舗のダウンロード処理開始（同時 {max_workers} セッション）===")
+
+    @contextlib.contextmanager
+    def open_worker(portal):
+        with own_session(settings, download_dir) as driver:
+            yield lambda job: [export_shop_in_session(driver, job["shop"], download_dir, job["name"])]
+
+    results, _ = scheduler.run(jobs, open_worker, workers=max_workers, limits={"goonet": max_workers})
+    return [p for job in jobs for p in results.get(job["name"], [])]
+
+
 def main():
     settings = load_settings()
     DOWNLOAD_DIR = Path(settings["DOWNLOAD_DIR"])
@@ -308,61 +431,13 @@ def main():
     driver = None
     try:
         print(f"DOWNLOAD_DIR: {DOWNLOAD_DIR}")
-        driver = build_driver(DOWNLOAD_DIR, HEADLESS)
-
-        # ログイン
-        login_goonet(driver, USERNAME, PASSWORD)
-
-        # ダウンロード前のファイル一覧を取得
-        print("\n=== ダウンロード前のファイル確認 ===")
-        before_files = snapshot_files(DOWNLOAD_DIR)
-        print(f"既存ファイル数: {len(before_files)}")
-
-        # 各店舗のダウンロードボタンを順番にクリック
-        print("\n=== 各店舗のダウンロード処理開始 ===")
-        for shop in TARGET_SHOPS:
-            ok = trigger_download_for_shop(driver, shop)
-            if ok:
-                wait_time = shop.get("wait_seconds", 5)
-                print(f"{shop['name']}: ダウンロードボタンをクリック完了")
-                print(f"{wait_time}秒待機...")
-                time.sleep(wait_time)
-            else:
-                print(f"{shop['name']}: ダウンロードボタンクリックに失敗")
-
-        # 全ダウンロード完了後、新規ファイルを検出
-        print("\n=== 新規ファイルの検出とリネーム処理 ===")
-        after_files = snapshot_files(DOWNLOAD_DIR)
-        new_files = [p for p in after_files - before_files if p.exists()]
-
-        if not new_files:
-            print("新規ファイルが見つかりませんでした")
+        if settings["GOONET_MAX_WORKERS"] > 1 and len(shops.shops("goonet")) > 1:
+            # 各セッションがそれぞれログインする（own_session）
+            download_stockeffect_concurrent(settings, DOWNLOAD_DIR)
         else:
-            print(f"新規ファイル検出: {len(new_files)}件")
-            # ダウンロード順（古い順）にソート：最初にダウンロードしたファイル = 最初の店舗
-            new_files_sorted = sorted(new_files, key=lambda p: p.stat().st_mtime)
-
-            # 各店舗に対応するファイルをリネーム
-            # TARGET_SHOPS[0] = ハイエース専門店 → 最初のファイル（古い方）
-            # TARGET_SHOPS[1] = CARAD → 2番目のファイル（新しい方）
-            for i, shop in enumerate(TARGET_SHOPS):
-                if i < len(new_files_sorted):
-                    file_to_rename = new_files_sorted[i]
-                    current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                    new_name = f"{shop['filename_prefix']}{current_time}_{file_to_rename.name}"
-                    dst = file_to_rename.with_name(new_name)
-
-                    # リネーム実行
-                    if dst.exists():
-                        try:
-                            dst.unlink()
-                        except Exception:
-                            pass
-                    ok = safe_rename(file_to_rename, dst)
-                    if ok:
-                        print(f"リネーム完了: {shop['name']} ({file_to_rename.name}) -> {dst.name}")
-                    else:
-                        print(f"リネーム失敗: {file_to_rename.name}")
+            driver = build_driver(DOWNLOAD_DIR, HEADLESS)
+            login_goonet(driver, USERNAME, PASSWORD)
+            download_stockeffect(driver, DOWNLOAD_DIR)
 
         print("\n=== 処理完了 ===")
 
@@ -371,6 +446,7 @@ def main():
         print(traceback.format_exc())
     finally:
         if driver:
+            driver_factory.report_lean(driver)
             driver.quit()
         print("ブラウザを閉じました")
 
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP で直接取得するファイルの保存（carsensor_http / goonet_bukken 共通）
+- 本文をチャンク単位で一時ファイル（.<名前>.part）に書き、同時にサイズと SHA-256 を計算する
+  （応答全体をメモリに載せないため、ファイルが大きくてもメモリ使用量は一定）
+- HTML（エラーページ・ログイン画面）や空の応答、Content-Length に満たない応答は保存しない
+- 書き終えてから os.replace で確定するため、途中のファイルが保存先に残ることはない
+
+使い方:
+    response = session.post(url, data=data, stream=True)
+    path, size, digest = http_download.save_stream(response, download_dir / "export.csv")
+"""
+
+import hashlib
+import os
+import re
+from pathlib import Path
+from urllib.parse import unquote
+
+import download_events
+import tracing
+
+CHUNK_SIZE = 64 * 1024
+
+# 本文の先頭がこれらで始まればダウンロードではなく画面（HTML）
+HTML_SIGNATURES = (b"<!doctype html", b"<html", b"<head", b"<?xml")
+
+
+class UnexpectedContent(RuntimeError):
+    """ダウンロードではなく HTML 等が返された"""
+
+
+class IncompleteDownload(RuntimeError):
+    """本文が途中で切れた・空だった"""
+
+
+def filename_from_headers(response):
+    """Content-Disposition のファイル名（無ければ None）"""
+    cd = response.headers.get("Content-Disposition", "")
+    m = re.search(r"filename\*\s*=\s*([^']*)''([^;]+)", cd)
+    if m:
+        return unquote(m.group(2).strip().strip('"'), encoding=m.group(1) or "utf-8")
+    m = re.search(r'filename\s*=\s*"?([^";]+)"?', cd)
+    if m:
+        raw = m.group(1).strip()
+        try:
+            # サーバーが Shift_JIS のまま送ってくる場合（latin-1 として解釈されている）
+            return raw.encode("latin-1").decode("cp932")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            return raw
+    return None
+
+
+def check_content_type(response):
+    """添付ファイルでない HTML の応答なら UnexpectedContent を送出する"""
+    content_type = response.headers.get("Content-Type", "")
+    attachment = "attachment" in response.headers.get("Content-Disposition", "").lower()
+    if not attachment and any(t in content_type.lower() for t in ("text/html", "application/xhtml")):
+        raise UnexpectedContent(f"ダウンロードではなく HTML が返されました（Content-Type: {content_type}）")
+
+
+def _looks_like_html(head: bytes) -> bool:
+    return head.lstrip(b"\xef\xbb\xbf \t\r\n").lower().startswith(HTML_SIGNATURES)
+
+
+def save_stream(response, dst: Path, overwrite: bool = False, chunk_size: int = CHUNK_SIZE):
+    """response の本文を dst に保存し、(保存先, バイト数, SHA-256) を返す。
+    overwrite=False なら既存ファイルを上書きせず 'name (1).ext' にする（ブラウザと同じ）"""
+    # 応答の確認で例外になっても接続を返すよう、確認から保存までを with response の中で行う
+    with response:
+        check_content_type(response)
+        dst = Path(dst)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if not overwrite:
+            dst = download_events.unique_path(dst)
+        tmp = dst.with_name(f".{dst.name}.part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in response.iter_content(chunk_size):
+                    if not chunk:
+                        continue
+                    if size == 0 and _looks_like_html(chunk[:512]):
+                        raise UnexpectedContent("ダウンロードではなく HTML が返されました（本文が HTML）")
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if size == 0:
+                raise IncompleteDownload("応答が空でした")
+            # 圧縮転送の場合は展開後のサイズになるため、Content-Length は非圧縮のときだけ照合する
+            expected = response.headers.get("Content-Length")
+            if expected and expected.isdigit() and not response.headers.get("Content-Encoding") and int(expected) != size:
+                raise IncompleteDownload(f"受信したサイズが一致しません（{size} / {expected} バイト）")
+            os.replace(tmp, dst)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+    tracing.add(bytes=size)
+    tracing.annotate(sha256=digest.hexdigest())
+    return dst, size, digest.hexdigest()
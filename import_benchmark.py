@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+各モジュールの import に掛かる時間を計測する（起動の速さ・import しても重い処理が走らないことの確認）
+- モジュールごとに新しい Python プロセスで python -X importtime -c "import <モジュール>" を実行し、
+  そのモジュールの累計 import 時間（依存を含む）と、読み込まれてしまった重いライブラリを表示する
+- 重いライブラリ（selenium の WebDriver 本体・requests・Google のクライアント）は実際に使う関数の中で読み込む。
+  import しただけで読み込まれていれば「重い依存」に表示する
+- 最後に全モジュールをまとめて import した場合の時間も表示する（オーケストレーターの起動時間の目安）
+
+使い方:
+    python import_benchmark.py                          # 全モジュール
+    python import_benchmark.py portal_runner pipeline --repeat 5
+    python import_benchmark.py --budget 100             # 100ミリ秒を超える・重い依存を読むモジュールがあれば終了コード 1
+    python import_benchmark.py --json imports.json
+"""
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# import しただけでは読み込まないライブラリ（読み込まれていれば遅い起動の原因）
+HEAVY_MODULES = (
+    "selenium.webdriver.remote.webdriver",
+    "selenium.webdriver.support.expected_conditions",
+    "requests",
+    "googleapiclient.discovery",
+    "google_auth_oauthlib.flow",
+)
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\| (\s*)(\S+)$")
+_MARKER = "--import-benchmark--"
+
+# 起動時の読み込み（site 等）と区別するため、計測対象の import の前に目印を出力する
+_PROBE = """
+import json, sys
+sys.stderr.write({marker!r} + "\\n")
+sys.stderr.flush()
+for _name in {modules!r}:
+    __import__(_name)
+print(json.dumps([m for m in {heavy!r} if m in sys.modules]))
+"""
+
+
+def modules():
+    """計測対象（このフォルダ直下の .py。このスクリプト自身は除く）"""
+    return sorted(p.stem for p in ROOT.glob("*.py") if p.stem != Path(__file__).stem)
+
+
+def measure(names):
+    """names を新しいプロセスで import し、(累計マイクロ秒, 読み込まれた重いライブラリ) を返す"""
+    code = _PROBE.format(marker=_MARKER, modules=list(names), heavy=HEAVY_MODULES)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=str(ROOT),
+                          capture_output=True, text=True, encoding="utf-8", errors="replace")
+    if proc.returncode != 0:
+        raise RuntimeError(f"import に失敗しました: {', '.join(names)}\n{proc.stderr[-2000:]}")
+    lines = proc.stderr.splitlines()
+    lines = lines[lines.index(_MARKER) + 1:] if _MARKER in lines else lines
+    # 最上位（字下げ無し）の import の累計を足す（依存は累計に含まれている）
+    total = sum(int(m.group(2)) for m in map(_IMPORTTIME_LINE.match, lines) if m and not m.group(3))
+    return total, json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def run(names, repeat: int = 3):
+    """モジュールごとに repeat 回計測し、最小値を {名前: {"ms", "heavy"}} で返す"""
+    results = {}
+    for name in names:
+        samples = [measure([name]) for _ in range(max(1, repeat))]
+        results[name] = {"ms": min(s[0] for s in samples) / 1000, "heavy": samples[0][1]}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="各モジュールの import 時間を計測")
+    parser.add_argument("modules", nargs="*", help="計測するモジュール（既定: すべて）")
+    parser.add_argument("--repeat", type=int, default=3, help="モジュールごとの計測回数（最小値を採用）")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="1モジュールあたりの上限（ミリ秒）。超えたもの・重い依存を読むものがあれば終了コード 1")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    args = parser.parse_args(argv)
+
+    names = args.modules or modules()
+    results = run(names, args.repeat)
+    everything, heavy_all = min((measure(names) for _ in range(max(1, args.repeat))), key=lambda r: r[0])
+
+    print(f"{'モジュール':<24}{'import':>10}  重い依存")
+    for name, r in sorted(results.items(), key=lambda kv: -kv[1]["ms"]):
+        print(f"{name:<24}{r['ms']:>8.1f}ms  {', '.join(r['heavy']) or '-'}")
+    print(f"\nすべてまとめて: {everything / 1000:.1f}ms"
+          + (f"（重い依存: {', '.join(heavy_all)}）" if heavy_all else ""))
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({"modules": results, "all_ms": everything / 1000},
+                                              ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"結果を保存しました: {args.json}")
+    if args.budget is not None:
+        over = [n for n, r in results.items() if r["ms"] > args.budget or r["heavy"]]
+        if over:
+            print(f"[ERROR] 上限（{args.budget:.0f}ms）超過・重い依存あり: {', '.join(over)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+要素の候補（XPath / CSS / id）の解決
+- 候補をすべて1回の JavaScript 実行で調べ、表示されている（クリックできる）最初の要素を返す
+  （候補ごとに待ち時間を使い切らない。見つかるまでの待ちは全候補で1回、timeouts.wait の学習値）
+- ポータル・ページ（URL のパス）・名前ごとに当たった候補を .cache/selectors.json に記録し、次回はその候補を先頭にする
+- 記録には候補ごとの当たり回数・解決回数・見つからなかった回数も残す（python locators.py で当たり率を表示）
+- SELECTOR_MEMO=false で記録した順序を使わない（候補は常に指定順）
+
+使い方:
+    button = locators.resolve(driver, "goonet.access.export_button", [
+        (By.XPATH, "//*[contains(text(), '検索結果をエクスポート')]"),
+        (By.CSS_SELECTOR, "a.export"),
+    ], 8, portal="goonet")
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import session_cache
+import timeouts
+import tracing
+
+# 候補を優先順に調べ、表示されていて無効化されていない最初の要素を [番号, 要素] で返す
+_FIND_SCRIPT = """
+const candidates = arguments[0];
+const usable = (el) => {
+  if (!el || el.disabled) return false;
+  if (!el.getClientRects().length) return false;
+  const style = window.getComputedStyle(el);
+  return style.visibility !== 'hidden' && style.display !== 'none';
+};
+for (let i = 0; i < candidates.length; i++) {
+  const by = candidates[i][0], value = candidates[i][1];
+  let nodes = [];
+  try {
+    if (by === 'xpath') {
+      const r = document.evaluate(value, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+      for (let j = 0; j < r.snapshotLength; j++) nodes.push(r.snapshotItem(j));
+    } else if (by === 'css selector') {
+      nodes = document.querySelectorAll(value);
+    } else if (by === 'id') {
+      nodes = [document.getElementById(value)];
+    } else if (by === 'name') {
+      nodes = document.getElementsByName(value);
+    }
+  } catch (e) {
+    continue;  // 書式の誤った候補は飛ばす
+  }
+  for (const el of nodes) {
+    if (usable(el)) return [i, el];
+  }
+}
+return null;
+"""
+
+_lock = threading.Lock()
+_memo = None
+
+
+def memo_enabled() -> bool:
+    return os.getenv("SELECTOR_MEMO", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _memo_path():
+    return session_cache.cache_dir() / "selectors.json"
+
+
+def _read():
+    try:
+        return json.loads(_memo_path().read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def _memo_entries():
+    global _memo
+    with _lock:
+        if _memo is None:
+            _memo = _read()
+        return _memo
+
+
+def _record(key: str, candidate=None):
+    """解決結果を記録する（session_cache.update_json でファイルを排他して読み直し、自分の分だけ加算する）"""
+    global _memo
+
+    def apply(entries):
+        entry = entries.setdefault(key, {"resolved": 0, "missed": 0, "memo_hits": 0, "hits": {}})
+        if candidate is None:
+            entry["missed"] += 1
+        else:
+            entry["resolved"] += 1
+            if entry.get("winner") == candidate:
+                entry["memo_hits"] += 1
+            entry["hits"][candidate] = entry["hits"].get(candidate, 0) + 1
+            entry["winner"] = candidate
+        entry["updated_at"] = time.time()
+
+    with _lock:
+        try:
+            _memo = session_cache.update_json(_memo_path(), apply)
+        except OSError as e:
+            print(f"[selector] 記録の保存に失敗: {e}")
+            entries = _read()
+            apply(entries)
+            _memo = entries
+
+
+def _key(driver, name: str, portal) -> str:
+    try:
+        page = re.sub(r"[0-9]+", "#", urlsplit(driver.current_url).path)
+    except Exception:
+        page = ""
+    return f"{portal or '-'}|{page}|{name}"
+
+
+def _label(candidate) -> str:
+    return f"{candidate[0]}:{candidate[1]}"
+
+
+def ordered(key: str, candidates):
+    """記録した当たりの候補を先頭にした候補の並び"""
+    candidates = list(candidates)
+    if not memo_enabled():
+        return candidates
+    winner = _memo_entries().get(key, {}).get("winner")
+    for i, candidate in enumerate(candidates):
+        if _label(candidate) == winner:
+            return [candidate] + candidates[:i] + candidates[i + 1:]
+    return candidates
+
+
+def find(driver, candidates):
+    """候補を1回だけ調べ、(候補, 要素) を返す（無ければ None）"""
+    found = driver.execute_script(_FIND_SCRIPT, [[by, value] for by, value in candidates])
+    if not found:
+        return None
+    index, element = found
+    return candidates[int(index)], element
+
+
+def resolve(driver, name: str, candidates, default: float, portal=None):
+    """candidates（(By, 値) の並び）のうち表示されている最初の要素を、最大 default 秒待って返す。
+    見つからなければ selenium の TimeoutException"""
+    key = _key(driver, name, portal)
+    candidates = ordered(key, candidates)
+    winner = _memo_entries().get(key, {}).get("winner")
+    with tracing.span("selector", target=name, candidates=len(candidates)) as s:
+        try:
+            candidate, element = timeouts.wait(driver, name, default, portal).until(lambda d: find(d, candidates))
+        except Exception:
+            _record(key)
+            raise
+        label = _label(candidate)
+        s["matched"] = label
+        s["memo"] = label == winner
+    _record(key, label)
+    return element
+
+
+def report():
+    """記録した候補の当たり率を表示する"""
+    entries = _read()
+    if not entries:
+        print(f"記録がありません（{_memo_path()}）")
+        return
+    for key, entry in sorted(entries.items()):
+        resolved, missed = entry.get("resolved", 0), entry.get("missed", 0)
+        total = resolved + missed
+        print(key)
+        if total:
+            print(f"  解決 {resolved}/{total}（{resolved / total:.0%}） / 記録した候補が当たり "
+                  f"{entry.get('memo_hits', 0)}/{resolved}")
+        for label, hits in sorted(entry.get("hits", {}).items(), key=lambda kv: -kv[1]):
+            mark = " ←" if label == entry.get("winner") else ""
+            print(f"    {hits:>5} {label}{mark}")
+
+
+if __name__ == "__main__":
+    report()
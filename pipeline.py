@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+"""
+依存関係つきステージ実行（ログイン → エクスポート → 検証 →（登録物件は差分抽出）→ アップロード）
+- ポータル × データセットごとのステージを DAG として定義し、依存が揃ったものから別プロセスで並列実行
+- エクスポートはポータルごとに1ステージ（全データセットのステップを1回の portal_runner.export で実行し、
+  結果をデータセットごとに分ける）。同時セッション数（shops.json の max_concurrency）はその中の
+  scheduler.py だけが適用する（ステージを並べてセッション数が掛け算にならないように）
+- 各ステージの入力と出力を .cache/pipeline/<run_id>.json に保存
+- 再実行時は「失敗した」「入力が変わった」ステージとその下流だけを実行する
+
+使い方:
+    python pipeline.py                       # 当日の run_id（YYYYMMDD）で実行／再実行
+    python pipeline.py --only goonet         # ポータルを限定
+    python pipeline.py --force carsensor.export
+    python pipeline.py --dry-run             # 実行せずに各ステージの状態だけ表示
+
+登録物件（全件スナップショット）は delta ステージで前回との差分（_delta.csv）を作る（snapshot_delta.py）。
+DELTA_UPLOAD_ONLY=true なら差分と、週1回（DELTA_FULL_DAYS）の全件だけをアップロードする。
+
+アップロードはエクスポートと並行して行う（PIPELINE_STREAM=false で従来どおりステージ順）
+- export ステージは、店舗ごとのジョブが終わるたびにファイルを検証（登録物件は差分抽出）し、
+  上限つきのキュー（STREAM_QUEUE_SIZE）に入れる。アップロード担当のスレッド（DRIVE_UPLOAD_WORKERS 本）が
+  キューから順に送る（キューが一杯ならスクレイパー側が空きを待つ）
+- 検証・差分抽出・アップロードの結果は export ステージの出力（データセットごとの stream）に残し、
+  validate / delta ステージはそれを引き継ぐ
+- upload ステージは、エクスポート中に送れなかったファイルだけをアップロードする（再実行時も同じ）
+
+ログインステージは Cookie をセッションキャッシュ（session_cache.py）に保存し、
+後続のエクスポートステージ（別プロセス）がそれを復元して使う。
+"""
+
+import argparse
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+import session_cache
+import shops
+import tracing
+
+# ステージの実装を変えたら上げる（保存済みの結果を無効にする）
+STAGE_VERSION = 5
+
+# エクスポート中のアップロード待ちのファイル数の上限（これを超えるとスクレイパーが待つ）
+STREAM_QUEUE_SIZE = max(1, int(os.getenv("STREAM_QUEUE_SIZE", "4")))
+
+# 差分を取るデータセット（全件スナップショット）
+DELTA_DATASETS = ("carsensor_registration", "goonet_registration")
+
+# ポータルにログインするステージ（同じポータルでは1つずつ。export の中の同時セッション数は scheduler.py が決める）
+SESSION_STAGES = ("login", "export")
+
+
+def portal_datasets():
+    """ポータル → データセット → エクスポートのステップ（店舗は shops.json。import 時には読まない）"""
+    return {
+        portal: {f"{portal}_{export}": shops.steps(portal, export) for export in shops.exports(portal)}
+        for portal in shops.portals()
+    }
+
+
+def to_bool(v, default=False):
+    if v is None:
+        return default
+    return str(v).strip().lower() in ("1", "true", "yes", "on")
+
+
+def build_graph(portals=None):
+    """ステージ（ノード）の一覧を依存順に返す"""
+    nodes = []
+    for portal, datasets in portal_datasets().items():
+        if portals and portal not in portals:
+            continue
+        login = f"{portal}.login"
+        export = f"{portal}.export"
+        nodes.append({"name": login, "stage": "login", "portal": portal, "deps": []})
+        # 全データセットを1つのステージ（1つのワーカープール）でエクスポートする
+        nodes.append({"name": export, "stage": "export", "portal": portal,
+                      "datasets": {dataset: list(steps) for dataset, steps in datasets.items()},
+                      "stream": to_bool(os.getenv("PIPELINE_STREAM"), True),
+                      "upload_only_delta": to_bool(os.getenv("DELTA_UPLOAD_ONLY")), "deps": [login]})
+        for dataset in datasets:
+            short = dataset.split("_", 1)[1]
+            validate = f"{portal}.{short}.validate"
+            upload = f"{portal}.{short}.upload"
+            nodes.append({"name": validate, "stage": "validate", "portal": portal, "dataset": dataset,
+                          "deps": [export]})
+            before_upload = validate
+            if dataset in DELTA_DATASETS:
+                before_upload = f"{portal}.{short}.delta"
+                nodes.append({"name": before_upload, "stage": "delta", "portal": portal, "dataset": dataset,
+                              "upload_only_delta": to_bool(os.getenv("DELTA_UPLOAD_ONLY")), "deps": [validate]})
+            nodes.append({"name": upload, "stage": "upload", "portal": portal, "dataset": dataset,
+                          "deps": [before_upload]})
+    return nodes
+
+
+# ===================== ステージ実装（子プロセスで実行） =====================
+
+def stage_login(node, inputs):
+    if node["portal"] == "carsensor":
+        import carsensor_download
+        settings = carsensor_download.load_settings()
+        if settings["CARSENSOR_HTTP"]:
+            import carsensor_http
+            session = carsensor_http.new_session()
+            try:
+                carsensor_http.login(session, settings["CARSENSOR_USERNAME"], settings["CARSENSOR_PASSWORD"])
+            finally:
+                session.close()
+            return {"via": "http", "at": time.time()}
+        driver = carsensor_download.build_driver(Path(settings["DOWNLOAD_DIR"]), settings["HEADLESS"])
+        try:
+            carsensor_download.login_carsensor(driver, settings["CARSENSOR_USERNAME"], settings["CARSENSOR_PASSWORD"])
+        finally:
+            driver.quit()
+        return {"via": "selenium", "at": time.time()}
+
+    import goonet_download
+    import goonet_bukken
+    settings = goonet_download.load_settings()
+    driver = goonet_bukken.build_driver(str(Path(settings["DOWNLOAD_DIR"]).resolve()), settings["HEADLESS"])
+    try:
+        goonet_download.login_goonet(driver, settings["GOONET_USERNAME"], settings["GOONET_PASSWORD"])
+    finally:
+        driver.quit()
+    return {"via": "selenium", "at": time.time()}
+
+
+def stage_export(node, inputs):
+    """ポータルの全データセットを1回の portal_runner.export で取得し、データセットごとの出力
+    {"datasets": {データセット: {"files": [...], "stream": {...}}}} を返す"""
+    import portal_runner
+    steps = [step for dataset_steps in node["datasets"].values() for step in dataset_steps]
+    with contextlib.ExitStack() as stack:
+        on_result, streamed = None, None
+        if node.get("stream"):
+            on_result, streamed = stack.enter_context(upload_stream(node["upload_only_delta"]))
+        with tracing.span("portal", portal=node["portal"]):
+            results, failures = portal_runner.export((node["portal"],), steps, on_result=on_result)
+    outputs = {}
+    for dataset, dataset_steps in node["datasets"].items():
+        files = [str(Path(p).resolve()) for step in dataset_steps for p in results.get(step, [])]
+        outputs[dataset] = {"files": files}
+        if streamed is not None:
+            outputs[dataset]["stream"] = streamed.get(dataset, {"validated": [], "upload": [], "uploaded": {}})
+    total = sum(len(o["files"]) for o in outputs.values())
+    if failures:
+        raise RuntimeError(f"エクスポートに失敗: {', '.join(failures)}（取得済み {total}件）")
+    empty = [dataset for dataset, o in outputs.items() if not o["files"]]
+    if empty:
+        raise RuntimeError(f"エクスポートされたファイルがありません: {', '.join(empty)}")
+    return {"datasets": outputs}
+
+
+def sha256_of(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def validate_export_file(path: Path):
+    """CSV として最低限の形になっているか確認する。問題があれば RuntimeError"""
+    if not path.exists():
+        raise RuntimeError(f"ファイルがありません: {path}")
+    size = path.stat().st_size
+    if size == 0:
+        raise RuntimeError(f"空のファイルです: {path.name}")
+    with open(path, "rb") as f:
+        head = f.read(4096)
+    if head.lstrip().lower().startswith((b"<!doctype", b"<html")):
+        raise RuntimeError(f"CSV ではなく HTML が保存されています: {path.name}")
+    first_line = head.splitlines()[0] if head else b""
+    if b"," not in first_line and b"\t" not in first_line:
+        raise RuntimeError(f"ヘッダー行に区切り文字がありません: {path.name}")
+    return {"path": str(path), "size": size, "sha256": sha256_of(path)}
+
+
+def stage_validate(node, inputs):
+    (export_outputs,) = inputs.values()
+    export_outputs = export_outputs["datasets"][node["dataset"]]
+    if "stream" in export_outputs:
+        # エクスポート中に検証済み（アップロード済みのファイルは消えている）
+        return {"files": export_outputs["stream"]["validated"], "stream": export_outputs["stream"]}
+    checked = [validate_export_file(Path(p)) for p in export_outputs["files"]]
+    return {"files": checked}
+
+
+def delta_files(dataset: str, validated: dict, upload_only_delta: bool):
+    """全件ファイル1つ（validate_export_file の結果）の差分を作り、アップロードするファイル（同じ形式）の一覧を返す。
+    差分のみアップロードする場合は、全件ファイルをダウンロード先から消す（.cache/snapshots に残る）"""
+    import snapshot_delta
+    path = Path(validated["path"])
+    result = snapshot_delta.extract(dataset, path)
+    files = []
+    if result["delta"]:
+        files.append(validate_export_file(result["delta"]))
+    if result["full_due"] or not upload_only_delta:
+        files.append(validated)
+    else:
+        path.unlink()
+        print(f"[DELTA] 全件ファイルはアップロードしません（差分のみ）: {path.name}")
+    return files
+
+
+def prepare_files(dataset: str, files, upload_only_delta: bool):
+    """エクスポートしたファイルを検証（登録物件は差分抽出）し、(検証結果, アップロードするファイル) を返す。
+    問題があれば RuntimeError"""
+    import export_store
+    checked = [validate_export_file(Path(p)) for p in files]
+    if dataset not in DELTA_DATASETS:
+        return checked, checked
+    # 差分のみアップロードする場合は全件ファイルを消すため、先にローカルの蓄積へ取り込む
+    export_store.ingest_files([Path(f["path"]) for f in checked])
+    return checked, [d for f in checked for d in delta_files(dataset, f, upload_only_delta)]
+
+
+@contextlib.contextmanager
+def upload_stream(upload_only_delta: bool, workers: int = None, queue_size: int = None):
+    """エクスポートと並行してアップロードする。(on_result, streamed) を返す。
+    on_result(job, files) はスクレイパーのスレッドから呼ぶ（scheduler.run）。ファイルを検証・差分抽出し、
+    上限つきのキューに入れる（一杯なら空くまで待つ）。アップロード担当のスレッドがキューから順に送る。
+    streamed: {データセット: {"validated": [...], "upload": [...], "uploaded": {パス: ファイルID or None}}}
+    （送れなかったファイルは uploaded に入らず、upload ステージで送り直す）。
+    終了時はキューに残った分を送り終えるまで待つ。中断時は送信中の分だけ送り、未着手の分は送らない"""
+    import toGoogleDrive
+    workers = max(1, workers or toGoogleDrive.UPLOAD_WORKERS)
+    # 認証はこのスレッドで1回だけ（各アップロードスレッドはこの認証情報で自分の service を作る）
+    try:
+        toGoogleDrive.authenticate_google_drive()
+    except Exception as e:
+        # エクスポートは止めない（アップロードは upload ステージで行う）
+        print(f"[STREAM] Google Drive の認証に失敗したため、エクスポート中のアップロードは行いません: {e}")
+        workers = 0
+    uploads = queue.Queue(maxsize=queue_size or STREAM_QUEUE_SIZE)
+    aborted = threading.Event()
+    lock = threading.Lock()
+    streamed = {}
+    done = object()
+
+    def uploader():
+        while True:
+            item = uploads.get()
+            try:
+                if item is done:
+                    return
+                if aborted.is_set():
+                    continue  # 中断時は未着手の分を送らない
+                dataset, path, step = item
+                try:
+                    fid = toGoogleDrive.upload_file(dataset, Path(path))
+                except Exception as e:
+                    print(f"[STREAM] アップロード失敗（upload ステージで再送）: {Path(path).name}（{step}）| {e}")
+                    continue
+                with lock:
+                    streamed[dataset]["uploaded"][path] = fid
+            finally:
+                uploads.task_done()
+
+    def on_result(job, files):
+        dataset = f"{job['portal']}_{job['export']}"
+        checked, to_upload = prepare_files(dataset, files, upload_only_delta)
+        with lock:
+            entry = streamed.setdefault(dataset, {"validated": [], "upload": [], "uploaded": {}})
+            entry["validated"].extend(checked)
+            entry["upload"].extend(to_upload)
+        for f in (to_upload if threads else ()):
+            started = time.perf_counter()
+            with tracing.span("stream.enqueue", job=job["name"], file=Path(f["path"]).name, queued=uploads.qsize()):
+                uploads.put((dataset, f["path"], job["name"]))
+            waited = time.perf_counter() - started
+            if waited >= 1:
+                print(f"[STREAM] アップロード待ちが一杯のため {waited:.1f}秒 待ちました: {Path(f['path']).name}")
+
+    threads = [threading.Thread(target=uploader, name=f"uploader-{i + 1}", daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+    if threads:
+        print(f"[STREAM] エクスポートと並行してアップロードします（{workers} 並列 / 待ち行列 {uploads.maxsize} 件）")
+    try:
+        yield on_result, streamed
+    except BaseException:
+        aborted.set()
+        raise
+    finally:
+        # 終了の印を入れ、キューに残った分（中断時は送信中の分だけ）を送り終えるまで待つ
+        for _ in threads:
+            uploads.put(done)
+        for t in threads:
+            t.join()
+
+
+def stage_delta(node, inputs):
+    """前回のスナップショットとの差分ファイルを作り、アップロードするファイルの一覧を返す"""
+    import export_store
+    (validated,) = inputs.values()
+    if "stream" in validated:
+        # エクスポート中に差分抽出済み
+        return {"files": validated["stream"]["upload"], "stream": validated["stream"]}
+    # 差分のみアップロードする場合は全件ファイルをここで消すため、先にローカルの蓄積へ取り込む
+    export_store.ingest_files([Path(f["path"]) for f in validated["files"]])
+    files = []
+    for f in validated["files"]:
+        files.extend(delta_files(node["dataset"], f, node["upload_only_delta"]))
+    return {"files": files}
+
+
+def stage_upload(node, inputs):
+    import toGoogleDrive
+    (validated,) = inputs.values()
+    # エクスポート中にアップロード済みのファイルは送らない（送れなかった分だけ送り直す）
+    streamed = validated.get("stream", {}).get("uploaded", {})
+    ids = [fid for fid in streamed.values() if fid]
+    paths = [Path(f["path"]) for f in validated["files"] if f["path"] not in streamed]
+    if streamed and not paths:
+        print(f"[STREAM] {len(streamed)} 件はエクスポート中にアップロード済みです")
+        return {"uploaded": ids}
+    service = toGoogleDrive.authenticate_google_drive()
+    missing = [p.name for p in paths if not p.exists()]
+    if missing:
+        raise RuntimeError(f"アップロード対象がありません: {', '.join(missing)}")
+    ids += toGoogleDrive.upload_dataset_files(service, node["dataset"], paths)
+    return {"uploaded": ids}
+
+
+STAGES = {
+    "login": stage_login,
+    "export": stage_export,
+    "validate": stage_validate,
+    "delta": stage_delta,
+    "upload": stage_upload,
+}
+
+
+def run_node(node, inputs):
+    """子プロセスのエントリポイント。(status, outputs or error, 所要秒) を返す"""
+    started = time.time()
+    print(f"\n>>> [{node['name']}] 開始")
+    try:
+        with tracing.span(f"stage.{node['stage']}", node=node["name"]):
+            outputs = STAGES[node["stage"]](node, inputs)
+        print(f"<<< [{node['name']}] 完了 ({time.time() - started:.1f}秒)")
+        return "ok", outputs, time.time() - started
+    except Exception as e:
+        print(f"<<< [{node['name']}] 失敗: {e}")
+        print(traceback.format_exc())
+        return "failed", f"{type(e).__name__}: {e}", time.time() - started
+
+
+# ===================== 状態の保存 =====================
+
+def state_path(run_id: str) -> Path:
+    return session_cache.cache_dir() / "pipeline" / f"{run_id}.json"
+
+
+def load_state(run_id: str):
+    path = state_path(run_id)
+    if path.exists():
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"状態ファイルを読み込めません（最初から実行）: {e}")
+    return {"run_id": run_id, "nodes": {}}
+
+
+def save_state(state):
+    path = state_path(state["run_id"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def fingerprint(node, inputs) -> str:
+    payload = {"version": STAGE_VERSION, "node": {k: v for k, v in node.items() if k != "deps"}, "inputs": inputs}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def outputs_available(node, record, records) -> bool:
+    """保存済み出力のファイルがまだ使えるか（アップロード済み・差分抽出済みなら削除されていてよい）"""
+    if node["stage"] not in ("export", "validate", "delta"):
+        return True
+    outputs = record.get("outputs", {})
+    if node["stage"] == "export":
+        # データセットごとに、下流で使い終わったか・ファイルが残っているか
+        return all(_files_available(f"{node['portal']}.{dataset.split('_', 1)[1]}", "export", dataset_outputs, records)
+                   for dataset, dataset_outputs in outputs.get("datasets", {}).items())
+    return _files_available(node["name"].rsplit(".", 1)[0], node["stage"], outputs, records)
+
+
+def _files_available(prefix: str, stage: str, outputs: dict, records) -> bool:
+    consumers = (f"{prefix}.upload",) if stage == "delta" else (f"{prefix}.delta", f"{prefix}.upload")
+    if any(records.get(name, {}).get("status") == "ok" for name in consumers):
+        return True
+    streamed = outputs.get("stream")
+    if streamed:
+        # エクスポート中にアップロード・差分抽出したファイルは消えていてよい（送れなかった分が残っていればよい）
+        return all(f["path"] in streamed["uploaded"] or Path(f["path"]).exists() for f in streamed["upload"])
+    files = outputs.get("files", [])
+    return all(Path(f["path"] if isinstance(f, dict) else f).exists() for f in files)
+
+
+def is_fresh(node, inputs, records, force) -> bool:
+    record = records.get(node["name"])
+    return (node["name"] not in force
+            and record is not None
+            and record.get("status") == "ok"
+            and record.get("inputs_hash") == fingerprint(node, inputs)
+            and outputs_available(node, record, records))
+
+
+# ===================== 実行 =====================
+
+def execute(nodes, state, workers: int = 4, force=(), dry_run: bool = False):
+    """依存が揃ったノードから並列実行する。失敗したノード名のリストを返す"""
+    records = state["nodes"]
+    pending = {n["name"]: n for n in nodes}
+    by_name = dict(pending)
+    succeeded, failed, will_run = set(), set(), set()
+    running = {}
+
+    def inputs_for(node):
+        return {d: records[d]["outputs"] for d in node["deps"]}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for name, node in list(pending.items()):
+                if any(d in failed for d in node["deps"]):
+                    print(f"--- [{name}] 上流が失敗したためスキップ")
+                    records[name] = {**records.get(name, {}), "status": "blocked"}
+                    failed.add(name)
+                    del pending[name]
+                    continue
+                if not all(d in succeeded for d in node["deps"]):
+                    continue
+                if node["stage"] in SESSION_STAGES and any(
+                        by_name[n]["stage"] in SESSION_STAGES and by_name[n]["portal"] == node["portal"]
+                        for n in running.values()):
+                    # 同じポータルのログイン・エクスポートは1つずつ（エクスポート内の同時セッション数は
+                    # scheduler.py が max_concurrency で決める。ここでも並べると掛け算になる）
+                    continue
+                del pending[name]
+                if dry_run and any(d in will_run for d in node["deps"]):
+                    print(f"--- [{name}] 実行対象（上流を再実行するため）")
+                    will_run.add(name)
+                    succeeded.add(name)
+                    continue
+                inputs = inputs_for(node)
+                if is_fresh(node, inputs, records, force):
+                    print(f"--- [{name}] 保存済みの結果を使用")
+                    succeeded.add(name)
+                    continue
+                if dry_run:
+                    print(f"--- [{name}] 実行対象")
+                    will_run.add(name)
+                    succeeded.add(name)
+                    continue
+                records[name] = {"status": "running", "inputs_hash": fingerprint(node, inputs),
+                                 "started_at": time.time()}
+                running[pool.submit(run_node, node, inputs)] = name
+
+            if not running:
+                # 残りは依存が解決できないノード（定義ミス）
+                failed.update(pending)
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    status, result, elapsed = future.result()
+                except Exception as e:
+                    status, result, elapsed = "failed", f"{type(e).__name__}: {e}", 0.0
+                record = records[name]
+                record.update({"status": status, "finished_at": time.time(), "seconds": round(elapsed, 2)})
+                if status == "ok":
+                    record["outputs"] = result
+                    record.pop("error", None)
+                    succeeded.add(name)
+                else:
+                    record["error"] = result
+                    record.pop("outputs", None)
+                    failed.add(name)
+                if not dry_run:
+                    save_state(state)
+    return sorted(failed)
+
+
+def print_summary(nodes, state):
+    print("\n=== ステージ一覧 ===")
+    for node in nodes:
+        record = state["nodes"].get(node["name"], {})
+        seconds = f"{record['seconds']:.1f}秒" if "seconds" in record else ""
+        print(f"{record.get('status', '-'):>8}  {node['name']:<36} {seconds}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ログイン → エクスポート → 検証 → 差分抽出 → アップロードの DAG 実行")
+    parser.add_argument("--run-id", default=datetime.date.today().strftime("%Y%m%d"),
+                        help="状態を共有する実行ID（既定: 当日の日付）")
+    parser.add_argument("--only", nargs="*", choices=shops.portals(), help="対象ポータル")
+    parser.add_argument("--force", nargs="*", default=[], help="保存済みの結果を使わずに実行するステージ名")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("PIPELINE_WORKERS", "4")),
+                        help="同時実行プロセス数")
+    parser.add_argument("--dry-run", action="store_true", help="実行せずに状態だけ表示")
+    args = parser.parse_args(argv)
+
+    nodes = build_graph(args.only)
+    state = load_state(args.run_id)
+    # 計測（tracing）の trace_id を run_id に揃える（ワーカープロセスへは環境変数で引き継がれる）
+    tracing.TRACE_ID = os.environ["TRACE_ID"] = str(args.run_id)
+    print(f"=== パイプライン実行 (run_id={args.run_id}, workers={args.workers}) ===")
+    failed = execute(nodes, state, workers=args.workers, force=set(args.force), dry_run=args.dry_run)
+    print_summary(nodes, state)
+
+    if failed and not args.dry_run:
+        print(f"\n[ERROR] 失敗したステージ: {', '.join(failed)}")
+        print("同じ run_id で再実行すると、失敗したステージと下流だけが実行されます。")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+ポータル単位の一括実行
+- 店舗・ポータルは shops.json（shops.py）で定義する
+- エクスポート（ポータル × 店舗 × 種類）をジョブとして scheduler.py のワーカーに振り分ける
+  （ワーカー = ログイン済みセッション1つ。全体で SCHEDULER_WORKERS、ポータルごとに max_concurrency まで同時実行）
+- カーセンサー: counter/byVehicle（アクセス数）＋ vehicles/registrationList（登録物件数）
+  （HTTP で直接取得し、失敗したものだけ Selenium で取得。店舗は「他店舗参照」で順に切り替える）
+- グーネット: ana/stockeffect（店舗ごとのアクセス数）＋ group/stock/search（登録物件数）
+- 取得したファイルは DOWNLOAD_DIR/<ステップ名>/ に置く（例: downloads/carsensor.access_hiace/）
+
+使い方:
+    python portal_runner.py carsensor
+    python portal_runner.py goonet
+    python portal_runner.py            # 両方（ポータルをまたいで並列）
+"""
+
+import contextlib
+import sys
+from pathlib import Path
+
+import carsensor_download
+import download_events
+import driver_factory
+import carsensor_http
+import carsensor_bukken
+import goonet_download
+import goonet_bukken
+import scheduler
+import session_cache
+import shops
+import tracing
+
+
+# ===================== ワーカー（ログイン済みセッション） =====================
+
+@contextlib.contextmanager
+def carsensor_worker(settings):
+    """カーセンサーのワーカー。ジョブ（店舗 × 種類）を HTTP で取得し、取れなければ Selenium で取り直す。
+    店舗はセッション単位で切り替わるため、表示中の店舗を覚えて切替を最小にする（既定の店舗には戻れない）。
+    キャッシュの Cookie を使うのは同時に1ワーカーだけ（session_cache.lease）。他のワーカーはそれぞれ
+    新しくログインするので、店舗の切替がワーカー間で混ざらない"""
+    with session_cache.lease("carsensor") as cached:
+        with _carsensor_session(settings, cached) as handle:
+            yield handle
+
+
+@contextlib.contextmanager
+def _carsensor_session(settings, cached: bool):
+    download_dir = Path(settings["DOWNLOAD_DIR"])
+    default = next((shop["id"] for shop in shops.shops("carsensor") if shop.get("default")), None)
+    state = {"session": None, "http": settings["CARSENSOR_HTTP"], "http_store": default,
+             "driver": None, "driver_store": default, "switched": False}
+
+    def ensure_store(key: str, shop, switch):
+        if state[key] == shop["id"]:
+            return
+        if shop.get("default"):
+            raise RuntimeError(f"このセッションでは既定の店舗（{shop['name']}）に戻せません")
+        state[key] = None  # 切替に失敗した場合は表示中の店舗が分からない
+        state["switched"] = True
+        switch(shop["switch"])
+        state[key] = shop["id"]
+
+    def http_export(job):
+        if state["session"] is None:
+            state["session"] = carsensor_http.new_session()
+            try:
+                carsensor_http.login(state["session"], settings["CARSENSOR_USERNAME"], settings["CARSENSOR_PASSWORD"],
+                                     cached=cached)
+            except Exception:
+                state["http"] = False  # ログインできなければ、以降のジョブも Selenium で取得する
+                raise
+        session = state["session"]
+        ensure_store("http_store", job["shop"],
+                     lambda texts: carsensor_http.switch_store(session, carsensor_http.ACCESS_URL, texts))
+        return [carsensor_http.export(session, job["export"], job["shop"],
+                                      download_events.job_dir(download_dir, job["name"]))]
+
+    def selenium_export(job):
+        if state["driver"] is None:
+            # HTTP 側で店舗を切り替えた後は、Cookie を共有する Selenium 側の表示中の店舗が分からない
+            # （キャッシュを使わないワーカーの Selenium は新しいセッションなので既定の店舗から）
+            state["driver_store"] = None if state["switched"] and cached else default
+            state["driver"] = carsensor_download.build_driver(download_dir, settings["HEADLESS"])
+            carsensor_download.login_carsensor(state["driver"], settings["CARSENSOR_USERNAME"],
+                                               settings["CARSENSOR_PASSWORD"], cached=cached)
+        driver, shop = state["driver"], job["shop"]
+        ensure_store("driver_store", shop, lambda texts: carsensor_download.switch_store(driver, texts))
+        if job["export"] == "access":
+            files = carsensor_download.download_access_counts(driver, download_dir, shop["name"], job["name"])
+        else:
+            files = carsensor_bukken.download_registration_list(driver, download_dir, shop["name"], job["name"])
+        return carsensor_download.rename_for_shop(files, shop)
+
+    def handle(job):
+        if state["http"]:
+            try:
+                return http_export(job)
+            except Exception as e:
+                print(f"[{job['name']}] HTTP での取得に失敗（Selenium で取り直します）: {e}")
+        return selenium_export(job)
+
+    try:
+        yield handle
+    finally:
+        if state["session"] is not None:
+            state["session"].close()
+        if state["driver"] is not None:
+            driver_factory.report_lean(state["driver"])
+            state["driver"].quit()
+        if state["switched"] and cached:
+            # 店舗を切り替えたセッションを次のワーカーに引き継がない（次回は既定の店舗からログインし直す）
+            session_cache.clear("carsensor")
+
+
+@contextlib.contextmanager
+def goonet_worker(settings):
+    """グーネットのワーカー。専用の Chrome セッションで店舗のエクスポートを順に実行する"""
+    download_dir = Path(settings["DOWNLOAD_DIR"]).expanduser().resolve()
+    with goonet_download.own_session(settings, download_dir) as driver:
+        def handle(job):
+            if job["export"] == "access":
+                return [goonet_download.export_shop_in_session(driver, job["shop"], download_dir, job["name"])]
+            return goonet_bukken.download_stock_search(driver, download_dir, job["name"])
+        yield handle
+
+
+WORKERS = {
+    "carsensor": (carsensor_download.load_settings, carsensor_worker),
+    "goonet": (goonet_download.load_settings, goonet_worker),
+}
+
+
+# ===================== 実行 =====================
+
+def export(portals, steps=None, settings=None, on_result=None):
+    """portals のエクスポートを実行する（steps で対象ステップを限定可能）。
+    on_result(job, files) はジョブが終わるたびに呼ぶ（scheduler.run）。
+    戻り値: (results {ステップ名: [Path, ...]}, failures [失敗したステップ名])"""
+    settings = dict(settings or {})
+    jobs, limits = [], {}
+    for portal in portals:
+        if portal not in settings:
+            settings[portal] = WORKERS[portal][0]()
+        jobs.extend(shops.jobs(portal, steps))
+        limits[portal] = shops.limit(portal)
+    if "goonet" in limits:
+        limits["goonet"] = settings["goonet"]["GOONET_MAX_WORKERS"]
+    workers = shops.max_workers()
+    print(f"=== エクスポート {len(jobs)}件（同時 {workers} セッション / "
+          + ", ".join(f"{p}: {n}" for p, n in limits.items()) + "）===")
+
+    def open_worker(portal):
+        return WORKERS[portal][1](settings[portal])
+
+    return scheduler.run(jobs, open_worker, workers=workers, limits=limits, on_result=on_result)
+
+
+@tracing.traced("portal", portal="carsensor")
+def export_carsensor(settings, steps=None):
+    """カーセンサーのエクスポートを実行。(results, failures) を返す"""
+    return export(("carsensor",), steps, {"carsensor": settings})
+
+
+@tracing.traced("portal", portal="goonet")
+def export_goonet(settings, steps=None):
+    """グーネットのエクスポートを実行。(results, failures) を返す"""
+    return export(("goonet",), steps, {"goonet": settings})
+
+
+def main(argv=None):
+    portals = shops.portals()
+    names = (argv if argv is not None else sys.argv[1:]) or portals
+    unknown = [n for n in names if n not in portals]
+    if unknown:
+        print(f"不明なポータル: {', '.join(unknown)}（指定可能: {', '.join(portals)}）")
+        return 2
+
+    with tracing.span("portals", portals=",".join(names)):
+        _, failures = export(names)
+
+    if failures:
+        print(f"\n[ERROR] 失敗したステップ: {', '.join(failures)}")
+        return 1
+    print("\n[OK] すべてのエクスポートが完了しました")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+ポータルのローカル代替サーバー（計測・回帰確認用）
+- 本番の c-match.carsensor.net / motorgate.jp にアクセスせずに各スクリプトを動かすための最小限の画面
+- カーセンサー（/carsensor/）: loginId / passwordCd のログイン、他店舗参照（tatenpoBtn）→ ハイエース専門店、
+  counter/byVehicle・vehicles/registrationList の「ダウンロード」
+- グーネット（/goonet/）: client_id / client_pw のログイン、ana/stockeffect の SelectGroupShop → 検索 → エクスポート、
+  group/stock/search の frm フォーム → /group/stock/search/csv への POST
+- 応答の遅延（--latency）、エクスポート生成の待ち（--export-delay）、ファイルサイズ（--file-size）、帯域（--bandwidth）を指定可能
+- 各画面は本番と同様に画像・フォント・第三者の解析タグ（localhost 側から配信）を読み込む（--asset-size、0 で無し）
+
+使い方:
+    python portal_stub.py --port 8765 --latency 200 --file-size 512
+    # 別のターミナルで
+    CARSENSOR_BASE_URL=http://127.0.0.1:8765/carsensor/ GOONET_BASE_URL=http://127.0.0.1:8765/goonet/ python portal_runner.py
+"""
+
+import argparse
+import datetime
+import secrets
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+CARSENSOR = "/carsensor/"
+GOONET = "/goonet/"
+
+CARSENSOR_COOKIE = "CS_SESSION"
+GOONET_COOKIE = "GN_SESSION"
+
+# カーセンサーの店舗（他店舗参照で切り替えられる店舗）
+CARSENSOR_STORES = {
+    "main": "本店",
+    "hiace": "ハイエース専門店　ＣＡＲ　ＰＲＯＤＵＣＥ",
+}
+
+# グーネットの店舗（SelectGroupShop の選択肢）
+GOONET_SHOPS = {
+    "1000001": "本店",
+    "1000491": "ハイエース専門店　ＣＡＲ　ＰＲＯＤＵＣＥ　｜　カープロデュース",
+    "1002529": "輸入車専門店　ＣＡＲＡＤ",
+}
+
+# エクスポートの列（実ファイルの主要な列のみ）
+CSV_HEADERS = {
+    "carsensor_access": ["物件管理番号", "車名", "グレード", "本体価格", "詳細閲覧数", "お気に入り数", "問い合わせ数"],
+    "carsensor_registration": ["物件管理番号", "車名", "年式", "走行距離", "本体価格", "掲載開始日", "掲載状態"],
+    "goonet_access": ["在庫ID", "車名", "本体価格", "一覧表示回数", "詳細表示回数", "お気に入り登録数", "問い合わせ数"],
+    "goonet_registration": ["在庫ID", "メーカー", "車種", "年式", "走行距離", "本体価格", "登録日"],
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def make_csv(kind: str, shop: str, size: int) -> bytes:
+    """size バイト程度の CSV（cp932・CRLF）を作る。同じ引数なら同じ内容"""
+    today = datetime.date.today().strftime("%Y/%m/%d")
+    lines = [",".join(CSV_HEADERS[kind])]
+    total = len(lines[0].encode("cp932")) + 2
+    i = 0
+    while total < size:
+        i += 1
+        key = f"{shop[:4].upper()}{i:06d}"
+        if kind == "carsensor_access":
+            row = [key, "ハイエースバン", "スーパーGL", str(2000000 + i * 1000), str(i % 300), str(i % 20), str(i % 5)]
+        elif kind == "carsensor_registration":
+            row = [key, "ハイエースバン", str(2015 + i % 9), str(10000 + i * 37), str(2000000 + i * 1000), today, "掲載中"]
+        elif kind == "goonet_access":
+            row = [key, "ハイエースワゴン", str(3000000 + i * 1000), str(i % 900), str(i % 300), str(i % 20), str(i % 5)]
+        else:
+            row = [key, "トヨタ", "ハイエース", str(2015 + i % 9), str(10000 + i * 37), str(3000000 + i * 1000), today]
+        line = ",".join(row)
+        lines.append(line)
+        total += len(line.encode("cp932")) + 2
+    return ("\r\n".join(lines) + "\r\n").encode("cp932")
+
+
+def page(title: str, body: str, script: str = "", head: str = "") -> bytes:
+    return (
+        "<!DOCTYPE html><html lang=\"ja\"><head><meta charset=\"utf-8\">"
+        f"<title>{title}</title>{head}"
+        + (f"<script>{script}</script>" if script else "")
+        + f"</head><body>{body}</body></html>"
+    ).encode("utf-8")
+
+
+# 画面が読み込む資源（パス → Content-Type）。analytics.js は別ホスト（localhost）から配信する
+ASSETS = {
+    "/static/site.css": "text/css",
+    "/static/banner.png": "image/png",
+    "/static/stub.woff2": "font/woff2",
+    "/tag/analytics.js": "text/javascript",
+}
+
+
+def make_asset(path: str, size: int) -> bytes:
+    if path.endswith(".css"):
+        return (b"@font-face{font-family:stub;src:url(/static/stub.woff2) format('woff2')}"
+                b"body{font-family:stub,sans-serif}")
+    if path.endswith(".js"):
+        return b"/*" + b"a" * max(size // 4 - 4, 0) + b"*/"
+    header = b"\x89PNG\r\n\x1a\n" if path.endswith(".png") else b"wOF2"
+    return header + b"\0" * max(size - len(header), 0)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "PortalStub/1.0"
+    # ヘッダーと本文を別々に書くため、Nagle による 40ms 程度の遅延が計測に混ざらないようにする
+    disable_nagle_algorithm = True
+
+    # ----- 共通 -----
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _count(self, key, n=1):
+        with self.server.lock:
+            self.server.stats[key] = self.server.stats.get(key, 0) + n
+
+    def _send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        # クライアントが受信し終える前に数える（直後に stats を読む計測側と競合しないように）
+        self._count("bytes_sent", len(body))
+        if self.command != "HEAD" and body:
+            self.wfile.write(body)
+
+    def _page(self, title, body, script=""):
+        """画面の HTML（資源の読み込みを含む）"""
+        head = ""
+        if self.server.asset_size:
+            port = self.server.server_address[1]
+            head = ('<link rel="stylesheet" href="/static/site.css">'
+                    f'<script async src="http://localhost:{port}/tag/analytics.js"></script>')
+            body = '<img src="/static/banner.png" alt="" width="1" height="1">' + body
+        return page(title, body, script, head)
+
+    def _asset(self, path):
+        self._count("assets")
+        self._send(200, make_asset(path, self.server.asset_size), ASSETS[path],
+                   {"Cache-Control": "max-age=3600", "Access-Control-Allow-Origin": "*"})
+
+    def _redirect(self, location, headers=None):
+        self._send(302, headers={"Location": location, **(headers or {})})
+
+    def _download(self, kind: str, shop: str, filename: str):
+        """エクスポート生成の待ち → 帯域制限付きで CSV を返す"""
+        if self.server.export_delay:
+            time.sleep(self.server.export_delay)
+        body = make_csv(kind, shop, self.server.file_size)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv; charset=Shift_JIS")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(filename)}")
+        self.end_headers()
+        self._count("downloads")
+        self._count("bytes_sent", len(body))
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / self.server.bandwidth)
+
+    def _form(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length).decode("utf-8", "replace") if length else ""
+        return {k: v[-1] for k, v in parse_qs(raw, keep_blank_values=True).items()}
+
+    def _session(self, cookie_name):
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        token = cookie[cookie_name].value if cookie_name in cookie else None
+        with self.server.lock:
+            return self.server.sessions.get(token)
+
+    def _new_session(self, cookie_name, data):
+        token = secrets.token_hex(16)
+        with self.server.lock:
+            self.server.sessions[token] = data
+        self._count("logins")
+        return {"Set-Cookie": f"{cookie_name}={token}; Path=/; HttpOnly"}
+
+    def _handle(self):
+        self._count("requests")
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path.startswith(CARSENSOR):
+            return self._carsensor(url.path[len(CARSENSOR):], query)
+        if url.path.startswith(GOONET):
+            return self._goonet(url.path[len(GOONET):], query)
+        if url.path in ASSETS and self.server.asset_size:
+            return self._asset(url.path)
+        self._send(404, self._page("Not Found", "<p>Not Found</p>"))
+
+    def do_GET(self):
+        self._handle()
+
+    def do_HEAD(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    # ----- カーセンサー -----
+
+    def _carsensor_header(self, session):
+        store = CARSENSOR_STORES[session["store"]]
+        return (f"<div class=\"header\"><span class=\"storeName\">{store}</span> "
+                f"<a id=\"tatenpoBtn\" href=\"{CARSENSOR}store/select/\">他店舗参照</a></div>")
+
+    def _carsensor(self, path, query):
+        if path == "login/":
+            if self.command == "POST":
+                form = self._form()
+                if form.get("loginId") and form.get("passwordCd"):
+                    cookie = self._new_session(CARSENSOR_COOKIE, {"store": "main"})
+                    return self._redirect(f"{CARSENSOR}counter/byVehicle/?login=true", cookie)
+                return self._redirect(f"{CARSENSOR}login/?error=1")
+            return self._send(200, self._page("ログイン", (
+                f"<form method=\"post\" action=\"{CARSENSOR}login/\">"
+                "<input type=\"text\" name=\"loginId\"> <input type=\"password\" name=\"passwordCd\">"
+                "<input type=\"submit\" id=\"sbtLogin\" name=\"sbtLogin\" value=\"ログイン\"></form>")))
+
+        session = self._session(CARSENSOR_COOKIE)
+        if session is None:
+            return self._redirect(f"{CARSENSOR}login/")
+
+        if path == "":
+            return self._redirect(f"{CARSENSOR}counter/byVehicle/")
+        if path == "counter/byVehicle/":
+            return self._send(200, self._page("物件別反響数", self._carsensor_header(session) + (
+                "<h1>物件別反響数</h1>"
+                f"<a class=\"btnDl\" href=\"{CARSENSOR}counter/byVehicle/download/\">CSVダウンロード</a>")))
+        if path == "counter/byVehicle/download/":
+            today = datetime.date.today().strftime("%Y%m%d")
+            return self._download("carsensor_access", session["store"], f"hankyobukken_{today}.csv")
+        if path == "vehicles/registrationList/":
+            return self._send(200, self._page("登録物件一覧", self._carsensor_header(session) + (
+                "<h1>登録物件一覧</h1>"
+                f"<form method=\"post\" action=\"{CARSENSOR}vehicles/registrationList/download/\">"
+                "<input type=\"hidden\" name=\"outputType\" value=\"csv\">"
+                "<button type=\"submit\" name=\"dlBtn\" value=\"1\">ダウンロード</button></form>")))
+        if path == "vehicles/registrationList/download/" and self.command == "POST":
+            self._form()
+            today = datetime.date.today().strftime("%Y%m%d")
+            return self._download("carsensor_registration", session["store"],
+                                  f"torokubukken_{session['store']}_{today}.csv")
+        if path == "store/select/":
+            links = "".join(f"<li><a href=\"{CARSENSOR}store/switch/?shop={key}\">{name}</a></li>"
+                            for key, name in CARSENSOR_STORES.items())
+            return self._send(200, self._page("他店舗参照", self._carsensor_header(session) + f"<ul>{links}</ul>"))
+        if path == "store/switch/" and query.get("shop") in CARSENSOR_STORES:
+            session["store"] = query["shop"]
+            return self._redirect(f"{CARSENSOR}counter/byVehicle/")
+        return self._send(404, self._page("Not Found", "<p>Not Found</p>"))
+
+    # ----- グーネット -----
+
+    def _goonet(self, path, query):
+        if path == "":
+            if self._session(GOONET_COOKIE) is not None:
+                return self._redirect(f"{GOONET}top")
+            return self._send(200, self._page("MOTOR GATE ログイン", (
+                f"<form method=\"post\" action=\"{GOONET}login\">"
+                "<input type=\"text\" id=\"client_id\" name=\"client_id\">"
+                "<input type=\"password\" name=\"client_pw\">"
+                "<button type=\"submit\" id=\"button01\">ログイン</button></form>")))
+        if path == "login" and self.command == "POST":
+            form = self._form()
+            if form.get("client_id") and form.get("client_pw"):
+                return self._redirect(f"{GOONET}top", self._new_session(GOONET_COOKIE, {}))
+            return self._redirect(GOONET)
+
+        session = self._session(GOONET_COOKIE)
+        if session is None:
+            return self._redirect(GOONET)
+
+        if path == "top":
+            return self._send(200, self._page("トップ", "<h1>MOTOR GATE</h1>"))
+        if path == "ana/stockeffect":
+            shop = query.get("group_shop_id")
+            options = "".join(
+                f"<option value=\"{value}\"{' selected' if value == shop else ''}>{name}</option>"
+                for value, name in GOONET_SHOPS.items())
+            body = (
+                "<h1>効果分析（在庫）</h1>"
+                f"<form id=\"searchForm\" method=\"get\" action=\"{GOONET}ana/stockeffect\">"
+                f"<select id=\"SelectGroupShop\" name=\"group_shop_id\">{options}</select>"
+                "<a href=\"javascript:click_stock_search_btn();\">検索</a></form>")
+            if shop in GOONET_SHOPS:
+                body += ("<table><tr><td>検索結果</td></tr></table>"
+                         "<a class=\"export\" href=\"javascript:void(0);\" onclick=\"export_stockeffect();\">"
+                         "検索結果をエクスポート</a>")
+            script = (
+                "function click_stock_search_btn(){document.getElementById('searchForm').submit();}"
+                "function export_stockeffect(){location.href='" + GOONET + "ana/stockeffect/export?group_shop_id='"
+                "+document.getElementById('SelectGroupShop').value;}")
+            return self._send(200, self._page("効果分析（在庫）", body, script))
+        if path == "ana/stockeffect/export" and query.get("group_shop_id") in GOONET_SHOPS:
+            return self._download("goonet_access", query["group_shop_id"], "効果分析（在庫）.csv")
+        if path == "group/stock/search":
+            return self._send(200, self._page("在庫検索", (
+                "<h1>在庫検索</h1>"
+                f"<form id=\"frm\" method=\"post\" action=\"{GOONET}group/stock/search/csv\">"
+                "<input type=\"text\" id=\"ac1\" name=\"keyword\" value=\"\">"
+                "<input type=\"hidden\" name=\"sort\" value=\"regist_date\">"
+                "<input type=\"hidden\" id=\"export_flg\" name=\"export_flg\" value=\"0\">"
+                "<ul class=\"menu\"><li class=\"export\"><a href=\"javascript:excel();\">エクスポート</a></li></ul>"
+                "</form>"),
+                "function excel(){document.getElementById('export_flg').value='1';document.getElementById('frm').submit();}"))
+        if path == "group/stock/search/csv" and self.command == "POST":
+            if self._form().get("export_flg") != "1":
+                return self._send(400, self._page("エラー", "<p>export_flg がありません</p>"))
+            return self._download("goonet_registration", "stock", "在庫検索一覧.csv")
+        return self._send(404, self._page("Not Found", "<p>Not Found</p>"))
+
+
+def make_server(host="127.0.0.1", port=0, latency=0.0, export_delay=0.0, file_size=64 * 1024,
+                bandwidth=0, verbose=False, asset_size=200 * 1024):
+    """代替サーバーを作る（port=0 なら空きポート）。latency / export_delay は秒、bandwidth はバイト/秒（0 で無制限）、
+    asset_size は画面が読み込む画像・フォント1つあたりのバイト数（0 で資源無し）"""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.export_delay = export_delay
+    server.file_size = file_size
+    server.bandwidth = bandwidth
+    server.verbose = verbose
+    server.asset_size = asset_size
+    server.sessions = {}
+    server.stats = {}
+    server.lock = threading.Lock()
+    return server
+
+
+def base_urls(server):
+    """スクリプトに渡す接続先（CARSENSOR_BASE_URL / GOONET_BASE_URL）"""
+    host, port = server.server_address[:2]
+    return {
+        "CARSENSOR_BASE_URL": f"http://{host}:{port}{CARSENSOR}",
+        "GOONET_BASE_URL": f"http://{host}:{port}{GOONET}",
+    }
+
+
+def start_in_thread(**kwargs):
+    """別スレッドで代替サーバーを起動し、サーバーを返す（停止は server.shutdown()）"""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, name="portal-stub", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ポータルのローカル代替サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="各応答の遅延（ミリ秒）")
+    parser.add_argument("--export-delay", type=float, default=0, help="エクスポート生成の待ち（ミリ秒）")
+    parser.add_argument("--file-size", type=int, default=64, help="エクスポートファイルのサイズ（KB）")
+    parser.add_argument("--bandwidth", type=int, default=0, help="ダウンロードの帯域（KB/秒、0 で無制限）")
+    parser.add_argument("--asset-size", type=int, default=200, help="画面の画像・フォントのサイズ（KB、0 で無し）")
+    parser.add_argument("--verbose", action="store_true", help="アクセスログを表示")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency / 1000, args.export_delay / 1000,
+                         args.file_size * 1024, args.bandwidth * 1024, args.verbose, args.asset_size * 1024)
+    print("代替サーバーを起動しました:")
+    for k, v in base_urls(server).items():
+        print(f"  {k}={v}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"停止しました: {server.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+エクスポート（ジョブ）の振り分け
+- ワーカー = ログイン済みのセッション1つ（Chrome または HTTP）。ポータルのジョブを順番に取り出して実行する
+- 同時に動くワーカーは全体で workers まで、ポータルごとに limits[portal] まで
+  （店舗の選択・切替はサーバー側のセッション単位。キャッシュの Cookie を使うのは1ワーカーだけ
+  （session_cache.lease）で、他のワーカーはそれぞれ新しくログインするため、ワーカー間で混ざらない。
+  既定はカーセンサー 1（ログイン1回で店舗を順に切替）、グーネット 2）
+- 空いた枠には残りジョブの多いポータルから順にワーカーを起動する（ポータルをまたいで並列に進む）
+- ワーカーを開けなかった（ログイン失敗等）ポータルは、残りのジョブを失敗として扱う
+- on_result(job, files) を渡すと、ジョブが終わるたびにそのワーカーのスレッドで呼ぶ
+  （例外はそのジョブの失敗。呼び出しが終わるまでワーカーは次のジョブに進まない）
+
+使い方:
+    @contextlib.contextmanager
+    def open_worker(portal):
+        driver = ...           # 起動・ログイン
+        try:
+            yield lambda job: export(driver, job)   # ジョブを実行し、取得したファイルの一覧を返す
+        finally:
+            driver.quit()
+
+    results, failures = scheduler.run(shops.jobs("goonet"), open_worker, workers=3, limits={"goonet": 2})
+"""
+
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import tracing
+
+
+def _drain(portal: str, jobs: queue.Queue, handle, results: dict, failures: list, lock, busy: dict,
+           on_result=None):
+    """ジョブが無くなるまで取り出して実行する（1ジョブの失敗では止めない）"""
+    while True:
+        with lock:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                return
+            busy[portal] += 1
+        try:
+            with tracing.span("job", portal=portal, job=job["name"]):
+                files = handle(job) or []
+            if on_result is not None:
+                on_result(job, files)
+            with lock:
+                results[job["name"]] = files
+            print(f"[{job['name']}] 取得ファイル数: {len(files)}")
+        except Exception as e:
+            print(f"[{job['name']}] でエラー: {e}")
+            print(traceback.format_exc())
+            with lock:
+                failures.append(job["name"])
+        finally:
+            with lock:
+                busy[portal] -= 1
+
+
+def _work(portal: str, jobs: queue.Queue, open_worker, results: dict, failures: list, lock, busy: dict,
+          on_result=None) -> bool:
+    """ワーカー1つ分。ワーカーを開けなかった（ログイン失敗等）場合は False"""
+    opened = False
+    try:
+        with open_worker(portal) as handle:
+            opened = True
+            _drain(portal, jobs, handle, results, failures, lock, busy, on_result)
+    except Exception as e:
+        print(f"[{portal}] セッション{'の終了' if opened else 'を開始できません'}: {e}")
+        print(traceback.format_exc())
+    return opened
+
+
+def run(jobs, open_worker, workers: int = 1, limits=None, on_result=None):
+    """jobs（shops.jobs() の形式）を実行する。(results {ステップ名: [Path, ...]}, failures [ステップ名]) を返す"""
+    limits = limits or {}
+    queues = {}
+    for job in jobs:
+        queues.setdefault(job["portal"], queue.Queue()).put(job)
+    results, failures = {}, []
+    lock = threading.Lock()
+    active = {portal: 0 for portal in queues}
+    busy = {portal: 0 for portal in queues}  # ジョブを実行中のワーカー数
+    broken = set()
+    running = {}
+
+    def startable():
+        """ワーカーを起動できるポータル（1ワーカーあたりの残りジョブが多い順）。
+        待っているジョブが、手の空いている（起動中・ログイン中を含む）ワーカーより多い場合だけ起動する
+        （ジョブを実行中のワーカーは数えない。数えると先に起動したワーカーがジョブを取った時点で2つ目が起動しない）"""
+        with lock:
+            idle = {p: active[p] - busy[p] for p in queues}
+        candidates = [p for p, q in queues.items()
+                      if p not in broken and active[p] < limits.get(p, 1) and idle[p] < q.qsize()]
+        return sorted(candidates, key=lambda p: -queues[p].qsize() / (active[p] + 1))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="worker") as pool:
+        while True:
+            while len(running) < workers:
+                candidates = startable()
+                if not candidates:
+                    break
+                portal = candidates[0]
+                active[portal] += 1
+                running[pool.submit(_work, portal, queues[portal], open_worker, results, failures, lock, busy,
+                                    on_result)] = portal
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                portal = running.pop(future)
+                active[portal] -= 1
+                try:
+                    opened = future.result()
+                except Exception as e:
+                    print(f"[{portal}] ワーカーが異常終了しました: {e}")
+                    opened = False
+                if not opened:
+                    broken.add(portal)
+
+    # 実行できなかったジョブ（ログイン失敗等）
+    for portal, q in queues.items():
+        while not q.empty():
+            failures.append(q.get_nowait()["name"])
+    return results, failures
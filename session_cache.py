@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+ログイン済みセッション（Cookie）のローカルキャッシュ
+- ログイン成功時の Cookie をポータル別に .cache/sessions/<portal>.json へ保存（所有者のみ読み書き可）
+- SESSION_CACHE_TTL 秒（既定 6時間）を過ぎたものは使わない
+- 次回は Cookie を復元 → 軽いページ取得で有効性を確認 → 無効ならログインフォームへ
+
+保存先は環境変数 CACHE_DIR で変更可能。SESSION_CACHE=false で無効化。
+
+並列のワーカーは lease() で Cookie を使うワーカーを1つに限り、他のワーカーはそれぞれ新しくログインする。
+
+キャッシュの JSON を複数のプロセス（pipeline.py の並列ステージ）から更新する場合は update_json を使う
+（ロックファイルで排他し、読み直したうえで変更分だけ反映して書き換える）。
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+DEFAULT_TTL = 6 * 3600
+
+
+def cache_dir() -> Path:
+    """ローカルキャッシュの置き場所（各種キャッシュ共通）"""
+    base = os.getenv("CACHE_DIR")
+    return Path(base).expanduser() if base else Path(__file__).with_name(".cache")
+
+
+def _lock(f, blocking: bool = True) -> bool:
+    """開いたファイル f を排他ロックする（blocking=False で取れなければ False）"""
+    if os.name == "nt":
+        import msvcrt
+        while True:
+            f.seek(0)
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False  # LK_LOCK は約10秒で諦めるので、blocking なら取れるまで繰り返す
+    import fcntl
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _unlock(f):
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(path: Path):
+    """path を更新する間のプロセス間の排他（<path>.lock をロックする。同じプロセスの別スレッドも待つ）"""
+    lock_path = Path(path).with_name(Path(path).name + ".lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a+b") as f:
+        _lock(f)
+        try:
+            yield
+        finally:
+            _unlock(f)
+
+
+def update_json(path: Path, update) -> dict:
+    """JSON ファイルを排他して読み直し、update(data) で変更して書き戻す（一時ファイル → os.replace）。
+    他のプロセスが書いた内容を消さないよう、update では自分の変更分だけを反映すること。更新後の内容を返す"""
+    path = Path(path)
+    with file_lock(path):
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            data = {}
+        update(data)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+    return data
+
+
+def enabled() -> bool:
+    return os.getenv("SESSION_CACHE", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _ttl() -> float:
+    try:
+        return float(os.getenv("SESSION_CACHE_TTL", DEFAULT_TTL))
+    except ValueError:
+        return DEFAULT_TTL
+
+
+def _path(portal: str) -> Path:
+    return cache_dir() / "sessions" / f"{portal}.json"
+
+
+def save_cookies(portal: str, cookies):
+    """Cookie 一覧（Selenium 形式の dict）を保存する"""
+    if not enabled() or not cookies:
+        return
+    path = _path(portal)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.chmod(path.parent, 0o700)
+    except OSError:
+        pass
+    now = time.time()
+    payload = {"saved_at": now, "expires_at": now + _ttl(), "cookies": cookies}
+    tmp = path.with_suffix(".tmp")
+    # 作成時点から 0600 で開く（他ユーザーに読ませない）
+    fd = os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    try:
+        os.chmod(path, 0o600)
+    except OSError:
+        pass
+    print(f"[session] {portal}: Cookie を保存しました（{len(cookies)}件）")
+
+
+def load_cookies(portal: str):
+    """有効期限内の Cookie 一覧を返す。無い・期限切れ・壊れている場合は None"""
+    if not enabled():
+        return None
+    path = _path(portal)
+    if not path.exists():
+        return None
+    try:
+        payload = json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        clear(portal)
+        return None
+    if payload.get("expires_at", 0) < time.time():
+        print(f"[session] {portal}: キャッシュの有効期限切れ")
+        clear(portal)
+        return None
+    return payload.get("cookies") or None
+
+
+def clear(portal: str):
+    try:
+        _path(portal).unlink()
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def lease(portal: str):
+    """キャッシュの Cookie（サーバー側では1つのセッション）を使うワーカーを同時に1つに限る。
+    取れれば True（Cookie を復元・保存してよい）、他のワーカー（別プロセスを含む）が使用中なら False を返す。
+    False のワーカーは新しくログインし、キャッシュを読み書きしない（店舗の選択・切替がワーカー間で混ざらない）"""
+    if not enabled():
+        yield False
+        return
+    path = _path(portal).with_suffix(".lease")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        acquired = _lock(f, blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                _unlock(f)
+
+
+# ===== Selenium =====
+
+def restore_driver_session(driver, portal: str, base_url: str, probe_url: str, is_logged_in) -> bool:
+    """キャッシュの Cookie をブラウザに戻し、probe_url を開いて is_logged_in(driver) で確認する"""
+    cookies = load_cookies(portal)
+    if not cookies:
+        return False
+    try:
+        # Cookie はそのドメインのページを開いていないと追加できない
+        driver.get(base_url)
+        for c in cookies:
+            cookie = {k: c[k] for k in ("name", "value", "domain", "path", "secure", "httpOnly") if c.get(k) is not None}
+            if c.get("expiry"):
+                cookie["expiry"] = int(c["expiry"])
+            try:
+                driver.add_cookie(cookie)
+            except Exception:
+                continue
+        driver.get(probe_url)
+        if is_logged_in(driver):
+            print(f"[session] {portal}: キャッシュのセッションでログイン済み（ログインフォームを省略）")
+            return True
+    except Exception as e:
+        print(f"[session] {portal}: セッション復元でエラー: {e}")
+    print(f"[session] {portal}: キャッシュのセッションは無効です。ログインし直します")
+    clear(portal)
+    try:
+        driver.delete_all_cookies()
+    except Exception:
+        pass
+    return False
+
+
+def save_driver_session(driver, portal: str):
+    try:
+        save_cookies(portal, driver.get_cookies())
+    except Exception as e:
+        print(f"[session] {portal}: Cookie の保存に失敗: {e}")
+
+
+# ===== requests =====
+
+def restore_requests_session(session, portal: str) -> bool:
+    """キャッシュの Cookie を requests.Session に設定する（有効性の確認は呼び出し側）"""
+    cookies = load_cookies(portal)
+    if not cookies:
+        return False
+    for c in cookies:
+        session.cookies.set(c["name"], c["value"], domain=c.get("domain"), path=c.get("path", "/"),
+                            secure=bool(c.get("secure")))
+    return True
+
+
+def save_requests_session(session, portal: str):
+    cookies = [
+        {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path,
+         "secure": bool(c.secure), "expiry": c.expires}
+        for c in session.cookies
+    ]
+    try:
+        save_cookies(portal, cookies)
+    except Exception as e:
+        print(f"[session] {portal}: Cookie の保存に失敗: {e}")
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+ポータル・店舗の設定（shops.json）
+- ポータルごとに、エクスポートの種類・店舗・同時セッション数（max_concurrency）を定義する
+- shops.json が無ければ DEFAULT_CONFIG（従来の固定の店舗）を使う。置き場所は SHOPS_FILE で変更可能
+- ステップ名: 既定の店舗は "<portal>.<export>"、それ以外は "<portal>.<export>_<店舗id>"
+  （例: carsensor.access / carsensor.access_hiace。pipeline.py・portal_runner.py 共通）
+
+shops.json の例:
+    {
+      "max_workers": 4,
+      "portals": {
+        "carsensor": {
+          "max_concurrency": 1,
+          "shops": [
+            {"id": "main", "name": "メイン", "default": true},
+            {"id": "hiace", "name": "ハイエース専門店", "switch": ["ハイエース専門店", "CAR PRODUCE"]}
+          ]
+        },
+        "goonet": {
+          "max_concurrency": 2,
+          "shops": [
+            {"id": "carad", "value": "1002529", "name": "輸入車専門店　ＣＡＲＡＤ", "filename_prefix": "CARAD_"}
+          ]
+        }
+      }
+    }
+
+店舗の項目:
+    id               … ステップ名・ファイル名に使う英数字
+    default          … ログイン直後に表示される店舗（カーセンサー。店舗切替をしない）
+    switch           … 「他店舗参照」で選ぶ店舗の表示名の候補（カーセンサー）
+    suffix           … ファイル名の末尾に付ける文字列（既定: 既定の店舗以外は "_<id>"。名前に id を含むファイルには付けない）
+    value            … 店舗選択（SelectGroupShop）の値（グーネット）
+    filename_prefix  … ファイル名の先頭に付ける文字列（グーネット）
+"""
+
+import copy
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+DEFAULT_CONFIG = {
+    # 全ポータル合計の同時セッション数
+    "max_workers": 3,
+    "portals": {
+        "carsensor": {
+            # 既定は1セッション（ログインは1回、店舗は「他店舗参照」で順に切り替える）。
+            # 2 以上にすると、キャッシュの Cookie を使う1ワーカー以外はそれぞれ新しくログインし、
+            # 店舗ごとのジョブを別セッションで同時に実行する（同じアカウントで同時にログインしてよい場合のみ）
+            "max_concurrency": 1,
+            # 店舗ごとに取得するエクスポート
+            "exports": ["access", "registration"],
+            "shops": [
+                {"id": "main", "name": "メイン", "default": True},
+                {"id": "hiace", "name": "ハイエース専門店", "switch": ["ハイエース専門店", "CAR PRODUCE"]},
+            ],
+        },
+        "goonet": {
+            "max_concurrency": 2,
+            "exports": ["access"],
+            # 店舗に関係なく1回だけ取得するエクスポート（グループ全体の在庫検索）
+            "portal_exports": ["registration"],
+            "shops": [
+                {"id": "hiace", "value": "1000491", "name": "ハイエース専門店　ＣＡＲ　ＰＲＯＤＵＣＥ　｜　カープロデュース",
+                 "filename_prefix": "ハイエース専門店_"},
+                {"id": "carad", "value": "1002529", "name": "輸入車専門店　ＣＡＲＡＤ", "filename_prefix": "CARAD_"},
+            ],
+        },
+    },
+}
+
+_lock = threading.Lock()
+_config = None
+
+
+def config_path() -> Path:
+    path = os.getenv("SHOPS_FILE")
+    return Path(path).expanduser() if path else Path(__file__).with_name("shops.json")
+
+
+def _validate(config: dict):
+    for portal, conf in config["portals"].items():
+        if portal not in DEFAULT_CONFIG["portals"]:
+            raise RuntimeError(f"shops.json: 未対応のポータルです: {portal}")
+        ids = [shop.get("id") for shop in conf["shops"]]
+        for shop_id in ids:
+            if not shop_id or not re.fullmatch(r"[A-Za-z0-9]+", str(shop_id)):
+                raise RuntimeError(f"shops.json: {portal} の店舗 id は英数字で指定してください: {shop_id!r}")
+        if len(set(ids)) != len(ids):
+            raise RuntimeError(f"shops.json: {portal} の店舗 id が重複しています")
+        for shop in conf["shops"]:
+            if portal == "carsensor" and not shop.get("default") and not shop.get("switch"):
+                raise RuntimeError(f"shops.json: carsensor の店舗 {shop['id']} に switch（店舗名の候補）がありません")
+            if portal == "goonet" and not (shop.get("value") and shop.get("filename_prefix")):
+                raise RuntimeError(f"shops.json: goonet の店舗 {shop['id']} に value / filename_prefix がありません")
+        if portal == "carsensor" and sum(1 for shop in conf["shops"] if shop.get("default")) > 1:
+            raise RuntimeError("shops.json: carsensor の default の店舗は1つだけです")
+
+
+def load() -> dict:
+    """shops.json（無ければ DEFAULT_CONFIG）を読み込む。ポータル単位で既定値を補う"""
+    global _config
+    with _lock:
+        if _config is not None:
+            return _config
+        config = copy.deepcopy(DEFAULT_CONFIG)
+        path = config_path()
+        if path.exists():
+            try:
+                loaded = json.loads(path.read_text(encoding="utf-8"))
+            except ValueError as e:
+                raise RuntimeError(f"{path.name} を読み込めません: {e}")
+            config["max_workers"] = loaded.get("max_workers", config["max_workers"])
+            for portal, conf in (loaded.get("portals") or {}).items():
+                config["portals"].setdefault(portal, {"shops": []}).update(conf)
+        _validate(config)
+        # 既定の店舗（ログイン直後の店舗）を先頭にする（同じセッションでは元の店舗に戻れないため）
+        for conf in config["portals"].values():
+            conf["shops"].sort(key=lambda shop: not shop.get("default"))
+        _config = config
+        return _config
+
+
+def portals():
+    return list(load()["portals"])
+
+
+def shops(portal: str):
+    return load()["portals"][portal]["shops"]
+
+
+def exports(portal: str):
+    """portal で取得するエクスポートの種類（店舗ごと → 店舗に関係なく1回 の順）"""
+    conf = load()["portals"][portal]
+    return list(conf.get("exports", [])) + list(conf.get("portal_exports", []))
+
+
+def max_workers() -> int:
+    return max(1, int(os.getenv("SCHEDULER_WORKERS") or load()["max_workers"]))
+
+
+def limit(portal: str) -> int:
+    return max(1, int(load()["portals"][portal].get("max_concurrency", 1)))
+
+
+def suffix(shop) -> str:
+    """ファイル名の末尾に付ける文字列（既定の店舗は付けない）"""
+    if shop is None or shop.get("default"):
+        return ""
+    return shop.get("suffix", f"_{shop['id']}")
+
+
+def suffixed(path: Path, shop) -> Path:
+    """店舗の suffix を付けたパス（既定の店舗、またはファイル名に店舗 id が含まれている場合はそのまま）"""
+    path = Path(path)
+    if not suffix(shop) or shop["id"] in re.split(r"[_\s-]+", path.stem):
+        return path
+    return path.with_name(f"{path.stem}{suffix(shop)}{path.suffix}")
+
+
+def step_name(portal: str, export: str, shop=None) -> str:
+    if shop is None or shop.get("default"):
+        return f"{portal}.{export}"
+    return f"{portal}.{export}_{shop['id']}"
+
+
+def jobs(portal: str, steps=None):
+    """portal のエクスポート（ジョブ）一覧。店舗ごとにまとめた順（同じ店舗への切替を1回にする）"""
+    conf = load()["portals"][portal]
+    result = []
+    for shop in conf["shops"]:
+        for export in conf.get("exports", []):
+            result.append({"name": step_name(portal, export, shop), "portal": portal, "export": export, "shop": shop})
+    for export in conf.get("portal_exports", []):
+        result.append({"name": step_name(portal, export), "portal": portal, "export": export, "shop": None})
+    return [job for job in result if steps is None or job["name"] in steps]
+
+
+def steps(portal: str, export: str):
+    """export（access / registration）のステップ名（pipeline のデータセット単位）"""
+    return tuple(job["name"] for job in jobs(portal) if job["export"] == export)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+登録物件（在庫）スナップショットの差分抽出
+- torokubukken（カーセンサー）/ 在庫検索一覧・goonet_bukken（グーネット）は毎日の全件スナップショット
+- 前回のスナップショット（.cache/snapshots/）と車両キーで突き合わせ、追加・削除・変更の行だけを
+  <元の名前>_delta.csv に書き出す（先頭列: 変更種別 / 変更列、文字コード・改行は元ファイルと同じ）
+- 全件ファイルは一定間隔（DELTA_FULL_DAYS、既定 7日）ごと、または前回が無い・列構成が変わった場合に必ず残す
+- 同じファイルで再実行した場合は、その前のスナップショットと比較し直す（差分が空にならない）
+
+使い方:
+    python snapshot_delta.py carsensor_registration downloads/torokubukken_main_20240101.csv
+"""
+
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import export_parser
+import session_cache
+
+# データセットごとの車両キー列（先に見つかった列を使う）
+VEHICLE_KEYS = {
+    "carsensor_registration": ("物件管理番号", "物件番号", "管理番号", "物件ID"),
+    "goonet_registration": ("在庫ID", "在庫番号", "物件ID", "車両ID", "管理番号"),
+}
+
+# 全件スナップショットを残す間隔（日）
+FULL_SNAPSHOT_DAYS = float(os.getenv("DELTA_FULL_DAYS", "7"))
+# 実行時刻のずれで1日遅れないように、間隔より少し早めに全件扱いにする（秒）
+FULL_SNAPSHOT_SLACK = 3600
+
+KIND_ADDED, KIND_REMOVED, KIND_CHANGED = "追加", "削除", "変更"
+
+
+def series_key(dataset_key: str, file_path) -> str:
+    """同じ系列（ポータル・データセット・店舗）のファイルに共通のキー。ファイル名の数字（日時）は # にまとめる"""
+    return f"{dataset_key}/{re.sub(r'[0-9]+', '#', Path(file_path).name)}"
+
+
+def _snapshot_paths(series: str):
+    base = session_cache.cache_dir() / "snapshots" / re.sub(r"[^\w.-]", "_", series)
+    return base.with_suffix(".json"), base.with_suffix(".csv"), base.with_suffix(".prev.csv")
+
+
+def _load_meta(path: Path):
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+
+def read_snapshot(path: Path):
+    """CSV を読み込み (header, rows, encoding, newline) を返す（文字コードは export_parser と同じ判定）"""
+    raw = Path(path).read_bytes()
+    encoding = export_parser.detect_encoding(raw[:export_parser.DETECT_BYTES])
+    try:
+        text = raw.decode(encoding)
+    except UnicodeDecodeError:
+        raise RuntimeError(f"文字コードを判別できません: {Path(path).name}")
+    newline = "\r\n" if "\r\n" in text[:4096] else "\n"
+    rows = list(csv.reader(io.StringIO(text, newline="")))
+    if not rows:
+        raise RuntimeError(f"空のファイルです: {Path(path).name}")
+    return rows[0], rows[1:], encoding, newline
+
+
+def key_columns(dataset_key: str, header):
+    for name in VEHICLE_KEYS.get(dataset_key, ()):
+        if name in header:
+            return [header.index(name)]
+    raise RuntimeError(f"車両キーの列が見つかりません（候補: {', '.join(VEHICLE_KEYS.get(dataset_key, ()))}）")
+
+
+def index_rows(rows, columns):
+    """車両キー → 行。キーが空の行は除き、重複は後の行を採る"""
+    indexed = {}
+    for row in rows:
+        key = tuple(row[i].strip() if i < len(row) else "" for i in columns)
+        if any(key):
+            indexed[key] = row
+    return indexed
+
+
+def compute_delta(header, previous, current):
+    """previous / current（キー → 行）から [(変更種別, 変更列, 行)] を返す"""
+    delta = []
+    for key, row in current.items():
+        before = previous.get(key)
+        if before is None:
+            delta.append((KIND_ADDED, "", row))
+        elif before != row:
+            changed = [name for i, name in enumerate(header)
+                       if (before[i] if i < len(before) else "") != (row[i] if i < len(row) else "")]
+            delta.append((KIND_CHANGED, "/".join(changed), row))
+    for key, row in previous.items():
+        if key not in current:
+            delta.append((KIND_REMOVED, "", row))
+    return delta
+
+
+def write_delta(path: Path, header, delta, encoding: str, newline: str):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator=newline)
+    writer.writerow(["変更種別", "変更列"] + header)
+    for kind, changed, row in delta:
+        writer.writerow([kind, changed] + row)
+    tmp = path.with_name(f".{path.name}.part")
+    tmp.write_bytes(buf.getvalue().encode("utf-8-sig" if encoding == "utf-8-sig" else encoding, errors="replace"))
+    os.replace(tmp, path)
+
+
+def extract(dataset_key: str, file_path: Path):
+    """file_path を前回のスナップショットと比較して差分ファイルを書き出し、スナップショットを更新する。
+    戻り値: {"series", "delta"（差分ファイル or None）, "added", "removed", "changed", "full_due", "reason"}"""
+    file_path = Path(file_path)
+    series = series_key(dataset_key, file_path)
+    meta_path, current_path, prev_path = _snapshot_paths(series)
+    meta = _load_meta(meta_path)
+    header, rows, encoding, newline = read_snapshot(file_path)
+    columns = key_columns(dataset_key, header)
+
+    digest = hashlib.sha256(file_path.read_bytes()).hexdigest()
+    rerun = meta.get("source") == file_path.name and meta.get("sha256") == digest
+    base_path = prev_path if rerun else current_path
+    base_meta = meta.get("previous", {}) if rerun else meta
+
+    result = {"series": series, "delta": None, "added": 0, "removed": 0, "changed": 0,
+              "full_due": False, "reason": None}
+    if not base_path.exists():
+        result.update(full_due=True, reason="前回のスナップショットがありません")
+    else:
+        base_header, base_rows, _, _ = read_snapshot(base_path)
+        if base_header != header:
+            result.update(full_due=True, reason="列構成が前回と異なります")
+        else:
+            delta = compute_delta(header, index_rows(base_rows, columns), index_rows(rows, columns))
+            for kind, key in ((KIND_ADDED, "added"), (KIND_REMOVED, "removed"), (KIND_CHANGED, "changed")):
+                result[key] = sum(1 for d in delta if d[0] == kind)
+            if delta:
+                result["delta"] = file_path.with_name(f"{file_path.stem}_delta{file_path.suffix}")
+                write_delta(result["delta"], header, delta, encoding, newline)
+    last_full = base_meta.get("full_at", 0)
+    if not result["full_due"] and time.time() - last_full >= FULL_SNAPSHOT_DAYS * 86400 - FULL_SNAPSHOT_SLACK:
+        result.update(full_due=True, reason=f"前回の全件から {FULL_SNAPSHOT_DAYS:g} 日以上経過")
+
+    # スナップショットを更新（再実行時は1世代前を残したまま）
+    current_path.parent.mkdir(parents=True, exist_ok=True)
+    if not rerun:
+        if current_path.exists():
+            os.replace(current_path, prev_path)
+        tmp = current_path.with_name(f".{current_path.name}.part")
+        shutil.copyfile(file_path, tmp)
+        os.replace(tmp, current_path)
+    new_meta = {
+        "source": file_path.name, "sha256": digest, "taken_at": time.time(), "rows": len(rows),
+        "full_at": time.time() if result["full_due"] else last_full,
+        "previous": base_meta if rerun else {k: v for k, v in meta.items() if k != "previous"},
+    }
+    meta_path.write_text(json.dumps(new_meta, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print(f"[DELTA] {file_path.name}: 追加 {result['added']} / 削除 {result['removed']} / 変更 {result['changed']}"
+          f"（全 {len(rows)} 行）" + (f" → {result['delta'].name}" if result["delta"] else "")
+          + (f" / 全件: {result['reason']}" if result["full_due"] else ""))
+    return result
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2 or argv[0] not in VEHICLE_KEYS:
+        print(f"使い方: python snapshot_delta.py {{{'|'.join(VEHICLE_KEYS)}}} <CSVファイル>")
+        return 2
+    extract(argv[0], Path(argv[1]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
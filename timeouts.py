@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+記録した所要時間から待ち時間（タイムアウト）を決める
+- tracing の記録（.cache/traces/*.jsonl の直近 TIMEOUT_HISTORY_DAYS 日）から、成功したスパンの所要時間を
+  名前（とポータル）ごとに集める
+- タイムアウト = p99 × TIMEOUT_MARGIN + TIMEOUT_PAD 秒 を [下限, 上限] に収める
+  上限は従来の固定値（これより長く待つことはない）、下限は TIMEOUT_FLOOR 秒
+- 記録が TIMEOUT_MIN_SAMPLES 件に満たない場合・ADAPTIVE_TIMEOUTS=false の場合は従来の固定値
+- wait() は WebDriverWait と同じ until() を持ち、待った時間を "wait.<名前>" として記録する（次回以降の学習元）
+- 学習の対象（毎日1回の実行を想定。期間 30 日・最小 10 件）
+  - ログインフォーム・ログイン後の遷移・店舗ごとのボタン・店舗切替など、1回の実行で1〜数回の待ち
+    → 10 回ほど実行すると学習値に切り替わる（期間内の実行が 10 回未満なら固定値のまま）
+  - download.wait（ブラウザのダウンロード完了待ち）はポータルごと。1回の実行で店舗数×エクスポート数の記録がある
+  - HTTP での直接取得は download.fetch として別に記録する（download.wait の学習値には含めない）
+- GitHub Actions では .cache/traces をキャッシュして実行をまたいで引き継ぐ（download_data.yml）
+
+使い方:
+    timeouts.wait(driver, "carsensor.login.form", 20, portal="carsensor").until(EC.presence_of_element_located(...))
+    download_events.wait_for_downloads(driver, d, timeout=timeouts.timeout("download.wait", 180, "carsensor"),
+                                       portal="carsensor")
+"""
+
+import datetime
+import json
+import math
+import os
+import threading
+
+import session_cache
+import tracing
+
+# 1回の実行で1回だけの待ち（ログイン等）も期間内に MIN_SAMPLES 件集まるよう、期間は MIN_SAMPLES 日より十分長くする
+HISTORY_DAYS = int(os.getenv("TIMEOUT_HISTORY_DAYS", "30"))
+MIN_SAMPLES = int(os.getenv("TIMEOUT_MIN_SAMPLES", "10"))
+MARGIN = float(os.getenv("TIMEOUT_MARGIN", "1.5"))
+PAD = float(os.getenv("TIMEOUT_PAD", "2"))
+FLOOR = float(os.getenv("TIMEOUT_FLOOR", "3"))
+
+_lock = threading.Lock()
+_samples = None  # {(name, portal): [秒, ...]}（portal=None はポータル問わず）
+
+
+def enabled() -> bool:
+    return os.getenv("ADAPTIVE_TIMEOUTS", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _trace_files():
+    """直近 HISTORY_DAYS 日の記録（TRACE_FILE 指定時はそのファイル）"""
+    if os.getenv("TRACE_FILE"):
+        return [tracing.trace_file()]
+    folder = session_cache.cache_dir() / "traces"
+    today = datetime.date.today()
+    days = (today - datetime.timedelta(days=i) for i in range(HISTORY_DAYS))
+    return [folder / f"{day:%Y%m%d}.jsonl" for day in days]
+
+
+def _load():
+    global _samples
+    with _lock:
+        if _samples is not None:
+            return _samples
+        samples = {}
+        for path in _trace_files():
+            try:
+                f = open(path, encoding="utf-8")
+            except OSError:
+                continue
+            with f:
+                for line in f:
+                    # 成功したスパンだけを json として読む（行数が多いため先に文字列で絞る）
+                    if '"status": "ok"' not in line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    seconds = (record.get("duration_ms") or 0) / 1000
+                    for key in ((record["name"], record.get("portal")), (record["name"], None)):
+                        samples.setdefault(key, []).append(seconds)
+        _samples = {key: sorted(values) for key, values in samples.items()}
+        return _samples
+
+
+def percentile(values, q: float) -> float:
+    """ソート済みの values の q 分位（最近傍）"""
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+def timeout(name: str, default: float, portal=None, floor: float = None) -> float:
+    """name（スパン名）の記録から決めたタイムアウト秒。記録が少なければ default"""
+    if not enabled():
+        return default
+    samples = _load()
+    values = samples.get((name, portal)) if portal else None
+    if not values or len(values) < MIN_SAMPLES:
+        values = samples.get((name, None))
+    if not values or len(values) < MIN_SAMPLES:
+        return default
+    learned = percentile(values, 0.99) * MARGIN + PAD
+    return round(min(default, max(min(floor if floor is not None else FLOOR, default), learned)), 1)
+
+
+class _Wait:
+    """WebDriverWait の代わり。until() の所要時間を wait.<name> として記録する"""
+
+    def __init__(self, driver, name: str, seconds: float, portal=None, poll_frequency: float = 0.5):
+        self.driver, self.name, self.seconds, self.portal = driver, name, seconds, portal
+        self.poll_frequency = poll_frequency
+
+    def until(self, method, message: str = ""):
+        from selenium.webdriver.support.ui import WebDriverWait
+        with tracing.span(f"wait.{self.name}", portal=self.portal, timeout=self.seconds):
+            return WebDriverWait(self.driver, self.seconds, poll_frequency=self.poll_frequency).until(method, message)
+
+    def until_not(self, method, message: str = ""):
+        from selenium.webdriver.support.ui import WebDriverWait
+        with tracing.span(f"wait.{self.name}", portal=self.portal, timeout=self.seconds):
+            return WebDriverWait(self.driver, self.seconds, poll_frequency=self.poll_frequency).until_not(method, message)
+
+
+def wait(driver, name: str, default: float, portal=None, floor: float = None, poll_frequency: float = 0.5):
+    """学習したタイムアウトの WebDriverWait 相当を返す（default は従来の固定値＝上限）"""
+    return _Wait(driver, name, timeout(f"wait.{name}", default, portal, floor), portal, poll_frequency)
+
+
+def report():
+    """学習済みのタイムアウトを表示する（python timeouts.py）"""
+    samples = _load()
+    print(f"{'名前':<40}{'ポータル':<12}{'件数':>6}{'p50':>8}{'p99':>8}{'タイムアウト':>12}")
+    for (name, portal), values in sorted(samples.items(), key=lambda kv: (kv[0][0], kv[0][1] or "")):
+        if not name.startswith(("wait.", "download.wait")):
+            continue
+        learned = percentile(values, 0.99) * MARGIN + PAD
+        print(f"{name:<40}{portal or '-':<12}{len(values):>6}{percentile(values, 0.5):>7.1f}s"
+              f"{percentile(values, 0.99):>7.1f}s{max(FLOOR, learned):>11.1f}s"
+              + ("" if len(values) >= MIN_SAMPLES else "（記録不足）"))
+
+
+if __name__ == "__main__":
+    report()
@@ -1,34 +1,56 @@
 # -*- coding: utf-8 -*-
 import os
+import hashlib
 import platform
 import sys
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
-# Windows環境でのUTF-8出力を強制設定
-if platform.system() == "Windows":
-    import io
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
-    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
-
-# パッケージのインポートを試行し、エラーハンドリングを追加
-try:
-    from google.auth.transport.requests import Request
-    from google.oauth2.credentials import Credentials
-    from google_auth_oauthlib.flow import InstalledAppFlow
-    from googleapiclient.discovery import build
-    from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
-    print("[OK] すべてのGoogleライブラリのインポートに成功しました")
-except ImportError as e:
-    print(f"[ERROR] Googleライブラリのインポートエラー: {e}")
-    print("\n解決方法:")
-    print("1. 仮想環境を作成してください:")
-    print("   python -m venv google_drive_env")
-    print("   google_drive_env\\Scripts\\activate")
-    print("   pip install google-api-python-client google-auth-httplib2 google-auth-oauthlib")
-    print("\n2. または以下のコマンドで再インストール:")
-    print("   pip install --force-reinstall google-api-python-client google-auth-httplib2 google-auth-oauthlib")
-    sys.exit(1)
+import download_events
+import export_store
+import session_cache
+import shops
+import snapshot_delta
+import tracing
+
+# Google のライブラリ（読み込みに時間が掛かるため、最初に使うときに load_google() で読み込む）
+Request = Credentials = InstalledAppFlow = build = HttpError = MediaFileUpload = None
+_google_lock = threading.Lock()
+
+def load_google():
+    """Google のライブラリを読み込む（2回目以降は何もしない）。無ければ導入方法を表示して RuntimeError"""
+    global Request, Credentials, InstalledAppFlow, build, HttpError, MediaFileUpload
+    with _google_lock:
+        if MediaFileUpload is not None:
+            return
+        try:
+            from google.auth.transport.requests import Request
+            from google.oauth2.credentials import Credentials
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            from googleapiclient.discovery import build
+            from googleapiclient.errors import HttpError
+            from googleapiclient.http import MediaFileUpload
+            print("[OK] すべてのGoogleライブラリのインポートに成功しました")
+        except ImportError as e:
+            print(f"[ERROR] Googleライブラリのインポートエラー: {e}")
+            print("\n解決方法:")
+            print("1. 仮想環境を作成してください:")
+            print("   python -m venv google_drive_env")
+            print("   google_drive_env\\Scripts\\activate")
+            print("   pip install google-api-python-client google-auth-httplib2 google-auth-oauthlib")
+            print("\n2. または以下のコマンドで再インストール:")
+            print("   pip install --force-reinstall google-api-python-client google-auth-httplib2 google-auth-oauthlib")
+            raise RuntimeError(f"Googleライブラリを読み込めません: {e}")
+
+def use_utf8_console():
+    """Windows環境でのUTF-8出力を強制設定（スクリプトとして実行したときだけ）"""
+    if platform.system() == "Windows":
+        import io
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+        sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
 # 必要な権限スコープ（既存フォルダ検索 + ファイル作成）
 SCOPES = [
@@ -46,6 +68,67 @@ REG_PARENT_FOLDER_NAME = '登録物件数'
 REG_CAR_SENSOR_FOLDER_NAME = 'カーセンサー_登録物件数'
 REG_GOONET_FOLDER_NAME = 'グーネット_登録物件数'
 
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+# フォルダID キャッシュの有効期間（秒）。既定 7日
+FOLDER_CACHE_TTL = int(os.getenv("DRIVE_FOLDER_CACHE_TTL", str(7 * 24 * 3600)))
+
+# アップロード設定
+# - 同時アップロード数（スレッドごとに service を作成）
+UPLOAD_WORKERS = max(1, int(os.getenv("DRIVE_UPLOAD_WORKERS", "4")))
+# - チャンクサイズ（MB）。Drive の仕様で 256KB の倍数に丸める
+_CHUNK_UNIT = 256 * 1024
+UPLOAD_CHUNK_SIZE = max(1, round(float(os.getenv("DRIVE_UPLOAD_CHUNK_MB", "8")) * 1024 * 1024 / _CHUNK_UNIT)) * _CHUNK_UNIT
+# - 1チャンクあたりの再試行回数（失敗時は受信済みの位置から再開）
+UPLOAD_RETRIES = int(os.getenv("DRIVE_UPLOAD_RETRIES", "5"))
+# - 前回アップロードした内容と同じファイルはアップロードしない（false で常にアップロード）
+SKIP_UNCHANGED = os.getenv("DRIVE_SKIP_UNCHANGED", "true").strip().lower() in ("1", "true", "yes", "on")
+
+# データセット定義（ファイル名の判定 → アップロード先 マイドライブ/<parent>/<child>）
+DATASETS = {
+    'carsensor_access': {
+        'label': 'カーセンサー: hankyobukken',
+        'parent': PARENT_FOLDER_NAME, 'child': TARGET_FOLDER_NAME,
+        # 'hankyobukken' を含むCSV
+        'match': lambda name: 'hankyobukken' in name.lower(),
+    },
+    'goonet_access': {
+        'label': 'グーネット: 効果分析（在庫）',
+        'parent': PARENT_FOLDER_NAME, 'child': GOONET_FOLDER_NAME,
+        # リネーム後のファイル名で判定（shops.json の goonet の店舗の filename_prefix で始まる）
+        'match': lambda name: name.startswith(tuple(shop['filename_prefix'] for shop in shops.shops('goonet'))),
+    },
+    'carsensor_registration': {
+        'label': 'カーセンサー: torokubukken/登録物件数',
+        'parent': REG_PARENT_FOLDER_NAME, 'child': REG_CAR_SENSOR_FOLDER_NAME,
+        'match': lambda name: 'torokubukken' in name.lower(),
+    },
+    'goonet_registration': {
+        'label': 'グーネット: 在庫検索一覧/登録物件数',
+        'parent': REG_PARENT_FOLDER_NAME, 'child': REG_GOONET_FOLDER_NAME,
+        'match': lambda name: '在庫検索一覧' in name or 'goonet_bukken' in name.lower(),
+    },
+}
+
+def classify_file(path: Path):
+    """ファイル名から DATASETS のキーを返す（該当なしは None）"""
+    for key, dataset in DATASETS.items():
+        if dataset['match'](path.name):
+            return key
+    return None
+
+def collect_dataset_files(downloads_folder: Path):
+    """ダウンロードフォルダ（直下とジョブごとのフォルダ。一時フォルダは除く）の CSV をデータセット別に振り分ける"""
+    grouped = {key: [] for key in DATASETS}
+    for p in download_events.published_files(downloads_folder):
+        key = classify_file(p)
+        if key:
+            grouped[key].append(p)
+    return grouped
+
+def upload_dataset_files(service, dataset_key: str, files):
+    """1データセット分のファイルを既存フォルダへアップロードし、ファイルIDの一覧を返す"""
+    return upload_files(service, [(dataset_key, Path(p)) for p in files])
+
 def get_downloads_folder():
     """OSに応じてダウンロードフォルダのパスを取得（環境変数・settings.json対応）"""
     # 1. 環境変数 DOWNLOAD_DIR を優先
@@ -68,6 +151,7 @@ def get_downloads_folder():
 
 def authenticate_google_drive():
     """Google Drive APIの認証を行う"""
+    load_google()
     creds = None
     
     # token.jsonが存在する場合は既存の認証情報を使用
@@ -97,8 +181,55 @@ def authenticate_google_drive():
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
     
+    global _credentials
+    _credentials = creds
     return build('drive', 'v3', credentials=creds)
 
+# ===== スレッドごとの service =====
+# googleapiclient の HTTP 接続はスレッドセーフではないため、スレッドごとに service を作る
+
+_credentials = None
+_thread_local = threading.local()
+
+def get_thread_service():
+    """このスレッド専用の Drive service を返す（認証情報は authenticate_google_drive のものを共有）"""
+    service = getattr(_thread_local, 'service', None)
+    if service is None:
+        if _credentials is None:
+            raise RuntimeError("authenticate_google_drive() を先に呼び出してください")
+        load_google()
+        service = build('drive', 'v3', credentials=_credentials, cache_discovery=False)
+        _thread_local.service = service
+    return service
+
+# ===== バッチリクエスト =====
+
+# Drive のバッチは1回あたり最大100件
+BATCH_LIMIT = 100
+
+def run_batch(service, requests):
+    """{キー: HttpRequest} をバッチでまとめて実行し、{キー: (レスポンス, 例外)} を返す。
+    失敗した項目は例外を入れて返す（他の項目には影響しない）"""
+    results = {}
+    items = list(requests.items())
+    for start in range(0, len(items), BATCH_LIMIT):
+        chunk = items[start:start + BATCH_LIMIT]
+        keys = {str(i): key for i, (key, _) in enumerate(chunk)}
+
+        def callback(request_id, response, exception):
+            results[keys[request_id]] = (response, exception)
+
+        batch = service.new_batch_http_request(callback=callback)
+        for i, (_, request) in enumerate(chunk):
+            batch.add(request, request_id=str(i))
+        try:
+            batch.execute()
+        except Exception as e:
+            # バッチ自体の失敗 → 未完了の項目すべてに例外を設定
+            for key in keys.values():
+                results.setdefault(key, (None, e))
+    return results
+
 def find_existing_nested_folder(service, parent_name: str, child_name: str):
     """親フォルダ名が parent_name の直下にある child_name フォルダのIDを返す（作成しない）。"""
     query = (
@@ -106,112 +237,401 @@ def find_existing_nested_folder(service, parent_name: str, child_name: str):
     )
     results = service.files().list(q=query, fields="files(id,name,parents)").execute()
     items = results.get('files', [])
+    # 親フォルダ名の確認はバッチで1回にまとめる
+    parent_ids = {pid for item in items for pid in item.get('parents', []) or []}
+    parents = run_batch(service, {pid: service.files().get(fileId=pid, fields='id,name') for pid in parent_ids})
     for item in items:
         for parent_id in item.get('parents', []) or []:
-            try:
-                parent = service.files().get(fileId=parent_id, fields='id,name').execute()
-                if parent.get('name') == parent_name:
-                    print(f"[FOUND] フォルダ '{parent_name}/{child_name}' が見つかりました (ID: {item['id']})")
-                    return item['id']
-            except Exception:
-                continue
+            parent, error = parents.get(parent_id, (None, None))
+            if error is None and parent and parent.get('name') == parent_name:
+                print(f"[FOUND] フォルダ '{parent_name}/{child_name}' が見つかりました (ID: {item['id']})")
+                return item['id']
     print(f"[WARNING] フォルダ '{parent_name}/{child_name}' は見つかりません（作成しません）。")
     return None
 
+# ===== フォルダパス → ID の解決（メモリ＋ディスクキャッシュ） =====
+
+_folder_cache = None  # {"アクセス数/カーセンサー_アクセス数": {"id": ..., "resolved_at": ...}}
+_folder_cache_changes = {}  # 保存していない変更 {パス: エントリ or None（削除）}
+
+def _folder_cache_file() -> Path:
+    return session_cache.cache_dir() / "drive_folders.json"
+
+def _fresh(entries: dict) -> dict:
+    now = time.time()
+    return {k: v for k, v in entries.items() if now - v.get("resolved_at", 0) < FOLDER_CACHE_TTL}
+
+def _load_folder_cache():
+    global _folder_cache
+    if _folder_cache is None:
+        _folder_cache = {}
+        try:
+            _folder_cache = _fresh(json.loads(_folder_cache_file().read_text(encoding="utf-8")))
+        except Exception:
+            pass
+    return _folder_cache
+
+def _cache_folder(key: str, folder_id: str):
+    entry = {"id": folder_id, "resolved_at": time.time()}
+    _load_folder_cache()[key] = entry
+    _folder_cache_changes[key] = entry
+
+def _forget_folder(key: str):
+    _load_folder_cache().pop(key, None)
+    _folder_cache_changes[key] = None
+
+def _save_folder_cache():
+    """変更した分だけを、排他してファイルを読み直してから反映する（並列のステージが解決した ID を消さない）"""
+    if not _folder_cache_changes:
+        return
+    changes = dict(_folder_cache_changes)
+
+    def apply(data):
+        for key, entry in changes.items():
+            if entry is None:
+                data.pop(key, None)
+            else:
+                data[key] = entry
+        for key in set(data) - set(_fresh(data)):
+            del data[key]
+
+    try:
+        merged = session_cache.update_json(_folder_cache_file(), apply)
+    except Exception as e:
+        print(f"[WARNING] フォルダキャッシュを保存できませんでした: {e}")
+        return
+    _folder_cache_changes.clear()
+    # 他のプロセスが解決した分も取り込む（呼び出し側が持っている参照はそのまま使えるようにする）
+    cache = _load_folder_cache()
+    cache.clear()
+    cache.update(merged)
+
+def _q(value: str) -> str:
+    """Drive 検索クエリ用に文字列をエスケープ"""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+def _child_folder_request(service, parent_id: str, name: str):
+    query = f"name='{_q(name)}' and '{parent_id}' in parents and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+    return service.files().list(q=query, fields="files(id)", pageSize=10)
+
+def find_child_folder(service, parent_id: str, name: str):
+    """parent_id 直下の name フォルダのIDを返す（なければ None）"""
+    items = _child_folder_request(service, parent_id, name).execute().get('files', [])
+    return items[0]['id'] if items else None
+
+def resolve_folder_path(service, folder_path: str):
+    """'アクセス数/カーセンサー_アクセス数' のようなマイドライブ配下のパスをIDに解決する（作成しない）。
+    ルートから親IDで1階層ずつ辿り、途中の階層も含めてキャッシュする。"""
+    cache = _load_folder_cache()
+    parts = [p for p in folder_path.strip("/").split("/") if p]
+    if not parts:
+        return 'root'
+    key = "/".join(parts)
+    if key in cache:
+        return cache[key]["id"]
+
+    with tracing.span("drive.lookup", path=key):
+        # キャッシュ済みの最も深い階層から辿る
+        parent_id, depth = 'root', 0
+        for i in range(len(parts) - 1, 0, -1):
+            prefix = "/".join(parts[:i])
+            if prefix in cache:
+                parent_id, depth = cache[prefix]["id"], i
+                break
+        for i in range(depth, len(parts)):
+            parent_id = find_child_folder(service, parent_id, parts[i])
+            if not parent_id:
+                break
+            _cache_folder("/".join(parts[:i + 1]), parent_id)
+
+        if not parent_id and len(parts) == 2:
+            # マイドライブ直下に無い（共有フォルダ等）場合は従来の名前検索で探す
+            parent_id = find_existing_nested_folder(service, parts[0], parts[1])
+            if parent_id:
+                _cache_folder(key, parent_id)
+        if parent_id:
+            _save_folder_cache()
+            print(f"[FOUND] フォルダ '{key}' (ID: {parent_id})")
+        else:
+            print(f"[WARNING] フォルダ '{key}' は見つかりません（作成しません）。")
+    return parent_id
+
+@tracing.traced("drive.lookup", batch=True)
+def resolve_folder_paths(service, folder_paths):
+    """複数のフォルダパスを、階層ごとに1回のバッチでまとめて解決してキャッシュに載せる。
+    バッチで解決できなかったパスは resolve_folder_path（1件ずつ・従来の名前検索あり）で解決する。
+    {パス: ID or None} を返す"""
+    cache = _load_folder_cache()
+    targets = {"/".join(p for p in path.strip("/").split("/") if p) for path in folder_paths}
+    prefixes = {}
+    for key in targets:
+        parts = key.split("/")
+        for i in range(1, len(parts) + 1):
+            prefixes["/".join(parts[:i])] = parts[:i]
+    missing = set()  # 見つからなかった（またはエラーの）階層
+    depth = 1
+    updated = False
+    while True:
+        # 親が解決済みで、自身が未解決の階層をまとめて問い合わせる
+        level = {}
+        for key, parts in prefixes.items():
+            if len(parts) != depth or key in cache or key in missing:
+                continue
+            parent_key = "/".join(parts[:-1])
+            parent_id = 'root' if depth == 1 else cache.get(parent_key, {}).get("id")
+            if parent_id:
+                level[key] = _child_folder_request(service, parent_id, parts[-1])
+            else:
+                missing.add(key)
+        if not level and depth > max((len(p) for p in prefixes.values()), default=0):
+            break
+        for key, (response, error) in run_batch(service, level).items():
+            files = (response or {}).get('files', [])
+            if error is not None:
+                print(f"[WARNING] フォルダ '{key}' のバッチ検索に失敗しました: {error}")
+            if error is None and files:
+                _cache_folder(key, files[0]['id'])
+                updated = True
+            else:
+                missing.add(key)
+        depth += 1
+    if updated:
+        _save_folder_cache()
+    return {key: (cache[key]["id"] if key in cache else resolve_folder_path(service, key)) for key in targets}
+
+def invalidate_folder_path(folder_path: str):
+    """フォルダパス（とその配下）のキャッシュを破棄する（アップロード先が 404 の場合など）"""
+    cache = _load_folder_cache()
+    key = "/".join(p for p in folder_path.strip("/").split("/") if p)
+    for k in [k for k in cache if k == key or k.startswith(key + "/")]:
+        _forget_folder(k)
+    _save_folder_cache()
+
 def get_target_folder_id(service):
     """マイドライブ/アクセス数/カーセンサー_アクセス数 の既存フォルダIDを取得（作成しない）"""
-    return find_existing_nested_folder(service, PARENT_FOLDER_NAME, TARGET_FOLDER_NAME)
+    return resolve_folder_path(service, f"{PARENT_FOLDER_NAME}/{TARGET_FOLDER_NAME}")
 
 def get_child_folder_id(service, child_folder_name: str):
     """マイドライブ/アクセス数/<子> の既存フォルダIDを返す（作成しない）。"""
-    return find_existing_nested_folder(service, PARENT_FOLDER_NAME, child_folder_name)
+    return resolve_folder_path(service, f"{PARENT_FOLDER_NAME}/{child_folder_name}")
 
 def get_nested_child_folder_id(service, parent_folder_name: str, child_folder_name: str):
     """マイドライブ/<親>/<子> の既存フォルダIDを返す（作成しない）。"""
-    return find_existing_nested_folder(service, parent_folder_name, child_folder_name)
+    return resolve_folder_path(service, f"{parent_folder_name}/{child_folder_name}")
+
+# ===== フォルダ内ファイル一覧（1フォルダにつき1回だけ取得） =====
+
+_folder_listings = {}  # folder_id -> {ファイル名: サイズ}
+
+def list_folder_files(service, folder_id: str, refresh: bool = False):
+    """フォルダ直下のファイル名とサイズを {name: size} で返す（ゴミ箱除外）。
+    実行中はメモリに保持し、同じフォルダへの問い合わせは API を呼ばない。"""
+    if folder_id in _folder_listings and not refresh:
+        return _folder_listings[folder_id]
+    listing = {}
+    page_token = None
+    with tracing.span("drive.list", folder_id=folder_id) as sp:
+        while True:
+            results = _listing_request(service, folder_id, page_token).execute()
+            for f in results.get('files', []):
+                listing[f['name']] = int(f.get('size') or 0)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        sp["files"] = len(listing)
+    _folder_listings[folder_id] = listing
+    print(f"[LIST] フォルダ (ID: {folder_id}) のファイル数: {len(listing)}")
+    return listing
+
+def _listing_request(service, folder_id: str, page_token=None):
+    query = f"'{folder_id}' in parents and mimeType!='{FOLDER_MIME_TYPE}' and trashed=false"
+    return service.files().list(q=query, fields="nextPageToken, files(name,size)", pageSize=1000, pageToken=page_token)
+
+@tracing.traced("drive.list", batch=True)
+def list_folders_files(service, folder_ids):
+    """複数フォルダの一覧をバッチでまとめて取得し、キャッシュに載せる（続きのページもバッチで取得）。
+    失敗したフォルダはキャッシュせず、list_folder_files で個別に取り直す"""
+    pending = {fid: None for fid in set(folder_ids) if fid not in _folder_listings}
+    listings = {fid: {} for fid in pending}
+    while pending:
+        requests = {fid: _listing_request(service, fid, token) for fid, token in pending.items()}
+        pending = {}
+        for fid, (response, error) in run_batch(service, requests).items():
+            if error is not None:
+                print(f"[WARNING] フォルダ (ID: {fid}) の一覧取得に失敗しました: {error}")
+                listings.pop(fid, None)
+                continue
+            for f in response.get('files', []):
+                listings[fid][f['name']] = int(f.get('size') or 0)
+            if response.get('nextPageToken'):
+                pending[fid] = response['nextPageToken']
+    for fid, listing in listings.items():
+        _folder_listings[fid] = listing
+        print(f"[LIST] フォルダ (ID: {fid}) のファイル数: {len(listing)}")
+    return {fid: list_folder_files(service, fid) for fid in folder_ids}
+
+def remember_uploaded(folder_id: str, name: str, size: int):
+    """アップロードしたファイルを一覧キャッシュに反映する"""
+    if folder_id in _folder_listings:
+        _folder_listings[folder_id][name] = size
+
+# ===== 内容ハッシュの記録（ファイル名の日時が違っても中身が前回と同じならアップロードしない） =====
+
+_manifest = None  # {"carsensor_access/hankyobukken_#.csv": {"sha256": ..., "size": ..., "file": ..., "uploaded_at": ...}}
+_manifest_changes = {}  # 保存していない記録（保存時はこれだけをファイルに反映する）
+
+def _manifest_file() -> Path:
+    return session_cache.cache_dir() / "upload_manifest.json"
+
+def _load_manifest(refresh: bool = False):
+    """アップロード記録を返す。refresh=True ならファイルを読み直す（他のプロセスの記録を取り込む）"""
+    global _manifest
+    if _manifest is None or refresh:
+        try:
+            loaded = json.loads(_manifest_file().read_text(encoding="utf-8"))
+        except Exception:
+            loaded = {}
+        _manifest = {**loaded, **_manifest_changes}
+    return _manifest
+
+def _save_manifest():
+    """記録した分だけを、排他してファイルを読み直してから反映する。
+    pipeline.py は系列ごとのアップロードを別プロセスで並列に行うため、手元の記録で丸ごと上書きしない"""
+    global _manifest
+    if not _manifest_changes:
+        return
+    changes = dict(_manifest_changes)
+    try:
+        merged = session_cache.update_json(_manifest_file(), lambda data: data.update(changes))
+    except Exception as e:
+        print(f"[WARNING] アップロード記録を保存できませんでした: {e}")
+        return
+    for series in changes:
+        _manifest_changes.pop(series, None)
+    _manifest = {**merged, **_manifest_changes}
+
+def file_sha256(file_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_unchanged(series: str, digest: str) -> bool:
+    """前回アップロードした内容と同じか"""
+    entry = _load_manifest().get(series)
+    return bool(entry) and entry.get("sha256") == digest
+
+def record_uploaded(series: str, file_path: Path, digest: str, size: int, file_id: str):
+    entry = {"sha256": digest, "size": size, "file": Path(file_path).name,
+             "file_id": file_id, "uploaded_at": time.time()}
+    _manifest_changes[series] = entry
+    _load_manifest()[series] = entry
 
 def file_exists_in_folder(service, filename: str, parent_folder_id: str) -> bool:
     """指定フォルダ内に同名ファイルが既に存在するかを確認（ゴミ箱除外）。"""
-    query = (
-        f"name='{filename}' and '{parent_folder_id}' in parents and trashed=false"
-    )
-    results = service.files().list(q=query, fields="files(id,name)").execute()
-    return len(results.get('files', [])) > 0
+    return filename in list_folder_files(service, parent_folder_id)
 
 def upload_single_file(service, file_path: Path, child_folder_name: str):
-    if not file_path.exists():
-        print(f"エラー: ファイルが存在しません: {file_path}")
-        return None
-    target_folder_id = get_child_folder_id(service, child_folder_name)
-    if not target_folder_id:
-        print(f"エラー: 'マイドライブ/{PARENT_FOLDER_NAME}/{child_folder_name}' が見つからないためスキップします。")
-        return None
-    print(f"アップロード先: マイドライブ/{PARENT_FOLDER_NAME}/{child_folder_name} (ID: {target_folder_id})")
-    # 既存重複チェック
-    if file_exists_in_folder(service, file_path.name, target_folder_id):
-        print("[SKIP] 既に同名ファイルが存在するためアップロードをスキップします。")
-        try:
-            file_path.unlink()
-            print(f"[DELETE] ローカルファイルを削除しました: {file_path}")
-        except Exception as e:
-            print(f"⚠ ローカルファイルの削除に失敗しました: {file_path} | {e}")
-        return None
+    """マイドライブ/アクセス数/<子> へアップロード"""
+    return upload_single_file_to(service, file_path, PARENT_FOLDER_NAME, child_folder_name)
+
+def _is_retryable(error) -> bool:
+    """再試行で回復し得るエラーか（429/5xx とネットワーク系）"""
+    if HttpError is not None and isinstance(error, HttpError):
+        return error.resp.status == 429 or error.resp.status >= 500
+    return isinstance(error, (OSError, ConnectionError, TimeoutError)) or type(error).__module__.startswith('httplib2')
+
+@tracing.traced("drive.upload")
+def create_file(service, file_path: Path, folder_id: str):
+    """レジューム可能なチャンクアップロード。
+    チャンク送信に失敗した場合は、次の next_chunk() がサーバー側の受信済み位置を問い合わせてそこから再開する。"""
+    tracing.annotate(file=file_path.name)
     file_metadata = {
         'name': file_path.name,
-        'parents': [target_folder_id]
+        'parents': [folder_id]
     }
-    # ファイルハンドルを with で管理し、アップロード後に確実にクローズする（Windows のロック対策）
-    print("アップロードを開始します...")
-    with open(file_path, 'rb') as fh:
-        media = MediaIoBaseUpload(fh, mimetype='text/csv', resumable=False)
-        file = service.files().create(body=file_metadata, media_body=media, fields='id,name,size,createdTime').execute()
-    print("[OK] アップロード完了!")
-    print(f"ファイル名: {file.get('name')}")
-    print(f"ファイルID: {file.get('id')}")
-    print(f"作成日時: {file.get('createdTime')}")
-    print(f"アップロード先: マイドライブ/{PARENT_FOLDER_NAME}/{child_folder_name}")
-    print(f"Google DriveでのURL: https://drive.google.com/file/d/{file.get('id')}/view")
-    
-    # アップロード成功後にローカルファイルを削除（単発削除）
+    media = MediaFileUpload(str(file_path), mimetype='text/csv', chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
     try:
-        file_path.unlink()
-        print(f"[DELETE] ローカルファイルを削除しました: {file_path}")
-    except Exception as e:
-        print(f"[WARNING] ローカルファイルの削除に失敗しました: {file_path} | {e}")
-    return file.get('id')
+        tracing.add(bytes=media.size())
+        request = service.files().create(body=file_metadata, media_body=media, fields='id,name,size,createdTime')
+        response = None
+        failures = 0
+        while response is None:
+            try:
+                status, response = request.next_chunk()
+            except Exception as e:
+                if not _is_retryable(e) or failures >= UPLOAD_RETRIES:
+                    raise
+                failures += 1
+                tracing.add(retries=1)
+                wait = min(2 ** failures, 30)
+                print(f"[RETRY] {file_path.name}: チャンク送信に失敗（{e}）。{wait}秒後に "
+                      f"{request.resumable_progress} バイト目から再開します（{failures}/{UPLOAD_RETRIES}）")
+                time.sleep(wait)
+                continue
+            failures = 0
+            if status and media.size() > UPLOAD_CHUNK_SIZE:
+                print(f"  {file_path.name}: {int(status.progress() * 100)}%")
+        return response
+    finally:
+        # ファイルハンドルを確実にクローズする（Windows のロック対策）
+        media.stream().close()
 
-def upload_single_file_to(service, file_path: Path, parent_folder_name: str, child_folder_name: str):
+def plan_upload(service, file_path: Path, parent_folder_name: str, child_folder_name: str):
+    """アップロード先フォルダIDを解決し、重複チェックまで行う。
+    アップロード不要（ファイル無し・フォルダ無し・同名あり）の場合は None を返す"""
     if not file_path.exists():
         print(f"エラー: ファイルが存在しません: {file_path}")
         return None
+    folder_path = f"{parent_folder_name}/{child_folder_name}"
     target_folder_id = get_nested_child_folder_id(service, parent_folder_name, child_folder_name)
     if not target_folder_id:
-        print(f"エラー: 'マイドライブ/{parent_folder_name}/{child_folder_name}' が見つからないためスキップします。")
+        print(f"エラー: 'マイドライブ/{folder_path}' が見つからないためスキップします。")
         return None
-    print(f"アップロード先: マイドライブ/{parent_folder_name}/{child_folder_name} (ID: {target_folder_id})")
+    print(f"アップロード先: マイドライブ/{folder_path} (ID: {target_folder_id})")
     # 既存重複チェック
     if file_exists_in_folder(service, file_path.name, target_folder_id):
-        print("[SKIP] 既に同名ファイルが存在するためアップロードをスキップします。")
+        print(f"[SKIP] 既に同名ファイルが存在するためアップロードをスキップします: {file_path.name}")
         try:
             file_path.unlink()
             print(f"[DELETE] ローカルファイルを削除しました: {file_path}")
         except Exception as e:
             print(f"⚠ ローカルファイルの削除に失敗しました: {file_path} | {e}")
         return None
-    file_metadata = {
-        'name': file_path.name,
-        'parents': [target_folder_id]
-    }
-    print("アップロードを開始します...")
-    with open(file_path, 'rb') as fh:
-        media = MediaIoBaseUpload(fh, mimetype='text/csv', resumable=False)
-        file = service.files().create(body=file_metadata, media_body=media, fields='id,name,size,createdTime').execute()
-    print("[OK] アップロード完了!")
-    print(f"ファイル名: {file.get('name')}")
-    print(f"ファイルID: {file.get('id')}")
-    print(f"作成日時: {file.get('createdTime')}")
-    print(f"アップロード先: マイドライブ/{parent_folder_name}/{child_folder_name}")
-    print(f"Google DriveでのURL: https://drive.google.com/file/d/{file.get('id')}/view")
+    return target_folder_id
+
+# フォルダID・フォルダ一覧・アップロード記録のキャッシュを複数スレッドから更新するときのロック
+_state_lock = threading.Lock()
+
+def upload_planned_file(service, file_path: Path, parent_folder_name: str, child_folder_name: str, target_folder_id: str):
+    """plan_upload 済みのファイルをアップロードし、ファイルIDを返す"""
+    folder_path = f"{parent_folder_name}/{child_folder_name}"
+    print(f"アップロードを開始します... {file_path.name}")
+    try:
+        file = create_file(service, file_path, target_folder_id)
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        # キャッシュしていたフォルダが削除・移動された → 解決し直して1回だけ再試行
+        print(f"[WARNING] アップロード先が見つかりません（404）。フォルダを解決し直します: {folder_path}")
+        with _state_lock:
+            invalidate_folder_path(folder_path)
+            target_folder_id = get_nested_child_folder_id(service, parent_folder_name, child_folder_name)
+        if not target_folder_id:
+            print(f"エラー: 'マイドライブ/{folder_path}' が見つからないためスキップします。")
+            return None
+        file = create_file(service, file_path, target_folder_id)
+    remember_uploaded(target_folder_id, file.get('name') or file_path.name, int(file.get('size') or 0))
+    # 並列アップロード時に行が混ざらないよう1回の print で出力
+    print("[OK] アップロード完了!\n"
+          f"ファイル名: {file.get('name')}\n"
+          f"ファイルID: {file.get('id')}\n"
+          f"作成日時: {file.get('createdTime')}\n"
+          f"アップロード先: マイドライブ/{folder_path}\n"
+          f"Google DriveでのURL: https://drive.google.com/file/d/{file.get('id')}/view")
+
+    # アップロード成功後にローカルファイルを削除（単発削除）
     try:
         file_path.unlink()
         print(f"[DELETE] ローカルファイルを削除しました: {file_path}")
@@ -219,6 +639,130 @@ def upload_single_file_to(service, file_path: Path, parent_folder_name: str, chi
         print(f"[WARNING] ローカルファイルの削除に失敗しました: {file_path} | {e}")
     return file.get('id')
 
+def upload_single_file_to(service, file_path: Path, parent_folder_name: str, child_folder_name: str):
+    target_folder_id = plan_upload(service, file_path, parent_folder_name, child_folder_name)
+    if not target_folder_id:
+        return None
+    return upload_planned_file(service, file_path, parent_folder_name, child_folder_name, target_folder_id)
+
+def plan_uploads(service, jobs):
+    """(dataset_key, Path) の一覧のうち、アップロードするものを (planned, unchanged) に分ける。
+    planned: [(dataset, Path, フォルダID, サイズ, 系列, SHA-256)]、unchanged: 前回と同じ内容でスキップしたファイル名"""
+    planned, unchanged, seen = [], [], {}
+    # 他のプロセス（並列のステージ）が記録した分も見て判定する
+    _load_manifest(refresh=True)
+    for dataset_key, file_path in jobs:
+        dataset = DATASETS[dataset_key]
+        print(f"\n[{dataset['label']}] アップロード: {file_path}")
+        series = snapshot_delta.series_key(dataset_key, file_path)
+        digest = file_sha256(file_path) if file_path.exists() else None
+        if SKIP_UNCHANGED and digest and (is_unchanged(series, digest) or seen.get(series) == digest):
+            # 中身が前回と同じ（日時だけ違う）→ アップロードせず、同名ファイルがある場合と同様にローカルを削除
+            print(f"[UNCHANGED] 前回アップロードした内容と同じためスキップします: {file_path.name}")
+            unchanged.append(file_path.name)
+            try:
+                file_path.unlink()
+                print(f"[DELETE] ローカルファイルを削除しました: {file_path}")
+            except Exception as e:
+                print(f"[WARNING] ローカルファイルの削除に失敗しました: {file_path} | {e}")
+            continue
+        folder_id = plan_upload(service, Path(file_path), dataset['parent'], dataset['child'])
+        if folder_id:
+            seen[series] = digest
+            planned.append((dataset, Path(file_path), folder_id, Path(file_path).stat().st_size, series, digest))
+    return planned, unchanged
+
+@tracing.traced("upload")
+def upload_files(service, jobs, workers: int = None):
+    """(dataset_key, Path) の一覧をアップロードし、ファイルIDの一覧を返す。
+    フォルダ解決・重複チェックは service で順に行い、アップロードはスレッドプールで並列に行う"""
+    workers = workers or UPLOAD_WORKERS
+    jobs = [(key, Path(p)) for key, p in jobs]
+    # 0) アップロード後（・変更なしのスキップ時）にローカルのファイルを消すため、先にローカルの蓄積へ取り込む
+    export_store.ingest_files([p for _, p in jobs if p.exists()])
+    # 1) 計画：フォルダ解決（階層ごと）と一覧取得をそれぞれバッチでまとめて先に行う
+    if jobs:
+        paths = {f"{DATASETS[key]['parent']}/{DATASETS[key]['child']}" for key, _ in jobs}
+        folder_ids = resolve_folder_paths(service, paths)
+        list_folders_files(service, [fid for fid in folder_ids.values() if fid])
+    planned, unchanged = plan_uploads(service, jobs)
+    tracing.annotate(unchanged=len(unchanged))
+    if not planned:
+        if unchanged:
+            print(f"\n[SUMMARY] 変更なし {len(unchanged)} 件（アップロードなし）")
+        return []
+
+    # 2) 並列アップロード
+    def run(item, svc=None):
+        dataset, file_path, folder_id = item[:3]
+        return upload_planned_file(svc or get_thread_service(), file_path,
+                                   dataset['parent'], dataset['child'], folder_id)
+
+    uploaded, sent_bytes, failed = [], 0, []
+    started = time.perf_counter()
+    workers = min(workers, len(planned))
+    if workers == 1:
+        outcomes = []
+        for item in planned:
+            try:
+                outcomes.append((item, run(item, service), None))
+            except Exception as e:
+                outcomes.append((item, None, e))
+    else:
+        print(f"\n{len(planned)} 件を {workers} 並列でアップロードします（チャンク {UPLOAD_CHUNK_SIZE // 1024}KB）")
+        outcomes = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(run, item): item for item in planned}
+            for future in as_completed(futures):
+                try:
+                    outcomes.append((futures[future], future.result(), None))
+                except Exception as e:
+                    outcomes.append((futures[future], None, e))
+    elapsed = max(time.perf_counter() - started, 1e-6)
+
+    for (_, file_path, _, size, series, digest), fid, error in outcomes:
+        if error is not None:
+            print(f"[ERROR] アップロード失敗: {file_path.name} | {error}")
+            failed.append(file_path.name)
+        elif fid:
+            uploaded.append(fid)
+            sent_bytes += size
+            if digest:
+                with _state_lock:
+                    record_uploaded(series, file_path, digest, size, fid)
+    if uploaded:
+        with _state_lock:
+            _save_manifest()
+    print(f"\n[SUMMARY] アップロード {len(uploaded)} 件 / {sent_bytes:,} バイト / {elapsed:.1f} 秒 "
+          f"→ {sent_bytes / elapsed:,.0f} bytes/s, {len(uploaded) / elapsed:.2f} files/s"
+          + (f" / 変更なし {len(unchanged)} 件" if unchanged else "")
+          + (f"（失敗 {len(failed)} 件）" if failed else ""))
+    if failed:
+        raise RuntimeError(f"アップロードに失敗したファイルがあります: {', '.join(failed)}")
+    return uploaded
+
+@tracing.traced("upload.file")
+def upload_file(dataset_key: str, file_path: Path):
+    """1ファイルをアップロードし、ファイルID（アップロード不要だった場合は None）を返す。
+    複数スレッドから同時に呼んでよい（キャッシュの更新はロックして順に、送信はスレッドごとの service で並列に行う）。
+    authenticate_google_drive() を先に呼び出しておくこと"""
+    file_path = Path(file_path)
+    tracing.annotate(dataset=dataset_key, file=file_path.name)
+    service = get_thread_service()
+    if file_path.exists():
+        export_store.ingest_files([file_path])
+    with _state_lock:
+        planned, _ = plan_uploads(service, [(dataset_key, file_path)])
+    if not planned:
+        return None
+    dataset, file_path, folder_id, size, series, digest = planned[0]
+    fid = upload_planned_file(service, file_path, dataset['parent'], dataset['child'], folder_id)
+    if fid and digest:
+        with _state_lock:
+            record_uploaded(series, file_path, digest, size, fid)
+            _save_manifest()
+    return fid
+
 def upload_matching_downloads():
     """ダウンロードフォルダからパターンに一致するCSVをそれぞれのフォルダへアップロードする。
     - 'hankyobukken' を含むCSV → カーセンサー_アクセス数
@@ -230,53 +774,14 @@ def upload_matching_downloads():
         service = authenticate_google_drive()
 
         # 収集
-        all_csvs = [p for p in downloads_folder.glob('*.csv')]
-        hankyo = [p for p in all_csvs if 'hankyobukken' in p.name.lower()]
-        # グーネットアクセス数: リネーム後のファイル名で検索（ハイエース専門店_ または CARAD_ で始まる）
-        kouka = [p for p in all_csvs if p.name.startswith('ハイエース専門店_') or p.name.startswith('CARAD_')]
-        toroku = [p for p in all_csvs if 'torokubukken' in p.name.lower()]
-        zaikoken = [p for p in all_csvs if '在庫検索一覧' in p.name or 'goonet_bukken' in p.name.lower()]
-
-        print("アップロード対象(カーセンサー: hankyobukken):")
-        for p in hankyo:
-            print(f" - {p}")
-        print("アップロード対象(グーネット: 効果分析（在庫）):")
-        for p in kouka:
-            print(f" - {p}")
-        print("アップロード対象(カーセンサー: torokubukken/登録物件数):")
-        for p in toroku:
-            print(f" - {p}")
-        print("アップロード対象(グーネット: 在庫検索一覧/登録物件数):")
-        for p in zaikoken:
-            print(f" - {p}")
-
-        uploaded = []
-        for p in hankyo:
-            print(f"\n[カーセンサー] アップロード: {p}")
-            fid = upload_single_file(service, p, TARGET_FOLDER_NAME)
-            if fid:
-                uploaded.append(fid)
-
-        for p in kouka:
-            print(f"\n[グーネット] アップロード: {p}")
-            fid = upload_single_file(service, p, GOONET_FOLDER_NAME)
-            if fid:
-                uploaded.append(fid)
-
-        # 登録物件数系
-        for p in toroku:
-            print(f"\n[カーセンサー/登録物件数] アップロード: {p}")
-            fid = upload_single_file_to(service, p, REG_PARENT_FOLDER_NAME, REG_CAR_SENSOR_FOLDER_NAME)
-            if fid:
-                uploaded.append(fid)
-
-        for p in zaikoken:
-            print(f"\n[グーネット/登録物件数] アップロード: {p}")
-            fid = upload_single_file_to(service, p, REG_PARENT_FOLDER_NAME, REG_GOONET_FOLDER_NAME)
-            if fid:
-                uploaded.append(fid)
-
-        return uploaded
+        grouped = collect_dataset_files(downloads_folder)
+        for key, files in grouped.items():
+            print(f"アップロード対象({DATASETS[key]['label']}):")
+            for p in files:
+                print(f" - {p}")
+
+        jobs = [(key, p) for key, files in grouped.items() for p in files]
+        return upload_files(service, jobs)
 
     except Exception as e:
         print(f"エラーが発生しました: {e}")
@@ -284,6 +789,7 @@ def upload_matching_downloads():
 
 def main():
     """メイン実行関数"""
+    use_utf8_console()
     print("=== Google Drive CSV アップローダー ===")
     
     # credentials.jsonの存在確認
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+処理段階ごとの計測（スパン）を JSON Lines で記録する
+- 1スパン = 1行: name / 開始時刻 / duration_ms / status / bytes / retries / 任意の属性 / 親スパン
+- 出力先は TRACE_FILE（既定: .cache/traces/<日付>.jsonl）。複数プロセス・スレッドから追記してよい
+- driver を渡したスパンには、その間に Chrome が行った通信（パフォーマンスログの Network イベント）のうち
+  時間の掛かったものを network として付加する（内側のスパンで集計済みの通信は含まない）
+- TRACE=false で無効化（span は何も書かない）
+
+使い方:
+    with tracing.span("login", portal="carsensor", driver=driver) as s:
+        ...
+        s["retries"] += 1
+
+    @tracing.traced("driver.build")
+    def build_driver(...): ...
+
+    tracing.add(bytes=size)   # 実行中の（最も内側の）スパンに加算
+"""
+
+import contextlib
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+import weakref
+from pathlib import Path
+
+import session_cache
+
+# スパンに付加する通信の件数（所要時間の長い順）
+NETWORK_TOP = 5
+
+_local = threading.local()
+# ドライバごとの応答待ちリクエスト（requestId → 情報）と、起動からの累計
+_network_pending = weakref.WeakKeyDictionary()
+_network_totals = weakref.WeakKeyDictionary()
+_write_lock = threading.Lock()
+# 1回の実行を通して同じ ID（pipeline のワーカープロセスには環境変数で引き継ぐ）
+TRACE_ID = os.environ.setdefault("TRACE_ID", uuid.uuid4().hex[:12])
+
+
+def enabled() -> bool:
+    return os.getenv("TRACE", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+def trace_file() -> Path:
+    path = os.getenv("TRACE_FILE")
+    if path:
+        return Path(path).expanduser()
+    return session_cache.cache_dir() / "traces" / f"{datetime.date.today():%Y%m%d}.jsonl"
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """実行中の最も内側のスパン（無ければ None）"""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def add(**counters):
+    """実行中のスパンの bytes / retries などに加算する"""
+    s = current()
+    if s is None:
+        return
+    for k, v in counters.items():
+        s[k] = (s.get(k) or 0) + (v or 0)
+
+
+def annotate(**attrs):
+    """実行中のスパンに属性を追加する（店舗名など、関数の中で決まる値）"""
+    s = current()
+    if s is not None:
+        s.update(attrs)
+
+
+def _write(record: dict):
+    path = trace_file()
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    try:
+        with _write_lock:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError as e:
+        print(f"[trace] 書き込みに失敗: {e}")
+
+
+# ===== Chrome の通信タイミング =====
+
+def network_summary(driver):
+    """前回の取得以降に完了した Chrome の通信を集計する。
+    {"requests", "bytes", "blocked", "slowest": [{"url", "status", "type", "ms", "ttfb_ms", "bytes"}]} を返す"""
+    import download_events  # download_events が tracing を使うため遅延 import
+
+    pending = _network_pending.setdefault(driver, {})
+    totals = _network_totals.setdefault(driver, {"requests": 0, "bytes": 0, "blocked": 0})
+    finished = []
+    for msg in download_events.take_events(driver, ("Network.",)):
+        method, params = msg.get("method"), msg.get("params", {})
+        request_id = params.get("requestId")
+        if method == "Network.requestWillBeSent":
+            pending[request_id] = {"url": params.get("request", {}).get("url", ""), "start": params.get("timestamp"),
+                                   "type": params.get("type")}
+        elif request_id in pending:
+            req = pending[request_id]
+            if method == "Network.responseReceived":
+                response = params.get("response", {})
+                timing = response.get("timing") or {}
+                req["status"] = response.get("status")
+                if timing.get("receiveHeadersEnd") is not None and timing.get("sendStart") is not None:
+                    req["ttfb_ms"] = round(timing["receiveHeadersEnd"] - timing["sendStart"], 1)
+            elif method in ("Network.loadingFinished", "Network.loadingFailed"):
+                del pending[request_id]
+                req["ms"] = round((params.get("timestamp", req["start"] or 0) - (req["start"] or 0)) * 1000, 1)
+                req["bytes"] = int(params.get("encodedDataLength") or 0)
+                if method == "Network.loadingFailed":
+                    req["error"] = params.get("errorText")
+                    # 軽量モード（Network.setBlockedURLs）で止めたもの
+                    req["blocked"] = bool(params.get("blockedReason")) or "BLOCKED_BY_CLIENT" in (req["error"] or "")
+                finished.append(req)
+    summary = {
+        "requests": len([r for r in finished if not r.get("blocked")]),
+        "bytes": sum(r["bytes"] for r in finished),
+        "blocked": len([r for r in finished if r.get("blocked")]),
+    }
+    for k, v in summary.items():
+        totals[k] += v
+    slowest = sorted((r for r in finished if not r.get("blocked")), key=lambda r: r["ms"], reverse=True)[:NETWORK_TOP]
+    summary["slowest"] = [{k: v for k, v in r.items() if k != "start"} for r in slowest]
+    return summary
+
+
+def network_totals(driver):
+    """起動からの通信件数・転送量・ブロック件数の累計（未集計のイベントも取り込む）"""
+    network_summary(driver)
+    return dict(_network_totals.get(driver, {"requests": 0, "bytes": 0, "blocked": 0}))
+
+
+# ===== スパン =====
+
+@contextlib.contextmanager
+def span(name: str, driver=None, **attrs):
+    """name の段階を計測し、終了時に1行書き出す。yield する dict に属性・カウンタを追加できる"""
+    if not enabled():
+        yield {"bytes": 0, "retries": 0}
+        return
+    stack = _stack()
+    record = {
+        "trace_id": TRACE_ID,
+        "span_id": uuid.uuid4().hex[:12],
+        "parent_id": stack[-1]["span_id"] if stack else None,
+        "name": name,
+        "start": datetime.datetime.now().isoformat(timespec="milliseconds"),
+        "pid": os.getpid(),
+        "thread": threading.current_thread().name,
+        "bytes": 0,
+        "retries": 0,
+        **attrs,
+    }
+    stack.append(record)
+    started = time.perf_counter()
+    try:
+        yield record
+        record["status"] = "ok"
+    except BaseException as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"[:500]
+        raise
+    finally:
+        record["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if driver is not None:
+            try:
+                record["network"] = network_summary(driver)
+            except Exception as e:
+                record["network"] = {"error": str(e)}
+        stack.pop()
+        _write(record)
+
+
+def traced(name: str, driver_arg=None, **attrs):
+    """関数全体をスパンで包むデコレータ。driver_arg に位置引数の番号を渡すとその driver の通信も付加する"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            driver = args[driver_arg] if driver_arg is not None and len(args) > driver_arg else None
+            with span(name, driver=driver, function=func.__qualname__, **attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator